@@ -2,8 +2,86 @@
 api.py: Contains the transformational functions required for the sample
 """
 
+import base64
+import binascii
+import json
+import threading
 import uuid
+import cache
+import config
 import db
+import render
+
+# project_id -> (owner_id, ETag, JSON body bytes) of whole-project responses,
+# see get_project_response(). Writes go through invalidate_project(), which also
+# bumps the generation so a read that raced with the write is not cached.
+_project_cache = cache.LRUCache(config.PROJECT_CACHE_SIZE, ttl=config.PROJECT_CACHE_TTL)
+_project_cache_lock = threading.Lock()
+_project_cache_generation = 0
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor cannot be decoded"""
+
+
+class InvalidSearch(ValueError):
+    """Raised when a search query has no terms"""
+
+
+def encode_cursor(after):
+    """encode_cursor - wrap a db page key into an opaque cursor string
+    :param after: the db next_after key (a string, an int or a list of them),
+        or None on the last page
+    :return: (string) cursor, or None on the last page
+    """
+    if after is None:
+        return None
+    raw = json.dumps([after], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _is_key(value, key_type):
+    """_is_key - is value a key part of key_type (str, int or float, a bool is not an int)"""
+    return isinstance(value, key_type) and not isinstance(value, bool)
+
+
+def decode_cursor(cursor, key_type):
+    """decode_cursor - unwrap a cursor from encode_cursor()
+    :param cursor: (string) cursor, None or "" for the first page
+    :param key_type: the type of key the endpoint pages on: str, int, or a tuple of
+        types for a composite key, e.g. (int, str) for [created_at, comment_id]
+    :return: the db page key, None for the first page
+    :raises InvalidCursor: if the cursor does not decode to a key of key_type
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        after, = json.loads(raw)
+    except (binascii.Error, ValueError, TypeError) as err:
+        raise InvalidCursor(f"invalid cursor {cursor!r}") from err
+    if isinstance(key_type, tuple):
+        valid = (isinstance(after, list) and len(after) == len(key_type)
+                 and all(_is_key(part, part_type) for part, part_type in zip(after, key_type)))
+    else:
+        valid = _is_key(after, key_type)
+    if not valid:
+        raise InvalidCursor(f"invalid cursor {cursor!r}")
+    return after
+
+
+def _write(conn, write_fn, *args):
+    """_write - run a single-row db write, through the group commit writer when it is on
+    :param conn: sqllite3 db connection, used when config.WRITE_COALESCE is off;
+        otherwise the write goes to the group commit writer of its shard
+    :param write_fn: db write function taking a commit keyword (db.add_project, db.add_comment)
+    :param args: remaining arguments for write_fn
+    :return: write_fn's return value, once committed
+    """
+    writer = db.get_coalescer(conn.shard)
+    if writer is None:
+        return write_fn(conn, *args)
+    return writer.call(write_fn, *args, commit=False)
 
 
 def add_project(conn, owner_id, project_name):
@@ -11,12 +89,65 @@ def add_project(conn, owner_id, project_name):
     :param conn: sqllite3 db connection
     :param owner_id: (string) owner's uuid
     :param project_name: (string) name of new project
-    :return: a dict with the project / owner info
+    :return: a dict with the project / owner info, None if the owner does not exist
     """
 
     # Passed authorization, so add this project
     project_id = str(uuid.uuid1())
-    return db.add_project(conn, project_id, owner_id, project_name)
+    return _write(conn, db.add_project, project_id, owner_id, project_name)
+
+
+def _item_error(item, fields):
+    """_item_error - check that a batch item has every field as a non-empty string
+    :param item: one decoded JSON item of a batch request
+    :param fields: tuple of required field names
+    :return: error message, None if the item is valid
+    """
+    if not isinstance(item, dict):
+        return "item must be an object"
+    for field in fields:
+        if not isinstance(item.get(field), str) or not item[field]:
+            return f"{field} is required"
+    return None
+
+
+def _batch_response(results):
+    """_batch_response - wrap per-item results with created / failed totals"""
+    created = sum(1 for result in results if result["status"] == "created")
+    return {"created": created,
+            "failed": len(results) - created,
+            "results": results}
+
+
+def add_projects(conn, owner_id, items):
+    """add_projects - validate and add a batch of projects in one transaction
+    :param conn: sqllite3 db connection
+    :param owner_id: (string) owner's uuid
+    :param items: list of {"project_name": <name>}
+    :return:
+        {"created": <count>, "failed": <count>,
+         "results": [{"status": "created", "project": <see add_project>}
+                     or {"status": "error", "error": <message>}, ...in request order]}
+        None if the owner does not exist
+    """
+    results = []
+    new_projects = []
+    for item in items:
+        error = _item_error(item, ("project_name",))
+        if error:
+            results.append({"status": "error", "error": error})
+        else:
+            new_projects.append((str(uuid.uuid1()), item["project_name"]))
+            results.append(None)
+
+    projects = db.add_projects(conn, owner_id, new_projects)
+    if projects is None:
+        return None
+
+    projects = iter(projects)
+    results = [result or {"status": "created", "project": next(projects)}
+               for result in results]
+    return _batch_response(results)
 
 
 def get_num_projects(conn):
@@ -27,24 +158,326 @@ def get_num_projects(conn):
     return db.get_num_projects(conn)
 
 
+def get_num_owner_projects(conn, owner_id):
+    """get_num_owner_projects - get number of projects owned by this owner
+    :param conn: sqllite3 db connection
+    :param owner_id: (string) owner's uuid
+    :return: {"owner_id": <owner_id>, "project_count": <count>}
+    """
+    return db.get_num_owner_projects(conn, owner_id)
+
+
 def get_project(conn, owner_id, project_id):
     """get_project - get project for this project_id
     :param conn: sqllite3 db connection
-    :param project_id:
+    :param owner_id: (string) project owner uuid
+    :param project_id: (string) project id uuid
     :return:
+        the project with its owner and comments, None if not found
     """
     return db.get_project(conn, owner_id, project_id)
 
 
+def project_etag(version):
+    """project_etag - strong ETag for a version of a project response
+    :param version: tuple project version (see db.get_project_version)
+    :return: (string) quoted ETag value
+    """
+    return '"v%d.%d"' % version
+
+
+def etag_matches(if_none_match, etag):
+    """etag_matches - does an If-None-Match header value match this ETag
+    :param if_none_match: (string) header value: "*" or a comma separated list of ETags
+    :param etag: (string) current ETag (see project_etag)
+    :return: bool, True if the client's copy is current (weak comparison, RFC 9110 13.1.2)
+    """
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def get_project_etag(conn, owner_id, project_id):
+    """get_project_etag - current ETag of a project, without reading its comments
+    (from the project cache when possible)
+    :param conn: sqllite3 db connection
+    :param owner_id: (string) project owner uuid
+    :param project_id: (string) project id uuid
+    :return: (string) ETag, None if not found
+    """
+    entry = _project_cache.get(project_id)
+    if entry is not None and entry[0] == owner_id:
+        return entry[1]
+    version = db.get_project_version(conn, owner_id, project_id)
+    return None if version is None else project_etag(version)
+
+
+def get_project_with_etag(conn, owner_id, project_id):
+    """get_project_with_etag - get project for this project_id, and the ETag of that response
+    :param conn: sqllite3 db connection
+    :param owner_id: (string) project owner uuid
+    :param project_id: (string) project id uuid
+    :return: tuple (project (see get_project), ETag), None if not found
+    """
+    result = db.get_project_versioned(conn, owner_id, project_id)
+    if result is None:
+        return None
+    project, version = result
+    return project, project_etag(version)
+
+
+def get_project_response(conn, owner_id, project_id):
+    """get_project_response - the serialized project (see get_project) and its ETag,
+    from the project cache when possible
+    :param conn: sqllite3 db connection
+    :param owner_id: (string) project owner uuid
+    :param project_id: (string) project id uuid
+    :return: tuple (ETag, JSON body bytes), None if not found
+    """
+    entry = _project_cache.get(project_id)
+    if entry is not None and entry[0] == owner_id:
+        return entry[1], entry[2]
+
+    generation = _project_cache_generation
+    result = get_project_with_etag(conn, owner_id, project_id)
+    if result is None:
+        return None
+    project, etag = result
+    body = render.dumps(project)
+    with _project_cache_lock:
+        if generation == _project_cache_generation:
+            _project_cache.set(project_id, (owner_id, etag, body))
+    return etag, body
+
+
+def invalidate_project(project_id=None):
+    """invalidate_project - drop a project's cached response, after a change to it
+    :param project_id: (string) project uuid, None to drop every cached project
+    :return: None
+    """
+    global _project_cache_generation
+    with _project_cache_lock:
+        _project_cache_generation += 1
+        if project_id is None:
+            _project_cache.clear()
+        else:
+            _project_cache.delete(project_id)
+
+
+def invalidate_owner_projects(owner_id):
+    """invalidate_owner_projects - drop the cached responses of every project of an owner
+    :param owner_id: (string) owner uuid
+    :return: None
+    """
+    global _project_cache_generation
+    with _project_cache_lock:
+        _project_cache_generation += 1
+        _project_cache.delete_where(lambda project_id, entry: entry[0] == owner_id)
+
+
+def get_project_cache_stats():
+    """get_project_cache_stats - project response cache counters for diagnostics
+    :return: dict (see cache.LRUCache.stats)
+    """
+    return _project_cache.stats()
+
+
+def get_project_page(conn, owner_id, project_id, limit, cursor=None):
+    """get_project_page - get project for this project_id with one page of its comments
+    :param conn: sqllite3 db connection
+    :param owner_id: (string) project owner uuid
+    :param project_id: (string) project id uuid
+    :param limit: (int) max comments to return
+    :param cursor: (string) next_cursor from the previous page, None for the first page
+    :return:
+        the project (see get_project) plus "next_cursor", None if not found
+    """
+    result = db.get_project_page(conn, owner_id, project_id, limit,
+                                 decode_cursor(cursor, int))
+    if result is None:
+        return None
+
+    project, next_after = result
+    project["next_cursor"] = encode_cursor(next_after)
+    return project
+
+
+def list_owners(conn, limit, cursor=None):
+    """list_owners - get one page of owners
+    :param conn: sqllite3 db connection
+    :param limit: (int) max owners to return
+    :param cursor: (string) next_cursor from the previous page, None for the first page
+    :return:
+        {"owners": [{"owner_id": ..., "owner_username": ...}],
+         "next_cursor": <cursor or None on the last page>}
+    """
+    owners, next_after = db.get_owners_page(conn, limit, decode_cursor(cursor, str))
+    return {"owners": owners, "next_cursor": encode_cursor(next_after)}
+
+
+def list_projects(conn, owner_id, limit, cursor=None):
+    """list_projects - get one page of this owner's projects
+    :param conn: sqllite3 db connection
+    :param owner_id: (string) project owner uuid
+    :param limit: (int) max projects to return
+    :param cursor: (string) next_cursor from the previous page, None for the first page
+    :return:
+        {"projects": [{"project_id": ..., "project_name": ...}],
+         "next_cursor": <cursor or None on the last page>}
+    """
+    projects, next_after = db.get_projects_page(conn, owner_id, limit,
+                                                   decode_cursor(cursor, str))
+    return {"projects": projects, "next_cursor": encode_cursor(next_after)}
+
+
+def list_comments(conn, owner_id, project_id, limit, cursor=None):
+    """list_comments - get one page of the comments on this owner's project
+    :param conn: sqllite3 db connection
+    :param owner_id: (string) project owner uuid
+    :param project_id: (string) project id uuid
+    :param limit: (int) max comments to return
+    :param cursor: (string) next_cursor from the previous page, None for the first page
+    :return:
+        {"comments": [...], "next_cursor": <cursor or None on the last page>},
+        None if the project is not found
+    """
+    project = get_project_page(conn, owner_id, project_id, limit, cursor)
+    if project is None:
+        return None
+    return {"comments": project["comments"], "next_cursor": project["next_cursor"]}
+
+
+def list_owner_comments(conn, owner_id, limit, cursor=None):
+    """list_owner_comments - one page of the comments on this owner's projects, newest first
+    :param conn: sqllite3 db connection
+    :param owner_id: (string) project owner uuid
+    :param limit: (int) max comments to return
+    :param cursor: (string) next_cursor from the previous page, None for the first page
+    :return:
+        {"comments": [{"project_id": ..., "project_name": ..., "comment_id": ...,
+                       "commenter_id": ..., "commenter_username": ..., "message": ...,
+                       "created_at": <milliseconds since the epoch>}],
+         "next_cursor": <cursor or None on the last page>}
+    """
+    after = decode_cursor(cursor, (int, str))
+    comments, next_after = db.get_owner_comments_page(conn, owner_id, limit, after)
+    return {"comments": comments, "next_cursor": encode_cursor(next_after)}
+
+
+def search_query(text):
+    """search_query - turn the words of a search box into an FTS5 query: every word must
+    match, as a plain string (no FTS5 operators), a trailing * matching a prefix
+    :param text: (string) the ?q= text, e.g. 'deploy fail*'
+    :return: (string) FTS5 query, e.g. '"deploy" "fail"*'
+    :raises InvalidSearch: if text has no words
+    """
+    terms = []
+    for word in text.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+    if not terms:
+        raise InvalidSearch(f"no search terms in {text!r}")
+    return " ".join(terms)
+
+
+def search(conn, owner_id, text, limit, cursor=None):
+    """search - one page of the owner's projects and comments on them matching a search,
+    best match first
+    :param conn: sqllite3 db connection
+    :param owner_id: (string) owner uuid
+    :param text: (string) words to search for, see search_query()
+    :param limit: (int) max hits to return
+    :param cursor: (string) next_cursor from the previous page, None for the first page
+    :return:
+        {"hits": [{"type": "project" or "comment", "project_id": ..., "project_name": ...,
+                   "comment_id": ..., "commenter_id": ..., "commenter_username": ...,
+                   "message": ...}],
+         "next_cursor": <cursor or None on the last page>}
+    :raises InvalidSearch: if text has no words
+    """
+    after = decode_cursor(cursor, (float, int))
+    hits, next_after = db.search(conn, owner_id, search_query(text), limit, after)
+    return {"hits": hits, "next_cursor": encode_cursor(next_after)}
+
+
+def stream_project(conn, owner_id, project_id, batch_size):
+    """stream_project - get project for this project_id as streamed JSON
+    :param conn: sqllite3 db connection, must stay open until the stream is consumed
+    :param owner_id: (string) project owner uuid
+    :param project_id: (string) project id uuid
+    :param batch_size: (int) comments fetched per fragment
+    :return:
+        generator of JSON (bytes) fragments with the same document as get_project,
+        None if the project is not found
+    """
+    project = db.get_project_summary(conn, owner_id, project_id)
+    if project is None:
+        return None
+    return render.stream_json(project, "comments",
+                              db.iter_comments(conn, project_id, batch_size=batch_size))
+
+
+def stream_owners(conn, batch_size, cursor=None):
+    """stream_owners - every owner after the cursor as streamed JSON
+    :param conn: sqllite3 db connection, must stay open until the stream is consumed
+    :param batch_size: (int) owners fetched per fragment
+    :param cursor: (string) next_cursor of a previous page, None to start at the beginning
+    :return: generator of JSON (bytes) fragments, see list_owners (next_cursor is always null)
+    """
+    batches = db.iter_owners(conn, decode_cursor(cursor, str), batch_size)
+    return render.stream_json({}, "owners", batches, {"next_cursor": None})
+
+
+def stream_projects(conn, owner_id, batch_size, cursor=None):
+    """stream_projects - every project of this owner after the cursor as streamed JSON
+    :param conn: sqllite3 db connection, must stay open until the stream is consumed
+    :param owner_id: (string) project owner uuid
+    :param batch_size: (int) projects fetched per fragment
+    :param cursor: (string) next_cursor of a previous page, None to start at the beginning
+    :return: generator of JSON (bytes) fragments, see list_projects (next_cursor is always null)
+    """
+    batches = db.iter_projects(conn, owner_id, decode_cursor(cursor, str), batch_size)
+    return render.stream_json({}, "projects", batches, {"next_cursor": None})
+
+
+def stream_comments(conn, owner_id, project_id, batch_size, cursor=None):
+    """stream_comments - every comment on this owner's project after the cursor as streamed JSON
+    :param conn: sqllite3 db connection, must stay open until the stream is consumed
+    :param owner_id: (string) project owner uuid
+    :param project_id: (string) project id uuid
+    :param batch_size: (int) comments fetched per fragment
+    :param cursor: (string) next_cursor of a previous page, None to start at the beginning
+    :return:
+        generator of JSON (bytes) fragments, see list_comments (next_cursor is always null),
+        None if the project is not found
+    """
+    after = decode_cursor(cursor, int)
+    if db.get_project_summary(conn, owner_id, project_id) is None:
+        return None
+    batches = db.iter_comments(conn, project_id, after, batch_size)
+    return render.stream_json({}, "comments", batches, {"next_cursor": None})
+
+
 def delete_project(conn, owner_id, project_id):
     """delete_project - delete project for this project_id
     :param conn: sqllite3 db connection
     :param owner_id: (string) project owner uuid
     :param project_id: (string) project id uuid
     :return:
+        the deleted project with its owner and comments, None if not found
     """
     # Check to ensure the project owner is requesting delete
-    return db.delete_project(conn, owner_id, project_id)
+    response = db.delete_project(conn, owner_id, project_id)
+    invalidate_project(project_id)
+    return response
 
 
 def add_comment(conn, commenter_id, project_id, message):
@@ -54,9 +487,60 @@ def add_comment(conn, commenter_id, project_id, message):
     :param project_id: (string) project_id
     :param message: (string) message text
     :return:
-        returns value from db.add_comment()
+        returns value from db.add_comment(), None if the commenter does not exist
+    """
+    response = _write(conn, db.add_comment, commenter_id, project_id, message)
+    invalidate_project(project_id)
+    return response
+
+
+def add_comments(conn, project_id, items):
+    """add_comments - validate and add a batch of comments to this project in one transaction
+    :param conn: sqllite3 db connection
+    :param project_id: (string) project_id
+    :param items: list of {"commenter_id": <commenter uuid>, "message": <message text>}
+    :return:
+        {"created": <count>, "failed": <count>,
+         "results": [{"status": "created", "comment": <see add_comment>}
+                     or {"status": "error", "error": <message>}, ...in request order]}
+        None if the project does not exist
+    """
+    results = []
+    new_comments = []
+    for item in items:
+        error = _item_error(item, ("commenter_id", "message"))
+        if error:
+            results.append({"status": "error", "error": error})
+        else:
+            new_comments.append((item["commenter_id"], item["message"]))
+            results.append(None)
+
+    comments = db.add_comments(conn, project_id, new_comments)
+    if comments is None:
+        return None
+    invalidate_project(project_id)
+
+    comments = iter(comments)
+    for i, result in enumerate(results):
+        if result is None:
+            comment = next(comments)
+            if comment is None:
+                results[i] = {"status": "error", "error": "unknown commenter_id"}
+            else:
+                results[i] = {"status": "created", "comment": comment}
+    return _batch_response(results)
+
+
+def update_owner(conn, owner_id, owner_username):
+    """update_owner - rename an owner
+    :param conn: sqllite3 db connection
+    :param owner_id: (string) owner uuid
+    :param owner_username: (string) new username
+    :return: value from db.update_owner(), None if the owner does not exist
     """
-    return db.add_comment(conn, commenter_id, project_id, message)
+    response = db.update_owner(conn, owner_id, owner_username)
+    invalidate_owner_projects(owner_id)
+    return response
 
 
 def update_comment(conn, comment_id, message):
@@ -2,36 +2,21 @@
 This module contains example code for Flask usage.
 Feel free to modify this file in any way.
 """
-import json
-from flask import Flask, request, Response, abort
+import logging
+from flask import Flask, g, request, Response, abort
 
 import api
+import config
+import datagen
 import db
-import sqlite3
-from auth import introspect_token
+import introspection
+import metrics
+import render
+import shards
 
 app = Flask(__name__)
 
 
-def db_add(conn, sql_dict):
-    """db_add - add test data to the table in sql_dict
-    :param conn: (sqlite db connection) Active connection to the database
-    :param sql_dict: (dict) contains INSERT statement and test data tuples
-    :return: None
-    """
-    c = conn.cursor()
-    sql = sql_dict["insert"]
-    for data in sql_dict['data']:
-        try:
-            c.execute(sql, data)
-            conn.commit()
-        except (sqlite3.OperationalError,
-                sqlite3.ProgrammingError,
-                sqlite3.IntegrityError) as err:
-            print(f"{err}\n{sql}\n{str(data)}")
-            raise
-
-
 def auth_bearer_token(request):
     """auth_bearer_token - authenticate the user in the bearer token
     :param request: Flask request, containing bearer token in head
@@ -41,16 +26,152 @@ def auth_bearer_token(request):
     """
     # get bearer token from auth header
     auth_header = request.headers.get("authorization")
+    if not auth_header or not auth_header.startswith("Bearer "):
+        abort(401)
     access_token = auth_header[len("Bearer "):]
 
-    # get user_info to respond with
-    token_info = introspect_token(access_token)
+    # get user_info to respond with (cached, see introspection.py)
+    try:
+        with g.timing.introspection():
+            token_info = introspection.introspect_token(access_token)
+    except introspection.IntrospectionError:
+        abort(503)
     if not token_info["token_is_valid"]:
         abort(401)
 
     return token_info["user_info"]
 
 
+def page_args(request):
+    """page_args - read the keyset pagination query parameters
+    :param request: Flask request, with optional ?limit=<n>&cursor=<next_cursor>
+    :return:
+       tuple (limit, cursor), limit capped at config.PAGE_SIZE_MAX
+       If invalid, return 400 to caller
+    """
+    limit = request.args.get("limit", config.PAGE_SIZE_DEFAULT)
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    return min(limit, config.PAGE_SIZE_MAX), request.args.get("cursor")
+
+
+def wants_stream(request):
+    """wants_stream - did the client ask for a streamed response (?stream=1)
+    :param request: Flask request
+    :return: bool
+    """
+    return request.args.get("stream", "").lower() in ("1", "true", "yes")
+
+
+def stream_response(stream_fn, *args, shard=0):
+    """stream_response - send the JSON fragments of an api.stream_* function as they
+    are produced. The read-only connection stays checked out until the response is closed.
+    :param stream_fn: api.stream_* function, called as stream_fn(conn, *args)
+    :param args: remaining arguments for stream_fn
+    :param shard: (int) shard to read from
+    :return:
+       streamed Flask Response
+       If stream_fn returns None, return 404 to caller
+       If the cursor is invalid, return 400 to caller
+    """
+    conn = db.connect_db(readonly=True, shard=shard)
+    try:
+        chunks = stream_fn(conn, *args)
+        if chunks is None:
+            abort(404)
+    except api.InvalidCursor:
+        conn.release()
+        abort(400)
+    except BaseException:
+        conn.release()
+        raise
+
+    response = Response(chunks, status=200, mimetype='application/json')
+    response.call_on_close(conn.release)
+    return response
+
+
+def json_response(payload, status=200, headers=None):
+    """json_response - a JSON response, encoded by render.py
+    :param payload: JSON serializable response body
+    :param status: (int) HTTP status
+    :param headers: (dict) extra headers
+    :return: Flask Response
+    """
+    return Response(render.dumps(payload), status=status,
+                    mimetype='application/json', headers=headers)
+
+
+def batch_items(request):
+    """batch_items - read the JSON array body of a batch request
+    :param request: Flask request
+    :return:
+       list of items
+       If the body is not a JSON array, return 400 to caller
+       If it has more than config.BATCH_MAX_ITEMS items, return 413 to caller
+    """
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        abort(400)
+    if len(items) > config.BATCH_MAX_ITEMS:
+        abort(413)
+    return items
+
+
+@app.before_request
+def start_query_count():
+    """start_query_count - count the SQL statements run for this request"""
+    db.reset_query_count()
+
+
+@app.after_request
+def add_query_count(response):
+    """add_query_count - report the SQL statements run for this request
+    :param response: flask response
+    :return: the response, with an X-Query-Count header
+    """
+    response.headers["X-Query-Count"] = str(db.get_query_count())
+    return response
+
+
+@app.before_request
+def start_timing():
+    """start_timing - time this request (see metrics.py)"""
+    g.timing = metrics.RequestTiming()
+
+
+@app.after_request
+def record_timing(response):
+    """record_timing - add this request to the metrics once its response is closed,
+    so a streamed body is timed to the end. With config.SERVER_TIMING, report the
+    time spent so far in a Server-Timing header
+    :param response: flask response
+    :return: the response
+    """
+    timing = g.timing
+    method = request.method
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    status = response.status_code
+
+    if config.SERVER_TIMING:
+        timing.set_sql(*db.get_query_stats())
+        response.headers["Server-Timing"] = timing.server_timing()
+
+    def observe():
+        tracer = db.get_tracer()
+        if tracer is not None:
+            tracer.flush()
+        timing.set_sql(*db.get_query_stats())
+        metrics.observe_request(method, route, status, timing)
+
+    response.call_on_close(observe)
+    return response
+
+
 @app.errorhandler(401)
 def custom_401(error):
     """custom_401 - custom error handler for HTTP 401
@@ -62,24 +183,65 @@ def custom_401(error):
                     {'WWW-Authenticate': 'Basic realm="Login Required"'})
 
 
-@app.route("/app/populate_test_data", methods=["GET"])
+@app.route("/app/populate_test_data", methods=["POST"])
 def populate_test_data():
-    """populate_test_data - clears the old data, and adds a fresh test dataset
+    """populate_test_data - clears the old data, and adds a fresh test dataset.
+    Without parameters the fixtures in testdb_config.py are loaded; with
+    ?owners=<n>&projects_per_owner=<n>&comments=<n>[&skew=<zipf exponent>&seed=<n>]
+    a generated dataset of that size is bulk loaded (see datagen.py)
+    Requires a valid bearer token
     :return:
     """
-    import testdb_config as tdc
+    auth_bearer_token(request)
+
+    try:
+        sizes = datagen.parse_sizes(request.args)
+    except ValueError:
+        abort(400)
+
     with db.connect_db() as conn:
-        c = conn.cursor()
-        c.execute("DELETE FROM owners;")
-        c.execute("DELETE FROM projects;")
-        c.execute("DELETE FROM comments;")
-        conn.commit()
-        db_add(conn, tdc.TEST_ROWS['owners'])
-        db_add(conn, tdc.TEST_ROWS['projects'])
-        db_add(conn, tdc.TEST_ROWS['comments'])
+        counts = shards.load(conn, sizes)
+    api.invalidate_project()
+
+    return json_response({"message": "OK", "rows": counts})
+
 
-    return Response(json.dumps({"message": "OK"}), status=200,
-                    mimetype='application/json')
+@app.route("/app/diagnostics", methods=["GET"])
+def diagnostics():
+    """diagnostics - report the storage profile and connection pool state
+    Requires a valid bearer token
+    :return: JSON with the configured profile, the pragmas in effect, pool, cache
+        and group commit stats, and with SQL tracing on the slowest statements
+    """
+    auth_bearer_token(request)
+
+    with db.connect_db(readonly=True) as conn:
+        storage = db.get_storage_settings(conn)
+    writer = db.get_coalescer()
+    tracer = db.get_tracer()
+
+    response = {"storage_profile": config.DB_PROFILE,
+                "storage": storage,
+                "pool": db.get_pool().stats(),
+                "read_pool": db.get_read_pool().stats(),
+                "token_cache": introspection.get_introspector().cache.stats(),
+                "owner_cache": db.get_owner_cache_stats(),
+                "project_cache": api.get_project_cache_stats(),
+                "json_serializer": render.get_serializer(),
+                "write_coalescer": writer.stats() if writer else None,
+                "shard_count": db.get_shard_count(),
+                "sql_trace": tracer.slowest() if tracer else None}
+
+    return json_response(response)
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """get_metrics - request latency, introspection and sqlite time, statement and row
+    counts per route, in the Prometheus text format (see metrics.py)
+    :return: text/plain metrics
+    """
+    return Response(metrics.render(), status=200, content_type=metrics.CONTENT_TYPE)
 
 
 @app.route("/projects/count", methods=["GET"])
@@ -93,15 +255,101 @@ def get_projects_count():
     username = user_info["username"]
 
     if request.method == "GET":
-        with db.connect_db() as conn:
-            response = api.get_num_projects(conn)
+        response = shards.get_num_projects()
 
         response = {"message":
                         f"""Hello {username}, there are {response["project_count"]} projects in the database!"""
         }
 
-    return Response(json.dumps(response), status=200,
-                    mimetype='application/json')
+    return json_response(response)
+
+
+@app.route("/owners/me/projects/count", methods=["GET"])
+def get_owner_projects_count():
+    """get_owner_projects_count - get a count of the user's projects
+    :return: JSON containing owner_id and project_count
+    """
+
+    # Authenticate user
+    user_info = auth_bearer_token(request)
+
+    with shards.connect_owner(user_info["user_id"], readonly=True) as conn:
+        response = api.get_num_owner_projects(conn, user_info["user_id"])
+
+    return json_response(response)
+
+
+@app.route("/owners/me/comments", methods=["GET"])
+def list_owner_comments():
+    """list_owner_comments - one page of the comments on the user's projects, newest first
+    (?limit=<n>&cursor=<next_cursor>)
+    :return: JSON containing comments and next_cursor
+    """
+
+    # Authenticate user
+    user_info = auth_bearer_token(request)
+    user_id = user_info["user_id"]
+
+    limit, cursor = page_args(request)
+
+    with shards.connect_owner(user_id, readonly=True) as conn:
+        try:
+            response = api.list_owner_comments(conn, user_id, limit, cursor)
+        except api.InvalidCursor:
+            abort(400)
+
+    return json_response(response)
+
+
+@app.route("/owners", methods=["GET"])
+def list_owners():
+    """list_owners - one page of owners (?limit=<n>&cursor=<next_cursor>),
+    or with ?stream=1 every owner after the cursor
+    :return: JSON containing owners and next_cursor
+    """
+
+    # Authenticate user
+    _ = auth_bearer_token(request)
+
+    if wants_stream(request):
+        return stream_response(api.stream_owners, config.STREAM_BATCH_SIZE,
+                               request.args.get("cursor"))
+
+    limit, cursor = page_args(request)
+
+    with db.connect_db(readonly=True) as conn:
+        try:
+            response = api.list_owners(conn, limit, cursor)
+        except api.InvalidCursor:
+            abort(400)
+
+    return json_response(response)
+
+
+@app.route("/projects", methods=["GET"])
+def list_projects():
+    """list_projects - one page of the user's projects (?limit=<n>&cursor=<next_cursor>),
+    or with ?stream=1 every project after the cursor
+    :return: JSON containing projects and next_cursor
+    """
+
+    # Authenticate user
+    user_info = auth_bearer_token(request)
+    user_id = user_info["user_id"]
+
+    if wants_stream(request):
+        return stream_response(api.stream_projects, user_id, config.STREAM_BATCH_SIZE,
+                               request.args.get("cursor"), shard=shards.shard_for_owner(user_id))
+
+    limit, cursor = page_args(request)
+
+    with shards.connect_owner(user_id, readonly=True) as conn:
+        try:
+            response = api.list_projects(conn, user_id, limit, cursor)
+        except api.InvalidCursor:
+            abort(400)
+
+    return json_response(response)
 
 
 @app.route("/projects", methods=["POST"])
@@ -116,17 +364,45 @@ def add_project():
 
     request_json = request.get_json()
 
-    with db.connect_db() as conn:
+    with shards.connect_owner(user_id) as conn:
         if request.method == "POST":
             response = api.add_project(conn, user_id, request_json["project_name"])
 
-    return Response(json.dumps(response),
-                    status=200, mimetype='application/json')
+    if response is None:
+        abort(404)
+
+    return json_response(response)
+
+
+@app.route("/projects/batch", methods=["POST"])
+def add_projects():
+    """add_projects - Add a JSON array of projects ({"project_name": ...}) in one transaction
+    :return: JSON with created / failed totals and a result per item
+    """
+
+    # Authenticate user
+    user_info = auth_bearer_token(request)
+    user_id = user_info["user_id"]
+
+    items = batch_items(request)
+
+    with shards.connect_owner(user_id) as conn:
+        response = api.add_projects(conn, user_id, items)
+
+    if response is None:
+        abort(404)
+
+    return json_response(response)
 
 
 @app.route("/projects/<project_id>", methods=["GET", "DELETE"])
 def projects(project_id):
     """get_project - handle GET and DELETE project requests
+    A GET with ?limit=<n>&cursor=<next_cursor> returns one page of the comments
+    and a next_cursor, without them it returns every comment.
+    A GET with ?stream=1 streams the project and every comment.
+    A plain GET carries an ETag; with a matching If-None-Match it returns
+    304 Not Modified after looking up only the project version.
     :param project_id: (string) the uuid of the project to GET or DELETE
     :return:
     """
@@ -135,15 +411,96 @@ def projects(project_id):
     user_info = auth_bearer_token(request)
     user_id = user_info["user_id"]
 
-    with db.connect_db() as conn:
-        if request.method == "GET":
-            response = api.get_project(conn, user_id, project_id)
+    if request.method == "GET" and wants_stream(request):
+        return stream_response(api.stream_project, user_id, project_id,
+                               config.STREAM_BATCH_SIZE, shard=shards.shard_for_owner(user_id))
+
+    with shards.connect_owner(user_id, readonly=request.method == "GET") as conn:
+        if request.method == "GET" and ("limit" in request.args or "cursor" in request.args):
+            limit, cursor = page_args(request)
+            try:
+                response = api.get_project_page(conn, user_id, project_id, limit, cursor)
+            except api.InvalidCursor:
+                abort(400)
+
+        elif request.method == "GET":
+            if_none_match = request.headers.get("If-None-Match")
+            if if_none_match:
+                etag = api.get_project_etag(conn, user_id, project_id)
+                if etag is not None and api.etag_matches(if_none_match, etag):
+                    return Response(status=304, headers={"ETag": etag})
+
+            # served from the project response cache when possible (see api.py)
+            result = api.get_project_response(conn, user_id, project_id)
+            if result is None:
+                abort(404)
+            etag, body = result
+            return Response(body, status=200, mimetype='application/json',
+                            headers={"ETag": etag})
 
         elif request.method == "DELETE":
             response = api.delete_project(conn, user_id, project_id)
+            shards.forget_project(project_id)
+
+    if response is None:
+        abort(404)
 
-    return Response(json.dumps(response),
-                    status=200, mimetype='application/json')
+    return json_response(response)
+
+
+@app.route("/projects/<project_id>/comments", methods=["GET"])
+def list_comments(project_id):
+    """list_comments - one page of the comments on the user's project
+    (?limit=<n>&cursor=<next_cursor>), or with ?stream=1 every comment after the cursor
+    :param project_id: (string) uuid of the project
+    :return: JSON containing comments and next_cursor
+    """
+
+    # Authenticate user
+    user_info = auth_bearer_token(request)
+    user_id = user_info["user_id"]
+
+    if wants_stream(request):
+        return stream_response(api.stream_comments, user_id, project_id,
+                               config.STREAM_BATCH_SIZE, request.args.get("cursor"),
+                               shard=shards.shard_for_owner(user_id))
+
+    limit, cursor = page_args(request)
+
+    with shards.connect_owner(user_id, readonly=True) as conn:
+        try:
+            response = api.list_comments(conn, user_id, project_id, limit, cursor)
+        except api.InvalidCursor:
+            abort(400)
+
+    if response is None:
+        abort(404)
+
+    return json_response(response)
+
+
+@app.route("/search", methods=["GET"])
+def search():
+    """search - one page of the user's projects and comments on them matching
+    ?q=<words>, best match first (?limit=<n>&cursor=<next_cursor>)
+    :return: JSON containing hits and next_cursor
+    """
+
+    # Authenticate user
+    user_info = auth_bearer_token(request)
+    user_id = user_info["user_id"]
+
+    limit, cursor = page_args(request)
+
+    with shards.connect_owner(user_id) as conn:
+        db.flush_search(conn)
+    with shards.connect_owner(user_id, readonly=True) as conn:
+        try:
+            response = api.search(conn, user_id, request.args.get("q", ""), limit, cursor)
+        except (api.InvalidSearch, api.InvalidCursor):
+            abort(400)
+
+    return json_response(response)
 
 
 @app.route("/projects/<project_id>/comments", methods=["POST"])
@@ -159,16 +516,49 @@ def add_comment(project_id):
     response = {}
 
     request_json = request.get_json()
-    with db.connect_db() as conn:
+    # the project's shard, which is not the commenter's
+    shard = shards.shard_for_project(project_id)
+    if shard is None:
+        abort(404)
+    with db.connect_db(shard=shard) as conn:
         if request.method == "POST":
             response = api.add_comment(conn,
                                        request_json['commenter_id'],
                                        project_id,
                                        request_json['message'])
 
-    return Response(json.dumps(response),
-                    status=200, mimetype='application/json')
+    if response is None:
+        abort(404)
+
+    return json_response(response)
+
+
+@app.route("/projects/<project_id>/comments/batch", methods=["POST"])
+def add_comments(project_id):
+    """add_comments - Add a JSON array of comments ({"commenter_id": ..., "message": ...})
+    to a project in one transaction
+    :param project_id: (string) uuid of the project to add the comments
+    :return: JSON with created / failed totals and a result per item
+    """
+
+    # Authenticate user
+    _ = auth_bearer_token(request)
+
+    items = batch_items(request)
+
+    shard = shards.shard_for_project(project_id)
+    if shard is None:
+        abort(404)
+    with db.connect_db(shard=shard) as conn:
+        response = api.add_comments(conn, project_id, items)
+
+    if response is None:
+        abort(404)
+
+    return json_response(response)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    shards.initialize_db()
     app.run()
@@ -0,0 +1,607 @@
+"""
+asgi_app.py: asyncio (ASGI) serving mode, with the same routes as app.py.
+
+Token introspection runs as non-blocking I/O on the event loop, so many slow
+introspection calls overlap. Every db / api call runs on a bounded pool of worker
+threads (DBExecutor); each worker owns one read-write and one read-only pooled sqlite
+connection per shard for its whole life, which keeps sqlite's one-thread-per-connection rule.
+
+    pip install uvicorn
+    python asgi_app.py          # or: uvicorn asgi_app:app
+"""
+import asyncio
+import json
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+import api
+import config
+import datagen
+import db
+import introspection
+import metrics
+import render
+import shards
+
+log = logging.getLogger(__name__)
+
+_END = object()
+
+
+class HTTPError(Exception):
+    """Raised by a handler to answer with an error status (like flask.abort)"""
+
+    def __init__(self, status, body=b"", headers=()):
+        super().__init__(status)
+        self.status = status
+        self.body = body
+        self.headers = list(headers)
+
+
+class DBExecutor:
+    """DBExecutor - bounded pool of sqlite worker threads, each owning one read-write
+    and one read-only connection per shard
+
+    :param workers: (int) worker threads (and connections of each kind)
+    :param max_pending: (int) max calls queued or running, further callers wait
+    :param max_streams: (int) max streams open at once, further streams wait. A stream
+        holds its worker until the client has read it, so this is kept below workers
+    """
+
+    def __init__(self, workers, max_pending, max_streams=1):
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="sqlite",
+                                            initializer=self._open)
+        self._slots = asyncio.Semaphore(max_pending)
+        self._slots_max = max_pending
+        self._streams_max = max(1, min(max_streams, workers - 1))
+        self._streams = asyncio.Semaphore(self._streams_max)
+
+    def _open(self):
+        """_open - worker thread initializer, checks out the thread's connections"""
+        shard_count = db.get_shard_count()
+        self._local.conns = [db.connect_db(shard=shard) for shard in range(shard_count)]
+        self._local.read_conns = [db.connect_db(readonly=True, shard=shard)
+                                  for shard in range(shard_count)]
+        with self._lock:
+            self._connections += self._local.conns + self._local.read_conns
+
+    def _call(self, fn, args, readonly=False, shard=0):
+        """_call - run fn(conn, *args) on one of the worker thread's connections
+        :return: tuple (result, sqlite work done, see db.get_query_stats)
+        """
+        conn = (self._local.read_conns if readonly else self._local.conns)[shard]
+        db.reset_query_count()
+        try:
+            result = fn(conn, *args)
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            tracer = db.get_tracer()
+            if tracer is not None:
+                tracer.flush()
+        return result, db.get_query_stats()
+
+    async def run(self, request, fn, *args, readonly=False, shard=0):
+        """run - await fn(conn, *args) on a worker thread
+        :param request: Request, the sqlite work done is added to its timing
+        :param fn: db / api function taking the connection first
+        :param readonly: (bool) use the thread's read-only connection
+        :param shard: (int) use the thread's connection to this shard
+        :return: fn's return value
+        """
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            result, query_stats = await loop.run_in_executor(self._executor, self._call,
+                                                             fn, args, readonly, shard)
+        request.timing.add_sql(*query_stats)
+        return result
+
+    async def stream(self, request, stream_fn, *args, shard=0):
+        """stream - run an api.stream_* function on one worker thread (the connection
+        must not change threads mid stream) and hand its fragments to the event loop.
+        The worker is busy until the client has read the stream, so streams wait for
+        one of max_streams places first and leave the other workers to the other calls
+        :param shard: (int) shard to read from
+        :return: async iterator of bytes fragments
+        :raises HTTPError: 404 if stream_fn returns None, 400 on an invalid cursor
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=8)
+        cancelled = threading.Event()
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def produce(conn):
+            try:
+                chunks = stream_fn(conn, *args)
+                put(chunks is not None)
+                for chunk in chunks or ():
+                    if cancelled.is_set():
+                        break
+                    put(chunk)
+                put(_END)
+            except Exception as err:
+                put(err)
+
+        await self._streams.acquire()
+        try:
+            await self._slots.acquire()
+        except BaseException:
+            self._streams.release()
+            raise
+        future = loop.run_in_executor(self._executor, self._call, produce, (), True,
+                                      shard)
+
+        async def finish():
+            cancelled.set()
+            while not future.done():
+                # unblock the producer so the worker thread is freed
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.sleep(0.001)
+            self._slots.release()
+            self._streams.release()
+            request.timing.add_sql(*future.result()[1])
+
+        async def fragments():
+            try:
+                while True:
+                    item = await queue.get()
+                    if item is _END:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+            finally:
+                await finish()
+
+        try:
+            first = await queue.get()
+        except BaseException:
+            await finish()
+            raise
+        if first is not True:
+            await finish()
+            if isinstance(first, api.InvalidCursor):
+                raise HTTPError(400)
+            if isinstance(first, Exception):
+                raise first
+            raise HTTPError(404)
+        return fragments()
+
+    def close(self):
+        """close - stop the workers and return their connections to the pool"""
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.release()
+
+
+class Request:
+    """Request - the parts of an ASGI http scope the handlers need"""
+
+    def __init__(self, scope, body, executor):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+        self.headers = {name.decode("latin-1").lower(): value.decode("latin-1")
+                        for name, value in scope.get("headers", [])}
+        self.body = body
+        self.route = "unmatched"
+        self.executor = executor
+        self.timing = metrics.RequestTiming()
+
+    def get_json(self):
+        """get_json - decoded JSON body, None if it is not valid JSON"""
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+    async def db(self, fn, *args, shard=0):
+        """db - await fn(conn, *args) on the sqlite workers' connections to a shard"""
+        return await self.executor.run(self, fn, *args, shard=shard)
+
+    async def read(self, fn, *args, shard=0):
+        """read - await fn(conn, *args) on the sqlite workers' read-only connections to a shard"""
+        return await self.executor.run(self, fn, *args, readonly=True, shard=shard)
+
+
+def json_response(payload, status=200):
+    """json_response - (status, headers, body) for a JSON payload, encoded by render.py"""
+    return status, [(b"content-type", b"application/json")], render.dumps(payload)
+
+
+async def stream_response(request, stream_fn, *args, shard=0):
+    """stream_response - (status, headers, async iterator) for an api.stream_* function"""
+    fragments = await request.executor.stream(request, stream_fn, *args, shard=shard)
+    return 200, [(b"content-type", b"application/json")], fragments
+
+
+async def auth_bearer_token(request):
+    """auth_bearer_token - authenticate the user in the bearer token, without blocking
+    :param request: Request, containing bearer token in head
+    :return:
+       If valid, token_info structure for this user
+       If invalid, raise HTTPError 401
+    """
+    auth_header = request.headers.get("authorization")
+    if not auth_header or not auth_header.startswith("Bearer "):
+        raise HTTPError(401, b"Invalid user", [(b"www-authenticate", b'Basic realm="Login Required"')])
+
+    try:
+        with request.timing.introspection():
+            token_info = await introspection.introspect_token_async(auth_header[len("Bearer "):])
+    except introspection.IntrospectionError:
+        raise HTTPError(503)
+    if not token_info["token_is_valid"]:
+        raise HTTPError(401, b"Invalid user", [(b"www-authenticate", b'Basic realm="Login Required"')])
+    return token_info["user_info"]
+
+
+def page_args(request):
+    """page_args - read ?limit=<n>&cursor=<next_cursor>, see app.page_args"""
+    try:
+        limit = int(request.args.get("limit", config.PAGE_SIZE_DEFAULT))
+    except ValueError:
+        raise HTTPError(400)
+    if limit < 1:
+        raise HTTPError(400)
+    return min(limit, config.PAGE_SIZE_MAX), request.args.get("cursor")
+
+
+def wants_stream(request):
+    """wants_stream - did the client ask for a streamed response (?stream=1)"""
+    return request.args.get("stream", "").lower() in ("1", "true", "yes")
+
+
+def batch_items(request):
+    """batch_items - read the JSON array body of a batch request, see app.batch_items"""
+    items = request.get_json()
+    if not isinstance(items, list):
+        raise HTTPError(400)
+    if len(items) > config.BATCH_MAX_ITEMS:
+        raise HTTPError(413)
+    return items
+
+
+def found(response):
+    """found - 404 when an api function returned None"""
+    if response is None:
+        raise HTTPError(404)
+    return response
+
+
+async def paged(request, fn, *args, shard=0):
+    """paged - call an api.list_* function with the page arguments"""
+    limit, cursor = page_args(request)
+    try:
+        return await request.read(fn, *args, limit, cursor, shard=shard)
+    except api.InvalidCursor:
+        raise HTTPError(400)
+
+
+async def project_shard(request, project_id):
+    """project_shard - the shard holding a project, see shards.shard_for_project
+    :raises HTTPError: 404 if no shard holds the project
+    """
+    shard = shards.cached_shard_for_project(project_id)
+    if shard is not None:
+        return shard
+    for shard in range(db.get_shard_count()):
+        if await request.read(shards.has_project, project_id, shard=shard):
+            shards.remember_project(project_id, shard)
+            return shard
+    raise HTTPError(404)
+
+
+# Handlers, one per route of app.py
+
+async def populate_test_data(request):
+    await auth_bearer_token(request)
+    try:
+        sizes = datagen.parse_sizes(request.args)
+    except ValueError:
+        raise HTTPError(400)
+    counts = await request.db(shards.load, sizes)
+    api.invalidate_project()
+    return json_response({"message": "OK", "rows": counts})
+
+
+async def diagnostics(request):
+    await auth_bearer_token(request)
+    storage = await request.read(db.get_storage_settings)
+    writer = db.get_coalescer()
+    tracer = db.get_tracer()
+    return json_response({"storage_profile": config.DB_PROFILE,
+                          "storage": storage,
+                          "pool": db.get_pool().stats(),
+                          "read_pool": db.get_read_pool().stats(),
+                          "token_cache": introspection.get_introspector().cache.stats(),
+                          "owner_cache": db.get_owner_cache_stats(),
+                          "project_cache": api.get_project_cache_stats(),
+                          "json_serializer": render.get_serializer(),
+                          "write_coalescer": writer.stats() if writer else None,
+                          "shard_count": db.get_shard_count(),
+                          "sql_trace": tracer.slowest() if tracer else None})
+
+
+async def get_metrics(request):
+    return 200, [(b"content-type", metrics.CONTENT_TYPE.encode())], metrics.render().encode()
+
+
+async def get_projects_count(request):
+    user_info = await auth_bearer_token(request)
+    project_count = 0
+    for shard in range(db.get_shard_count()):
+        project_count += (await request.read(api.get_num_projects, shard=shard))["project_count"]
+    return json_response({"message": f"""Hello {user_info["username"]}, there are {project_count} projects in the database!"""})
+
+
+async def get_owner_projects_count(request):
+    user_info = await auth_bearer_token(request)
+    user_id = user_info["user_id"]
+    return json_response(await request.read(api.get_num_owner_projects, user_id,
+                                            shard=shards.shard_for_owner(user_id)))
+
+
+async def list_owner_comments(request):
+    user_info = await auth_bearer_token(request)
+    user_id = user_info["user_id"]
+    return json_response(await paged(request, api.list_owner_comments, user_id,
+                                     shard=shards.shard_for_owner(user_id)))
+
+
+async def list_owners(request):
+    await auth_bearer_token(request)
+    if wants_stream(request):
+        return await stream_response(request, api.stream_owners, config.STREAM_BATCH_SIZE,
+                                     request.args.get("cursor"))
+    return json_response(await paged(request, api.list_owners))
+
+
+async def list_projects(request):
+    user_info = await auth_bearer_token(request)
+    user_id = user_info["user_id"]
+    shard = shards.shard_for_owner(user_id)
+    if wants_stream(request):
+        return await stream_response(request, api.stream_projects, user_id,
+                                     config.STREAM_BATCH_SIZE, request.args.get("cursor"),
+                                     shard=shard)
+    return json_response(await paged(request, api.list_projects, user_id, shard=shard))
+
+
+async def add_project(request):
+    user_info = await auth_bearer_token(request)
+    request_json = request.get_json()
+    if not isinstance(request_json, dict) or "project_name" not in request_json:
+        raise HTTPError(400)
+    user_id = user_info["user_id"]
+    response = await request.db(api.add_project, user_id, request_json["project_name"],
+                                shard=shards.shard_for_owner(user_id))
+    return json_response(found(response))
+
+
+async def add_projects(request):
+    user_info = await auth_bearer_token(request)
+    user_id = user_info["user_id"]
+    items = batch_items(request)
+    return json_response(found(await request.db(api.add_projects, user_id, items,
+                                                shard=shards.shard_for_owner(user_id))))
+
+
+async def get_project(request, project_id):
+    user_info = await auth_bearer_token(request)
+    user_id = user_info["user_id"]
+    shard = shards.shard_for_owner(user_id)
+    if wants_stream(request):
+        return await stream_response(request, api.stream_project, user_id, project_id,
+                                     config.STREAM_BATCH_SIZE, shard=shard)
+    if "limit" in request.args or "cursor" in request.args:
+        return json_response(found(await paged(request, api.get_project_page, user_id, project_id,
+                                               shard=shard)))
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        etag = await request.read(api.get_project_etag, user_id, project_id, shard=shard)
+        if etag is not None and api.etag_matches(if_none_match, etag):
+            return 304, [(b"etag", etag.encode())], b""
+    etag, body = found(await request.read(api.get_project_response, user_id, project_id,
+                                          shard=shard))
+    return 200, [(b"content-type", b"application/json"), (b"etag", etag.encode())], body
+
+
+async def delete_project(request, project_id):
+    user_info = await auth_bearer_token(request)
+    user_id = user_info["user_id"]
+    response = await request.db(api.delete_project, user_id, project_id,
+                                shard=shards.shard_for_owner(user_id))
+    shards.forget_project(project_id)
+    return json_response(found(response))
+
+
+async def list_comments(request, project_id):
+    user_info = await auth_bearer_token(request)
+    user_id = user_info["user_id"]
+    shard = shards.shard_for_owner(user_id)
+    if wants_stream(request):
+        return await stream_response(request, api.stream_comments, user_id, project_id,
+                                     config.STREAM_BATCH_SIZE, request.args.get("cursor"),
+                                     shard=shard)
+    return json_response(found(await paged(request, api.list_comments, user_id, project_id,
+                                           shard=shard)))
+
+
+async def search(request):
+    user_info = await auth_bearer_token(request)
+    user_id = user_info["user_id"]
+    limit, cursor = page_args(request)
+    shard = shards.shard_for_owner(user_id)
+    await request.db(db.flush_search, shard=shard)
+    try:
+        response = await request.read(api.search, user_id, request.args.get("q", ""), limit,
+                                      cursor, shard=shard)
+    except (api.InvalidSearch, api.InvalidCursor):
+        raise HTTPError(400)
+    return json_response(response)
+
+
+async def add_comment(request, project_id):
+    await auth_bearer_token(request)
+    request_json = request.get_json()
+    if not isinstance(request_json, dict) or not {"commenter_id", "message"} <= request_json.keys():
+        raise HTTPError(400)
+    response = await request.db(api.add_comment, request_json["commenter_id"], project_id,
+                                request_json["message"],
+                                shard=await project_shard(request, project_id))
+    return json_response(found(response))
+
+
+async def add_comments(request, project_id):
+    await auth_bearer_token(request)
+    items = batch_items(request)
+    return json_response(found(await request.db(api.add_comments, project_id, items,
+                                                shard=await project_shard(request, project_id))))
+
+
+# (path pattern, {method: handler}); static paths before the <project_id> ones, as in Flask
+ROUTES = [
+    (r"/app/populate_test_data", {"POST": populate_test_data}),
+    (r"/app/diagnostics", {"GET": diagnostics}),
+    (r"/metrics", {"GET": get_metrics}),
+    (r"/projects/count", {"GET": get_projects_count}),
+    (r"/owners/me/projects/count", {"GET": get_owner_projects_count}),
+    (r"/owners/me/comments", {"GET": list_owner_comments}),
+    (r"/owners", {"GET": list_owners}),
+    (r"/projects", {"GET": list_projects, "POST": add_project}),
+    (r"/projects/batch", {"POST": add_projects}),
+    (r"/projects/(?P<project_id>[^/]+)", {"GET": get_project, "DELETE": delete_project}),
+    (r"/projects/(?P<project_id>[^/]+)/comments", {"GET": list_comments, "POST": add_comment}),
+    (r"/projects/(?P<project_id>[^/]+)/comments/batch", {"POST": add_comments}),
+    (r"/search", {"GET": search}),
+]
+# (regex, route label as in app.py, e.g. /projects/<project_id>, methods)
+ROUTES = [(re.compile(pattern + "$"), re.sub(r"\(\?P<(\w+)>[^)]*\)", r"<\1>", pattern), methods)
+          for pattern, methods in ROUTES]
+
+
+def match(request):
+    """match - find the handler for a request, and set request.route to its route label
+    :return: tuple (handler, path parameters)
+    :raises HTTPError: 404 for an unknown path, 405 for a known path and wrong method
+    """
+    allowed = False
+    for pattern, route, methods in ROUTES:
+        m = pattern.match(request.path)
+        if m:
+            request.route = route
+            if request.method in methods:
+                return methods[request.method], m.groupdict()
+            allowed = True
+    raise HTTPError(405 if allowed else 404)
+
+
+class ASGIApp:
+    """ASGIApp - the ASGI application; the sqlite workers start with the first request
+    (or at lifespan startup) and stop at lifespan shutdown"""
+
+    def __init__(self):
+        self.executor = None
+
+    def start(self):
+        """start - create the sqlite workers and the tables of every shard"""
+        if self.executor is None:
+            self.executor = DBExecutor(config.ASGI_DB_WORKERS, config.ASGI_DB_MAX_PENDING,
+                                       config.ASGI_MAX_STREAMS)
+            shards.initialize_db()
+
+    def stop(self):
+        """stop - stop the sqlite workers"""
+        if self.executor is not None:
+            self.executor.close()
+            self.executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.stop()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def http(self, scope, receive, send):
+        self.start()
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        request = Request(scope, body, self.executor)
+        timing = request.timing
+        # what an exception a handler did not turn into an HTTPError is recorded as,
+        # the server answers it (or cuts the stream short)
+        status = 500
+        try:
+            try:
+                handler, params = match(request)
+                status, headers, content = await handler(request, **params)
+            except HTTPError as err:
+                status, headers, content = err.status, err.headers, err.body
+
+            if config.SERVER_TIMING:
+                headers = headers + [(b"server-timing", timing.server_timing().encode())]
+            if isinstance(content, bytes):
+                headers = headers + [(b"content-length", str(len(content)).encode()),
+                                     (b"x-query-count", str(timing.statements).encode())]
+                await send({"type": "http.response.start", "status": status, "headers": headers})
+                await send({"type": "http.response.body", "body": content})
+                return
+
+            # streamed: statements are still running, so there is no X-Query-Count
+            await send({"type": "http.response.start", "status": status, "headers": headers})
+            try:
+                async for fragment in content:
+                    await send({"type": "http.response.body", "body": fragment, "more_body": True})
+            finally:
+                await content.aclose()
+            await send({"type": "http.response.body", "body": b""})
+        except Exception:
+            status = 500
+            raise
+        finally:
+            metrics.observe_request(request.method, request.route, status, timing)
+
+
+app = ASGIApp()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("The asyncio serving mode needs an ASGI server: pip install uvicorn")
+    uvicorn.run(app, host="127.0.0.1", port=5000)
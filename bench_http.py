@@ -0,0 +1,337 @@
+"""
+bench_http.py: HTTP load generator for every route in app.py.
+
+Starts the app on a local port against a generated dataset (see datagen.py), drives it
+with concurrent workers running a weighted mix of requests, and reports throughput and
+p50/p95/p99 latency per endpoint, also written as JSON for comparing runs.
+
+    python bench_http.py --workload mixed --workers 8 --duration 10 --output bench_http.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.serving import make_server
+
+import app
+import auth
+import datagen
+import db
+
+ACCESS_TOKENS = list(auth.TOKEN_MAPPING)
+
+# workload -> {operation: weight}
+WORKLOADS = {
+    "read-heavy": {"count": 10, "owner_count": 5, "get_project": 40, "revalidate_project": 15,
+                   "stream_project": 2, "list_projects": 10, "stream_projects": 1,
+                   "list_owners": 5, "list_comments": 15, "owner_comments": 5, "search": 5,
+                   "add_comment": 5, "add_project": 3, "delete_project": 2, "metrics": 1},
+    "write-heavy": {"count": 2, "owner_count": 2, "get_project": 10, "list_comments": 3,
+                    "add_comment": 45, "add_comments_batch": 5, "add_project": 20,
+                    "add_projects_batch": 3, "delete_project": 12, "metrics": 1},
+    "mixed": {"count": 5, "owner_count": 3, "get_project": 25, "revalidate_project": 8,
+              "stream_project": 1, "list_projects": 5, "stream_projects": 1,
+              "list_owners": 5, "list_comments": 10, "owner_comments": 3, "search": 3,
+              "add_comment": 25, "add_comments_batch": 2, "add_project": 10,
+              "add_projects_batch": 1, "delete_project": 7, "metrics": 1},
+    # reads concentrated on a few projects (Zipf), as with a popular project polled by clients
+    "hot-project": {"get_project": 40, "revalidate_project": 30, "list_comments": 15,
+                    "add_comment": 15},
+}
+
+
+class Client:
+    """Client - one worker's HTTP session and the projects it can see
+
+    :param base_url: (string) app URL
+    :param token: (string) bearer token of the user this worker acts as
+    :param user_id: (string) that user's uuid
+    :param project_ids: list of project uuids owned by the user, most commented first
+        (see rank_projects)
+    :param skew: (float) Zipf exponent used to pick a project to read
+    :param rng: random.Random
+    """
+
+    def __init__(self, base_url, token, user_id, project_ids, skew, rng):
+        self.base_url = base_url
+        self.user_id = user_id
+        self.project_ids = project_ids
+        self.rng = rng
+        self.created = []  # projects this worker added, candidates for DELETE
+        self.etags = {}  # project_id -> ETag of the last full read, for If-None-Match
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = "Bearer " + token
+        self.cum_weights = []
+        total = 0.0
+        for rank in range(1, len(project_ids) + 1):
+            total += 1.0 / rank ** skew
+            self.cum_weights.append(total)
+
+    def pick_project(self):
+        return self.rng.choices(self.project_ids, cum_weights=self.cum_weights)[0]
+
+    def request(self, label, method, path, **kwargs):
+        """request - time one call; a connection error or timeout counts as a failed call
+        :return: tuple (label, seconds, ok, response or None)
+        """
+        start = time.perf_counter()
+        try:
+            r = self.session.request(method, self.base_url + path, **kwargs)
+        except requests.RequestException:
+            return label, time.perf_counter() - start, False, None
+        return label, time.perf_counter() - start, r.status_code < 400, r
+
+    # one method per operation in WORKLOADS
+
+    def count(self):
+        return self.request("GET /projects/count", "GET", "/projects/count")
+
+    def owner_count(self):
+        return self.request("GET /owners/me/projects/count", "GET", "/owners/me/projects/count")
+
+    def get_project(self):
+        return self.request("GET /projects/<project_id>", "GET", "/projects/" + self.pick_project())
+
+    def revalidate_project(self):
+        # a client polling a project it has read: 304 while the project is unchanged
+        project_id = self.pick_project()
+        etag = self.etags.get(project_id)
+        headers = {"If-None-Match": etag} if etag else {}
+        result = self.request("GET /projects/<project_id> If-None-Match" if etag
+                              else "GET /projects/<project_id>",
+                              "GET", "/projects/" + project_id, headers=headers)
+        if result[2] and "ETag" in result[3].headers:
+            self.etags[project_id] = result[3].headers["ETag"]
+        return result
+
+    def stream_project(self):
+        return self.request("GET /projects/<project_id>?stream=1", "GET",
+                            "/projects/" + self.pick_project() + "?stream=1")
+
+    def stream_projects(self):
+        return self.request("GET /projects?stream=1", "GET", "/projects?stream=1")
+
+    def list_projects(self):
+        return self.request("GET /projects", "GET", "/projects?limit=50")
+
+    def list_owners(self):
+        return self.request("GET /owners", "GET", "/owners?limit=50")
+
+    def list_comments(self):
+        return self.request("GET /projects/<project_id>/comments", "GET",
+                            "/projects/" + self.pick_project() + "/comments?limit=50")
+
+    def owner_comments(self):
+        return self.request("GET /owners/me/comments", "GET", "/owners/me/comments?limit=50")
+
+    def search(self):
+        # words of the generated names and messages (see datagen.py), one a prefix
+        text = self.rng.choice(["project", "comment", "bench", "comm*"])
+        return self.request("GET /search", "GET", "/search?limit=20&q=" + text)
+
+    def metrics(self):
+        return self.request("GET /metrics", "GET", "/metrics")
+
+    def add_comment(self):
+        return self.request("POST /projects/<project_id>/comments", "POST",
+                            "/projects/" + self.pick_project() + "/comments",
+                            json={"commenter_id": self.user_id, "message": "bench comment"})
+
+    def add_comments_batch(self):
+        items = [{"commenter_id": self.user_id, "message": f"bench comment {i}"} for i in range(100)]
+        return self.request("POST /projects/<project_id>/comments/batch", "POST",
+                            "/projects/" + self.pick_project() + "/comments/batch", json=items)
+
+    def add_project(self):
+        result = self.request("POST /projects", "POST", "/projects",
+                              json={"project_name": "bench project"})
+        if result[2]:
+            self.created.append(result[3].json()["project_id"])
+        return result
+
+    def add_projects_batch(self):
+        items = [{"project_name": f"bench project {i}"} for i in range(100)]
+        return self.request("POST /projects/batch", "POST", "/projects/batch", json=items)
+
+    def delete_project(self):
+        if not self.created:
+            return self.add_project()
+        return self.request("DELETE /projects/<project_id>", "DELETE",
+                            "/projects/" + self.created.pop())
+
+
+def rank_projects(session, base_url):
+    """rank_projects - the caller's projects, most commented first: the datagen skew gives
+    a few projects most of the comments, and the workloads read and comment on those most
+    :param session: requests.Session with the user's bearer token
+    :param base_url: (string) app URL
+    :return: list of project uuids
+    """
+    projects = session.get(base_url + "/projects?stream=1").json()["projects"]
+    comments = {}
+    for project in projects:
+        project_id = project["project_id"]
+        comments[project_id] = len(session.get(base_url + "/projects/" + project_id).json()["comments"])
+    return sorted(comments, key=lambda project_id: (-comments[project_id], project_id))
+
+
+def percentile(ordered, fraction):
+    """percentile - nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return None
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(samples, elapsed):
+    """summarize - per endpoint throughput and latency percentiles
+    :param samples: dict {label: [(seconds, ok), ...]}
+    :param elapsed: (float) wall clock seconds of the run
+    :return: dict {label: {"requests", "errors", "rps", "p50_ms", "p95_ms", "p99_ms", "max_ms"}}
+    """
+    result = {}
+    for label, values in sorted(samples.items()):
+        latencies = sorted(seconds for seconds, _ in values)
+        result[label] = {"requests": len(values),
+                         "errors": sum(1 for _, ok in values if not ok),
+                         "rps": len(values) / elapsed,
+                         "p50_ms": percentile(latencies, 0.50) * 1000,
+                         "p95_ms": percentile(latencies, 0.95) * 1000,
+                         "p99_ms": percentile(latencies, 0.99) * 1000,
+                         "max_ms": latencies[-1] * 1000}
+    return result
+
+
+def run(base_url, workload, workers, duration, skew=1.1, seed=0):
+    """run - drive the app with `workers` concurrent clients for `duration` seconds
+    :param base_url: (string) app URL
+    :param workload: (string) key of WORKLOADS
+    :param workers: (int) concurrent clients
+    :param duration: (float) seconds to run
+    :param skew: (float) Zipf exponent for picking the project to read / comment on
+    :param seed: (int) random seed
+    :return: dict with the run settings, totals and per endpoint results (see summarize)
+    """
+    mix = WORKLOADS[workload]
+    operations, weights = list(mix), list(mix.values())
+
+    clients = []
+    ranked = {}  # token -> rank_projects()
+    for i in range(workers):
+        token = ACCESS_TOKENS[i % len(ACCESS_TOKENS)]
+        user_id = auth.TOKEN_MAPPING[token]["user_info"]["user_id"]
+        if token not in ranked:
+            session = requests.Session()
+            session.headers["Authorization"] = "Bearer " + token
+            ranked[token] = rank_projects(session, base_url)
+        if not ranked[token]:
+            sys.exit(f"user {user_id} has no projects, load a dataset first")
+        clients.append(Client(base_url, token, user_id, ranked[token],
+                              skew, random.Random(seed + i)))
+
+    samples = {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def work(client):
+        local = {}
+        while time.perf_counter() < deadline:
+            operation = client.rng.choices(operations, weights)[0]
+            label, seconds, ok, _ = getattr(client, operation)()
+            local.setdefault(label, []).append((seconds, ok))
+        with lock:
+            for label, values in local.items():
+                samples.setdefault(label, []).extend(values)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(work, clients))
+    elapsed = time.perf_counter() - start
+
+    endpoints = summarize(samples, elapsed)
+    total = sum(endpoint["requests"] for endpoint in endpoints.values())
+    return {"workload": workload,
+            "workers": workers,
+            "duration_s": elapsed,
+            "requests": total,
+            "errors": sum(endpoint["errors"] for endpoint in endpoints.values()),
+            "rps": total / elapsed,
+            "endpoints": endpoints}
+
+
+def serve(database):
+    """serve - run app.py on a free local port, on a background thread
+    :param database: (string) sqlite file the app should use
+    :return: tuple (server, base_url)
+    """
+    db.init_pool(database=database)
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def print_report(result):
+    """print_report - human readable table of a run() result"""
+    print(f"{result['workload']}: {result['requests']} requests, {result['errors']} errors, "
+          f"{result['rps']:.0f} req/s with {result['workers']} workers")
+    print(f"{'endpoint':45} {'reqs':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for label, endpoint in result["endpoints"].items():
+        print(f"{label:45} {endpoint['requests']:7d} {endpoint['rps']:8.1f} "
+              f"{endpoint['p50_ms']:8.2f} {endpoint['p95_ms']:8.2f} {endpoint['p99_ms']:8.2f}")
+
+
+def main(argv=None):
+    """main - command line entry point, see the module docstring"""
+    parser = argparse.ArgumentParser(description="HTTP benchmark of the sample app")
+    parser.add_argument("--workload", choices=sorted(WORKLOADS) + ["all"], default="all")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per workload")
+    parser.add_argument("--owners", type=int, default=1000)
+    parser.add_argument("--projects-per-owner", type=int, default=20)
+    parser.add_argument("--comments", type=int, default=100000)
+    parser.add_argument("--skew", type=float, default=1.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--database",
+                        help="use this already loaded sqlite file instead of generating one")
+    parser.add_argument("--output", default="bench_http.json", help="JSON results file")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = args.database
+        if database is None:
+            database = os.path.join(directory, "bench.db")
+            datagen.main(["--database", database, "--owners", str(args.owners),
+                          "--projects-per-owner", str(args.projects_per_owner),
+                          "--comments", str(args.comments), "--skew", str(args.skew),
+                          "--seed", str(args.seed)])
+
+        server, base_url = serve(database)
+        try:
+            workloads = sorted(WORKLOADS) if args.workload == "all" else [args.workload]
+            results = []
+            for workload in workloads:
+                result = run(base_url, workload, args.workers, args.duration, args.skew, args.seed)
+                print_report(result)
+                results.append(result)
+        finally:
+            server.shutdown()
+            db.close_pool()
+
+    with open(args.output, "w") as f:
+        json.dump({"dataset": {"owners": args.owners,
+                               "projects_per_owner": args.projects_per_owner,
+                               "comments": args.comments,
+                               "skew": args.skew,
+                               "database": args.database},
+                   "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
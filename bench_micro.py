@@ -0,0 +1,239 @@
+"""
+bench_micro.py: Microbenchmarks and regression gate for the db.py / api.py hot paths.
+
+Each function is timed against generated datasets of increasing size (see datagen.py).
+Every call is sized the same at every dataset size (a probe owner with one project and
+a fixed number of comments), so an indexed lookup stays flat while a full scan grows
+with the table. The growth (time at the largest size / time at the smallest) and the time
+per call at each size are compared with a stored baseline; the run fails if either went
+past the threshold. The baseline must have been recorded at the same sizes.
+
+    python bench_micro.py                    # compare with bench_micro_baseline.json
+    python bench_micro.py --update-baseline  # record a new baseline
+    python bench_micro.py --serialization    # JSON encoding share of a project read
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import api
+import datagen
+import db
+import render
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_micro_baseline.json")
+
+# dataset sizes, in comments (owners = comments / 100, 10 projects per owner)
+SIZES = (10000, 100000, 300000)
+
+PROBE_OWNER = "bench-probe-owner"
+PROBE_COMMENTS = 10
+
+
+def _add_probe_project(conn):
+    """_add_probe_project - a probe owner project with PROBE_COMMENTS comments
+    :return: (string) the project uuid
+    """
+    project = api.add_project(conn, PROBE_OWNER, "probe")
+    api.add_comments(conn, project["project_id"],
+                     [{"commenter_id": PROBE_OWNER, "message": f"probe {i}"}
+                      for i in range(PROBE_COMMENTS)])
+    return project["project_id"]
+
+
+def _time(fn, repeat, setup=None):
+    """_time - median seconds of fn(); setup() runs untimed before each call
+    and its result is passed to fn"""
+    samples = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        fn(arg)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def measure(conn, repeat):
+    """measure - median seconds per call of each benchmarked function
+    :param conn: (sqlite db connection) connection to a loaded dataset
+    :param repeat: (int) calls per function
+    :return: dict {function name: seconds}
+    """
+    db.add_owner(conn, PROBE_OWNER, "probe")
+    project_id = _add_probe_project(conn)
+
+    return {
+        "db.get_project": _time(
+            lambda _: db.get_project(conn, PROBE_OWNER, project_id), repeat),
+        "api.get_project": _time(
+            lambda _: api.get_project(conn, PROBE_OWNER, project_id), repeat),
+        "db.delete_project": _time(
+            lambda new_project_id: db.delete_project(conn, PROBE_OWNER, new_project_id),
+            repeat, setup=lambda: _add_probe_project(conn)),
+        "db.add_comment": _time(
+            lambda _: db.add_comment(conn, PROBE_OWNER, project_id, "bench"), repeat),
+        "db.get_owner_comments": _time(
+            lambda _: db.get_owner_comments(conn, PROBE_OWNER), repeat),
+        "db.get_num_projects": _time(
+            lambda _: db.get_num_projects(conn), repeat),
+        "db.get_num_owner_projects": _time(
+            lambda _: db.get_num_owner_projects(conn, PROBE_OWNER), repeat),
+    }
+
+
+def run(sizes, repeat, seed=0):
+    """run - load each dataset size in turn and measure every function
+    :param sizes: list of dataset sizes, in comments
+    :param repeat: (int) calls per function per size
+    :param seed: (int) datagen seed
+    :return:
+        dict {function name: {"seconds": {<size>: median seconds}, "growth": <largest / smallest>}}
+    """
+    curves = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            db.init_pool(database=os.path.join(directory, f"bench-{size}.db"))
+            with db.connect_db() as conn:
+                db.initialize_db(conn)
+                datagen.bulk_load(conn, owners=max(10, size // 100), projects_per_owner=10,
+                                  comments=size, seed=seed)
+                for name, seconds in measure(conn, repeat).items():
+                    curves.setdefault(name, {"seconds": {}})["seconds"][str(size)] = seconds
+            db.close_pool()
+
+    for curve in curves.values():
+        times = list(curve["seconds"].values())
+        curve["growth"] = times[-1] / times[0]
+    return curves
+
+
+# comments on the project whose read is split into fetch and encode
+SERIALIZATION_SIZES = (10, 100, 1000, 10000)
+
+
+def measure_serialization(comment_counts, repeat):
+    """measure_serialization - time fetching a project (db.get_project) and encoding it,
+    with the old stdlib path (json.dumps, then encode) and each render.py serializer
+    :param comment_counts: list of comments on the project
+    :param repeat: (int) calls per measurement
+    :return: dict {comment count: {"fetch": seconds, <encoder>: seconds, ...}}
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        db.init_pool(database=os.path.join(directory, "bench-serialization.db"))
+        with db.connect_db() as conn:
+            db.initialize_db(conn)
+            db.add_owner(conn, PROBE_OWNER, "probe")
+            for count in comment_counts:
+                project = api.add_project(conn, PROBE_OWNER, "probe")
+                project_id = project["project_id"]
+                api.add_comments(conn, project_id,
+                                 [{"commenter_id": PROBE_OWNER, "message": f"probe comment {i}"}
+                                  for i in range(count)])
+                document = db.get_project(conn, PROBE_OWNER, project_id)
+
+                timings = {"fetch": _time(
+                    lambda _: db.get_project(conn, PROBE_OWNER, project_id), repeat)}
+                timings["stdlib json.dumps (before)"] = _time(
+                    lambda _: json.dumps(document).encode(), repeat)
+                for name, encode in render.SERIALIZERS.items():
+                    timings[f"render {name}"] = _time(lambda _: encode(document), repeat)
+                results[count] = timings
+        db.close_pool()
+    return results
+
+
+def print_serialization_report(results):
+    """print_serialization_report - encode time and its share of fetch + encode"""
+    print(f"{'comments':>8}  {'encoder':28}{'fetch us':>10}{'encode us':>11}{'share':>8}")
+    for count, timings in results.items():
+        fetch = timings["fetch"]
+        for name, seconds in timings.items():
+            if name != "fetch":
+                print(f"{count:>8}  {name:28}{fetch * 1e6:10.1f}{seconds * 1e6:11.1f}"
+                      f"{seconds / (fetch + seconds):8.0%}")
+
+
+def compare(curves, baseline, threshold):
+    """compare - functions that regressed past the baseline, in their growth across sizes
+    or in their time per call at any size
+    :param curves: run() result
+    :param baseline: run() result stored earlier, at the same sizes
+    :param threshold: (float) allowed relative increase, 1.0 = twice the baseline
+    :return: list of (function name, what regressed, value, baseline value)
+    """
+    regressions = []
+    for name, curve in curves.items():
+        if name not in baseline:
+            continue
+        if curve["growth"] > baseline[name]["growth"] * (1 + threshold):
+            regressions.append((name, "growth", curve["growth"], baseline[name]["growth"]))
+        for size, seconds in curve["seconds"].items():
+            base = baseline[name]["seconds"][size]
+            if seconds > base * (1 + threshold):
+                regressions.append((name, f"us per call at {size}", seconds * 1e6, base * 1e6))
+    return regressions
+
+
+def print_report(curves, sizes, baseline):
+    """print_report - time per call at each size, and the growth against the baseline"""
+    header = "".join(f"{size:>12}" for size in sizes)
+    print(f"{'function (us per call) / comments':36}{header}{'growth':>9}{'baseline':>9}")
+    for name, curve in curves.items():
+        times = "".join(f"{seconds * 1e6:12.1f}" for seconds in curve["seconds"].values())
+        base = f"{baseline[name]['growth']:9.2f}" if name in baseline else f"{'-':>9}"
+        print(f"{name:36}{times}{curve['growth']:9.2f}{base}")
+
+
+def main(argv=None):
+    """main - command line entry point, see the module docstring"""
+    parser = argparse.ArgumentParser(description="db/api microbenchmarks and regression gate")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in SIZES),
+                        help="comma separated dataset sizes, in comments")
+    parser.add_argument("--repeat", type=int, default=50, help="calls per function per size")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--threshold", type=float, default=1.0,
+                        help="allowed increase over the baseline growth and times (1.0 = 2x)")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--serialization", action="store_true",
+                        help="report the JSON encoding share of a project read instead")
+    args = parser.parse_args(argv)
+
+    if args.serialization:
+        print_serialization_report(measure_serialization(SERIALIZATION_SIZES, args.repeat))
+        return 0
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.update_baseline:
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        if stored["sizes"] != sizes:
+            print(f"--sizes {args.sizes} differ from the baseline sizes "
+                  f"{','.join(str(size) for size in stored['sizes'])}, "
+                  f"run with those or --update-baseline", file=sys.stderr)
+            return 2
+        baseline = stored["functions"]
+
+    curves = run(sizes, args.repeat)
+    print_report(curves, sizes, baseline)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"sizes": sizes, "functions": curves}, f, indent=2)
+        print(f"baseline written to {args.baseline}")
+        return 0
+
+    regressions = compare(curves, baseline, args.threshold)
+    for name, what, value, base in regressions:
+        print(f"REGRESSION {name}: {what} {value:.2f}, baseline {base:.2f}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""
+cache.py: Bounded, thread safe in-process LRU cache with optional TTL
+"""
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    """LRUCache - least recently used cache with per-entry expiry
+
+    :param max_size: (int) maximum number of entries, the least recently
+        used entry is evicted when it is exceeded
+    :param ttl: (float) default seconds an entry stays valid, None for no expiry
+    """
+
+    def __init__(self, max_size=1024, ttl=None):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """get - look up a key, refreshing its LRU position
+        :param key: cache key
+        :param default: returned on a miss or an expired entry
+        :return: the cached value or default
+        """
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=_MISSING):
+        """set - store a value
+        :param key: cache key
+        :param value: value to cache
+        :param ttl: (float) seconds this entry stays valid, defaults to the cache ttl
+        :return: None
+        """
+        ttl = self.ttl if ttl is _MISSING else ttl
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """delete - drop a key if it is cached
+        :param key: cache key
+        :return: None
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_where(self, predicate):
+        """delete_where - drop every entry for which predicate(key, value) is true,
+        scanning the whole cache (for rare, broad invalidations)
+        :param predicate: callable (key, value) -> bool
+        :return: (int) number of entries dropped
+        """
+        with self._lock:
+            keys = [key for key, (value, _) in self._entries.items() if predicate(key, value)]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def clear(self):
+        """clear - drop every entry (the hit/miss counters are kept)
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """stats - size and hit/miss counters for diagnostics
+        :return: dict
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._entries),
+                    "max_size": self.max_size,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "hit_ratio": self.hits / lookups if lookups else 0.0}
@@ -0,0 +1,159 @@
+"""
+coalescer.py: Group commit for small concurrent writes
+
+Request threads hand their write to a single writer thread, which runs every
+write that arrives within a few milliseconds in one transaction, commits once
+and then gives each caller its result. N concurrent writers then cost one
+commit (one fsync, one trip through sqlite's write lock) instead of N.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+_STOP = object()
+
+
+class CoalescerClosed(Exception):
+    """Raised when a write is submitted to a closed WriteCoalescer"""
+
+
+class WriteCoalescer:
+    """WriteCoalescer - run submitted writes in shared transactions on one writer thread
+
+    Each write runs inside its own SAVEPOINT, so a write that raises is rolled
+    back alone and the rest of its batch still commits. Write functions must
+    not commit themselves.
+
+    :param conn: sqlite connection used only by the writer thread
+    :param max_delay: (float) seconds a batch stays open for more writes after its first
+    :param max_batch: (int) max writes per transaction
+    """
+
+    def __init__(self, conn, max_delay=0.002, max_batch=256):
+        if max_batch < 1:
+            raise ValueError("max_batch must be at least 1")
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.conn = conn
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stats = {"batches": 0, "writes": 0, "failed": 0, "commit_errors": 0,
+                       "max_batch_size": 0, "commit_seconds": 0.0, "max_commit_seconds": 0.0}
+        self._thread = threading.Thread(target=self._run, name="write-coalescer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """submit - queue a write for the next transaction
+        :param fn: write function, called as fn(conn, *args, **kwargs) on the writer thread
+        :return: concurrent.futures.Future, resolved with fn's return value after the commit
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise CoalescerClosed("write coalescer is closed")
+            self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def call(self, fn, *args, **kwargs):
+        """call - submit a write and wait until it is committed
+        :return: fn's return value; an exception raised by fn (or the commit) is re-raised
+        """
+        return self.submit(fn, *args, **kwargs).result()
+
+    def close(self):
+        """close - commit the writes already queued, then stop the writer thread
+        :return: None
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_STOP)
+        self._thread.join()
+
+    def stats(self):
+        """stats - batch size and commit time counters for diagnostics
+        :return: dict of lifetime counters, averages and the current queue depth
+        """
+        with self._lock:
+            result = dict(self._stats)
+        batches = result["batches"]
+        result["pending"] = self._queue.qsize()
+        result["avg_batch_size"] = result["writes"] / batches if batches else 0.0
+        result["avg_commit_seconds"] = result["commit_seconds"] / batches if batches else 0.0
+        return result
+
+    def _run(self):
+        """_run - writer thread: collect a batch, run it, repeat until closed"""
+        stopping = False
+        while not stopping:
+            batch, stopping = self._collect()
+            if batch:
+                self._commit(batch)
+
+    def _collect(self):
+        """_collect - wait for a write, then take more for up to max_delay / max_batch
+        :return: tuple (list of queued writes, whether close() was called)
+        """
+        job = self._queue.get()
+        if job is _STOP:
+            return [], True
+        batch = [job]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                job = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if job is _STOP:
+                return batch, True
+            batch.append(job)
+        return batch, False
+
+    def _commit(self, batch):
+        """_commit - run a batch of writes in one transaction and resolve their futures"""
+        conn = self.conn
+        outcomes = []
+        started = time.monotonic()
+        try:
+            conn.execute("BEGIN IMMEDIATE;")
+            for future, fn, args, kwargs in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT coalesced_write;")
+                try:
+                    result = fn(conn, *args, **kwargs)
+                except Exception as err:
+                    conn.execute("ROLLBACK TO coalesced_write;")
+                    conn.execute("RELEASE coalesced_write;")
+                    outcomes.append((future, None, err))
+                else:
+                    conn.execute("RELEASE coalesced_write;")
+                    outcomes.append((future, result, None))
+            conn.commit()
+        except Exception as err:
+            if conn.in_transaction:
+                conn.rollback()
+            with self._lock:
+                self._stats["commit_errors"] += 1
+            for future, _, _, _ in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+        elapsed = time.monotonic() - started
+
+        with self._lock:
+            stats = self._stats
+            stats["batches"] += 1
+            stats["writes"] += len(outcomes)
+            stats["failed"] += sum(1 for _, _, err in outcomes if err is not None)
+            stats["max_batch_size"] = max(stats["max_batch_size"], len(outcomes))
+            stats["commit_seconds"] += elapsed
+            stats["max_commit_seconds"] = max(stats["max_commit_seconds"], elapsed)
+        for future, result, err in outcomes:
+            if err is None:
+                future.set_result(result)
+            else:
+                future.set_exception(err)
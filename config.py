@@ -0,0 +1,132 @@
+"""
+config.py: Runtime settings for the sample app.
+Every value can be overridden with the matching SAMPLE_REST_* environment variable.
+"""
+import os
+
+
+def _env(name, default, cast=str):
+    """_env - read a SAMPLE_REST_<name> environment variable
+    :param name: (string) setting name, without the SAMPLE_REST_ prefix
+    :param default: value to use when the variable is not set
+    :param cast: callable used to convert the raw string value
+    :return: the converted setting value
+    """
+    value = os.environ.get(f"SAMPLE_REST_{name}")
+    if value is None:
+        return default
+    return cast(value)
+
+
+def _flag(value):
+    """_flag - cast for on/off settings ("1", "true", "yes", "on" are on)"""
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+# sqlite database file
+DATABASE = _env("DATABASE", "sample-rest.db")
+
+# Owner based sharding (see shards.py): each owner's projects and comments live in one of
+# SHARD_COUNT database files, DATABASE being shard 0. 1 keeps everything in DATABASE
+SHARD_COUNT = _env("SHARD_COUNT", 1, int)
+# project_id -> shard cache of the routes that only know the project (see shards.shard_for_project)
+PROJECT_SHARD_CACHE_SIZE = _env("PROJECT_SHARD_CACHE_SIZE", 100000, int)
+
+# Connection pool (see pool.py)
+POOL_MAX_SIZE = _env("POOL_MAX_SIZE", 8, int)
+POOL_IDLE_TIMEOUT = _env("POOL_IDLE_TIMEOUT", 300.0, float)
+POOL_ACQUIRE_TIMEOUT = _env("POOL_ACQUIRE_TIMEOUT", 30.0, float)
+POOL_HEALTH_CHECK_AFTER = _env("POOL_HEALTH_CHECK_AFTER", 30.0, float)
+
+# Read-only (query_only) connection pool used by the GET routes, sized apart from
+# the writers since WAL readers do not wait on the single sqlite writer
+READ_POOL_MAX_SIZE = _env("READ_POOL_MAX_SIZE", 16, int)
+READ_POOL_CACHED_STATEMENTS = _env("READ_POOL_CACHED_STATEMENTS", 256, int)
+
+# sqlite storage profile applied to every connection (see db.apply_storage_profile)
+DB_PROFILE = _env("DB_PROFILE", "balanced")
+DB_PROFILES = {
+    # fsync on every commit, small footprint
+    "durable": {"journal_mode": "WAL",
+                "synchronous": "FULL",
+                "mmap_size": 0,
+                "cache_size": -2000,
+                "temp_store": "DEFAULT",
+                "busy_timeout": 5000},
+    # WAL + NORMAL only risks the last commits on power loss, never corruption
+    "balanced": {"journal_mode": "WAL",
+                 "synchronous": "NORMAL",
+                 "mmap_size": 64 * 1024 * 1024,
+                 "cache_size": -16000,
+                 "temp_store": "MEMORY",
+                 "busy_timeout": 5000},
+    # no fsync at all, for benchmarks and bulk loads
+    "throughput": {"journal_mode": "WAL",
+                   "synchronous": "OFF",
+                   "mmap_size": 256 * 1024 * 1024,
+                   "cache_size": -64000,
+                   "temp_store": "MEMORY",
+                   "busy_timeout": 10000},
+}
+
+# Token introspection (see introspection.py).
+# An empty URL uses the mock in auth.py instead of an RFC 7662 server
+INTROSPECTION_URL = _env("INTROSPECTION_URL", "")
+INTROSPECTION_TIMEOUT = _env("INTROSPECTION_TIMEOUT", 5.0, float)
+TOKEN_CACHE_SIZE = _env("TOKEN_CACHE_SIZE", 10000, int)
+TOKEN_CACHE_TTL = _env("TOKEN_CACHE_TTL", 60.0, float)
+TOKEN_CACHE_NEGATIVE_TTL = _env("TOKEN_CACHE_NEGATIVE_TTL", 5.0, float)
+
+# owner_id -> owner_username cache used by the write paths (see db.get_owner_username)
+OWNER_CACHE_SIZE = _env("OWNER_CACHE_SIZE", 10000, int)
+OWNER_CACHE_TTL = _env("OWNER_CACHE_TTL", 300.0, float)
+
+# Serialized GET /projects/<project_id> responses (see api.get_project_response).
+# Writes through this process invalidate entries at once; the TTL bounds how long
+# a write made by another process can go unseen
+PROJECT_CACHE_SIZE = _env("PROJECT_CACHE_SIZE", 1000, int)
+PROJECT_CACHE_TTL = _env("PROJECT_CACHE_TTL", 30.0, float)
+
+# JSON encoder for response bodies (see render.py): "auto" uses orjson when installed
+JSON_SERIALIZER = _env("JSON_SERIALIZER", "auto")
+
+# Add a Server-Timing header (introspection, sql and total milliseconds) to every
+# response; the same numbers are always collected for GET /metrics (see metrics.py)
+SERVER_TIMING = _env("SERVER_TIMING", False, _flag)
+
+# SQL statement tracing (see sqltrace.py): log every statement with its duration
+# (logger "sqltrace", DEBUG), capture each distinct statement's query plan, and log
+# statements slower than SQL_SLOW_THRESHOLD seconds as warnings with their plan
+SQL_TRACE = _env("SQL_TRACE", False, _flag)
+SQL_SLOW_THRESHOLD = _env("SQL_SLOW_THRESHOLD", 0.1, float)
+
+# Keyset pagination of the list endpoints
+PAGE_SIZE_DEFAULT = _env("PAGE_SIZE_DEFAULT", 50, int)
+PAGE_SIZE_MAX = _env("PAGE_SIZE_MAX", 1000, int)
+
+# Rows fetched per batch by the streaming (?stream=1) responses
+STREAM_BATCH_SIZE = _env("STREAM_BATCH_SIZE", 500, int)
+
+# Max items accepted by one POST .../batch request
+BATCH_MAX_ITEMS = _env("BATCH_MAX_ITEMS", 10000, int)
+
+# Largest dataset POST /app/populate_test_data generates (see datagen.parse_sizes): a load
+# this size takes a few seconds, within one request. Larger ones: python datagen.py
+DATAGEN_MAX_OWNERS = _env("DATAGEN_MAX_OWNERS", 5000, int)
+DATAGEN_MAX_PROJECTS_PER_OWNER = _env("DATAGEN_MAX_PROJECTS_PER_OWNER", 20, int)
+DATAGEN_MAX_COMMENTS = _env("DATAGEN_MAX_COMMENTS", 100000, int)
+DATAGEN_MAX_SKEW = _env("DATAGEN_MAX_SKEW", 10.0, float)
+
+# asyncio (ASGI) serving mode (see asgi_app.py): sqlite worker threads, each owning a
+# connection from each pool (keep below POOL_MAX_SIZE), and the max db calls queued for them.
+# A ?stream=1 response holds a worker while the client reads it, so at most ASGI_MAX_STREAMS
+# (and always fewer than ASGI_DB_WORKERS) are open at once
+ASGI_DB_WORKERS = _env("ASGI_DB_WORKERS", 4, int)
+ASGI_DB_MAX_PENDING = _env("ASGI_DB_MAX_PENDING", 256, int)
+ASGI_MAX_STREAMS = _env("ASGI_MAX_STREAMS", 2, int)
+
+# Group commit of single-row writes (see coalescer.py). When on, add_project / add_comment
+# wait up to WRITE_COALESCE_MAX_DELAY seconds for other writers and commit together
+WRITE_COALESCE = _env("WRITE_COALESCE", False, _flag)
+WRITE_COALESCE_MAX_DELAY = _env("WRITE_COALESCE_MAX_DELAY", 0.002, float)
+WRITE_COALESCE_MAX_BATCH = _env("WRITE_COALESCE_MAX_BATCH", 256, int)
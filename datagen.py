@@ -0,0 +1,292 @@
+"""
+datagen.py: Synthetic dataset generator and bulk loader, for benchmarks at production scale.
+
+    python datagen.py --owners 10000 --projects-per-owner 10 --comments 1000000
+
+Comments are spread over projects with a Zipf-like skew (a few hot projects get most of them).
+The owners in auth.py always come first, so the hard coded test tokens see real data.
+"""
+import argparse
+import logging
+import random
+import time
+
+import auth
+import config
+import db
+
+log = logging.getLogger(__name__)
+
+# rows per INSERT batch / transaction
+BATCH_SIZE = 10000
+
+# comments.created_at of the generated comments: one a second from 2024-01-01 UTC, in
+# generation order, so the same arguments give the same timestamps
+COMMENTS_START_MS = 1704067200000
+COMMENT_INTERVAL_MS = 1000
+
+
+def _uuid(rng):
+    """_uuid - a random uuid-formatted string drawn from rng, so datasets are reproducible"""
+    # formatting by hand is ~3x faster than str(uuid.UUID(...)) over millions of rows
+    h = "%032x" % rng.getrandbits(128)
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+def generate_owners(count, rng):
+    """generate_owners - owner rows, starting with the users known to auth.py
+    :param count: (int) number of owners
+    :param rng: random.Random
+    :return: list of (owner_id, owner_username) tuples
+    """
+    owners = [(token_info["user_info"]["user_id"], token_info["user_info"]["username"])
+              for token_info in auth.TOKEN_MAPPING.values()][:count]
+    while len(owners) < count:
+        owners.append((_uuid(rng), f"user{len(owners)}"))
+    return owners
+
+
+def generate_projects(owner_ids, per_owner, rng):
+    """generate_projects - per_owner projects for every owner
+    :param owner_ids: list of owner uuids
+    :param per_owner: (int) projects per owner
+    :param rng: random.Random
+    :return: generator of (project_id, owner_id, project_name) tuples
+    """
+    for owner_id in owner_ids:
+        for i in range(per_owner):
+            yield _uuid(rng), owner_id, f"project {i}"
+
+
+def generate_comments(project_ids, commenters, count, skew, rng):
+    """generate_comments - comments spread over projects with a Zipf-like skew:
+    the project of rank r gets a share proportional to 1 / r**skew
+    :param project_ids: list of project uuids
+    :param commenters: list of (owner_id, owner_username) tuples, picked uniformly
+    :param count: (int) number of comments
+    :param skew: (float) Zipf exponent, 0 spreads comments evenly
+    :param rng: random.Random
+    :return: generator of (comment_id, commenter_id, commenter_username, project_id, message) tuples
+    """
+    if not project_ids or not commenters:
+        return
+
+    # Shuffle so the hot projects are not all owned by the first owners
+    ranked = list(project_ids)
+    rng.shuffle(ranked)
+    cum_weights = []
+    total = 0.0
+    for rank in range(1, len(ranked) + 1):
+        total += 1.0 / rank ** skew
+        cum_weights.append(total)
+
+    for start in range(0, count, BATCH_SIZE):
+        size = min(BATCH_SIZE, count - start)
+        projects = rng.choices(ranked, cum_weights=cum_weights, k=size)
+        for i, project_id in enumerate(projects):
+            commenter_id, commenter_username = rng.choice(commenters)
+            yield (_uuid(rng), commenter_id, commenter_username, project_id,
+                   f"comment {start + i}")
+
+
+def _insert_batches(conn, sql, rows, batch_size):
+    """_insert_batches - executemany rows in batch_size chunks, one transaction per chunk
+    :return: (int) number of rows inserted
+    """
+    c = conn.cursor()
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            c.executemany(sql, batch)
+            conn.commit()
+            count += len(batch)
+            batch = []
+    if batch:
+        c.executemany(sql, batch)
+        conn.commit()
+        count += len(batch)
+    return count
+
+
+def bulk_load(conn, owners, projects_per_owner, comments, skew=1.1, seed=0,
+              batch_size=BATCH_SIZE):
+    """bulk_load - replace the owners, projects and comments with a generated dataset.
+    Secondary indexes and triggers are dropped during the load and rebuilt afterwards, and the
+    load runs with the "throughput" storage profile.
+    :param conn: (sqlite db connection) Active connection to an initialized database
+    :param owners: (int) number of owners
+    :param projects_per_owner: (int) projects per owner
+    :param comments: (int) total number of comments
+    :param skew: (float) Zipf exponent of the comments per project distribution
+    :param seed: (int) random seed, the same arguments always give the same dataset
+    :param batch_size: (int) rows per INSERT batch / transaction
+    :return: dict {"owners": <count>, "projects": <count>, "comments": <count>}
+    """
+    rng = random.Random(seed)
+    c = conn.cursor()
+
+    # Maintaining indexes and counter triggers row by row is far slower than
+    # building them once at the end (and triggers turn DELETE into a row by row delete)
+    sql = """SELECT type, name, sql FROM sqlite_master
+               WHERE type IN ('index', 'trigger') AND sql IS NOT NULL
+                 AND tbl_name IN ('owners', 'projects', 'comments');"""
+    schema = c.execute(sql).fetchall()
+
+    db.apply_storage_profile(conn, "throughput")
+    try:
+        for kind, name, _ in schema:
+            c.execute(f'DROP {kind.upper()} "{name}";')
+        conn.commit()
+
+        c.execute("DELETE FROM comments;")
+        c.execute("DELETE FROM projects;")
+        c.execute("DELETE FROM owners;")
+        conn.commit()
+        db.invalidate_owner()
+
+        owner_rows = generate_owners(owners, rng)
+        counts = {"owners": _insert_batches(
+            conn, "INSERT INTO owners (owner_id, owner_username) VALUES (?,?);",
+            owner_rows, batch_size)}
+
+        project_ids = []
+        project_owners = {}
+
+        def project_rows():
+            for row in generate_projects([owner_id for owner_id, _ in owner_rows],
+                                         projects_per_owner, rng):
+                project_ids.append(row[0])
+                project_owners[row[0]] = row[1]
+                yield row
+
+        counts["projects"] = _insert_batches(
+            conn, "INSERT INTO projects (project_id, owner_id, project_name) VALUES (?,?,?);",
+            project_rows(), batch_size)
+
+        # the triggers that would fill in project_owner_id are dropped, so it is written here
+        def comment_rows():
+            rows = generate_comments(project_ids, owner_rows, comments, skew, rng)
+            for i, row in enumerate(rows):
+                yield row + (COMMENTS_START_MS + i * COMMENT_INTERVAL_MS, project_owners[row[3]])
+
+        counts["comments"] = _insert_batches(
+            conn,
+            """INSERT INTO comments (comment_id, commenter_id, commenter_username, project_id, message,
+                                     created_at, project_owner_id)
+                 VALUES (?,?,?,?,?,?,?);""",
+            comment_rows(), batch_size)
+    finally:
+        # also when the load failed part way: the migrations are recorded as applied,
+        # so nothing else would ever recreate the indexes and triggers
+        _restore_schema(conn, schema)
+        db.apply_storage_profile(conn)
+
+    return counts
+
+
+def _restore_schema(conn, schema):
+    """_restore_schema - recreate the indexes and triggers bulk_load() dropped, then
+    rebuild what the triggers maintain from the rows that are there
+    :param conn: (sqlite db connection) the connection bulk_load() ran on
+    :param schema: list of (type, name, sql) rows from sqlite_master
+    :return: None
+    """
+    if conn.in_transaction:
+        conn.rollback()
+    c = conn.cursor()
+    existing = {row[0] for row in c.execute("SELECT name FROM sqlite_master;")}
+    for _, name, sql in schema:
+        if name not in existing:
+            c.execute(sql)
+    conn.commit()
+    db.rebuild_counters(conn)
+    db.rebuild_search(conn)
+
+
+def load_fixtures(conn):
+    """load_fixtures - replace the owners, projects and comments with the small
+    fixture dataset in testdb_config.py, one transaction per table
+    :param conn: (sqlite db connection) Active connection to an initialized database
+    :return: dict {"owners": <count>, "projects": <count>, "comments": <count>}
+    """
+    import testdb_config as tdc
+    c = conn.cursor()
+    c.execute("DELETE FROM owners;")
+    c.execute("DELETE FROM projects;")
+    c.execute("DELETE FROM comments;")
+    conn.commit()
+    db.invalidate_owner()
+
+    counts = {}
+    for table in ("owners", "projects", "comments"):
+        sql_dict = tdc.TEST_ROWS[table]
+        counts[table] = _insert_batches(conn, sql_dict["insert"], sql_dict["data"], BATCH_SIZE)
+    return counts
+
+
+def load(conn, sizes):
+    """load - load the fixtures, or a generated dataset when sizes are given
+    (the POST /app/populate_test_data endpoint)
+    :param conn: (sqlite db connection) Active connection to an initialized database
+    :param sizes: dict with any of "owners", "projects_per_owner", "comments", "skew", "seed";
+        empty to load the fixtures
+    :return: dict {"owners": <count>, "projects": <count>, "comments": <count>}
+    """
+    if not sizes:
+        return load_fixtures(conn)
+    return bulk_load(conn,
+                     sizes.get("owners", 100),
+                     sizes.get("projects_per_owner", 10),
+                     sizes.get("comments", 10000),
+                     skew=sizes.get("skew", 1.1),
+                     seed=sizes.get("seed", 0))
+
+
+def parse_sizes(args):
+    """parse_sizes - read the dataset size parameters of POST /app/populate_test_data
+    :param args: mapping of query parameters
+    :return: sizes dict for load()
+    :raises ValueError: if a parameter is not a number, is negative or is above its
+        config.DATAGEN_MAX_* limit
+    """
+    sizes = {}
+    for name, cast, limit in (("owners", int, config.DATAGEN_MAX_OWNERS),
+                              ("projects_per_owner", int, config.DATAGEN_MAX_PROJECTS_PER_OWNER),
+                              ("comments", int, config.DATAGEN_MAX_COMMENTS),
+                              ("skew", float, config.DATAGEN_MAX_SKEW),
+                              ("seed", int, None)):
+        if name in args:
+            value = cast(args[name])
+            # "not 0 <= value" also rejects a nan skew
+            if not 0 <= value or (limit is not None and value > limit):
+                raise ValueError(f"{name}={args[name]!r} is out of range")
+            sizes[name] = value
+    return sizes
+
+
+def main(argv=None):
+    """main - command line entry point, see the module docstring"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].split(": ", 1)[1])
+    parser.add_argument("--owners", type=int, default=1000)
+    parser.add_argument("--projects-per-owner", type=int, default=10)
+    parser.add_argument("--comments", type=int, default=100000)
+    parser.add_argument("--skew", type=float, default=1.1,
+                        help="Zipf exponent of comments per project (0 = uniform)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--database", help="sqlite file (default: config.DATABASE)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    db.init_pool(database=args.database)
+    start = time.perf_counter()
+    with db.connect_db() as conn:
+        db.initialize_db(conn)
+        counts = bulk_load(conn, args.owners, args.projects_per_owner, args.comments,
+                           skew=args.skew, seed=args.seed)
+    log.info("loaded %s in %.1fs", counts, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,488 @@
 """
 db.py: Contains the sample database code
 """
+import functools
+import logging
+import os
 import sqlite3
+import threading
+import time
 import uuid
+import cache
+import coalescer
+import config
+import pool
+import records
+import sqltrace
 import static_sql
 
+log = logging.getLogger(__name__)
 
-def connect_db():
-    """connect_db - connect to the database
-    (sqlite connections cannot be shared across threads)
-    :return: sqlite database connection
+# [(read-write pool, read-only pool)] per shard and the shard files, see init_pool()
+_pools = None
+_databases = None
+_pool_lock = threading.RLock()
+
+# shard -> group commit writer, see get_coalescer()
+_coalescers = {}
+
+# owner_id -> owner_username, see get_owner_username()
+_owner_cache = cache.LRUCache(config.OWNER_CACHE_SIZE, ttl=config.OWNER_CACHE_TTL)
+
+
+class _QueryCounter(threading.local):
+    """Statements run, seconds spent in sqlite and rows fetched by the current thread
+    since reset_query_count()"""
+    count = 0
+    seconds = 0.0
+    rows = 0
+
+
+_query_counter = _QueryCounter()
+_now = time.perf_counter
+
+# newer than any comments.created_at, the feed key before the first page
+_MAX_CREATED_AT = 2 ** 63 - 1
+
+# SQL statement tracer (see sqltrace.py), None when off
+_tracer = sqltrace.Tracer(slow_threshold=config.SQL_SLOW_THRESHOLD) if config.SQL_TRACE else None
+
+# Allowed values for the enumerated storage pragmas, in sqlite's numeric order
+_PRAGMA_CHOICES = {"journal_mode": ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"),
+                   "synchronous": ("OFF", "NORMAL", "FULL", "EXTRA"),
+                   "temp_store": ("DEFAULT", "FILE", "MEMORY")}
+_PRAGMA_INTEGERS = ("mmap_size", "cache_size", "busy_timeout")
+
+
+def _open_connection(database, readonly=False, cached_statements=128, shard=0):
+    """_open_connection - open and set up a new sqlite connection for the pool
+    :param database: (string) path to the sqlite database file
+    :param readonly: (bool) open a query_only connection, on which any write raises
+        sqlite3.OperationalError
+    :param cached_statements: (int) prepared statements kept per connection
+    :param shard: (int) the shard database is the file of
+    :return: pool.PooledConnection
     """
-    conn = sqlite3.connect("sample-rest.db")
-    c = conn.cursor()
-    c.execute("PRAGMA foreign_keys = ON;")
-    conn.commit()
+    # Pooled connections move between threads, but are only ever
+    # used by one thread at a time (the one that checked it out)
+    conn = sqlite3.connect(database,
+                           factory=_Connection,
+                           check_same_thread=False,
+                           cached_statements=cached_statements)
+    conn.execute("PRAGMA foreign_keys = ON;")
+    apply_storage_profile(conn)
+    if readonly:
+        conn.execute("PRAGMA query_only = ON;")
+    conn.shard = shard
     return conn
 
 
+def _count_statements(started, statements=0, rows=0):
+    """_count_statements - add to the current thread's query stats
+    :param started: (float) time.perf_counter() when the sqlite call started
+    :param statements: (int) statements executed
+    :param rows: (int) rows fetched
+    :return: (float) seconds since started
+    """
+    counter = _query_counter
+    elapsed = _now() - started
+    counter.seconds += elapsed
+    counter.count += statements
+    counter.rows += rows
+    return elapsed
+
+
+class _Cursor(sqlite3.Cursor):
+    """Cursor that counts the statements it executes, the rows fetched with
+    fetchone / fetchmany / fetchall and the time spent in both, and reports
+    them to the SQL tracer when one is installed"""
+
+    def _trace(self):
+        """_trace - the installed tracer, attached to this cursor's connection"""
+        tracer = _tracer
+        if tracer is not None and self.connection.tracer is not tracer:
+            tracer.attach(self.connection)
+            self.connection.tracer = tracer
+        return tracer
+
+    def execute(self, sql, parameters=()):
+        tracer = self._trace()
+        if tracer is not None:
+            tracer.starting(sql)
+        started = _now()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            elapsed = _count_statements(started, statements=1)
+            if tracer is not None:
+                tracer.executed(self.connection, sql, parameters, elapsed)
+
+    def executemany(self, sql, seq_of_parameters):
+        tracer = self._trace()
+        if tracer is not None:
+            tracer.starting(sql)
+        started = _now()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            elapsed = _count_statements(started, statements=1)
+            if tracer is not None:
+                tracer.executed(self.connection, sql, None, elapsed)
+
+    def fetchone(self):
+        started = _now()
+        row = super().fetchone()
+        elapsed = _count_statements(started, rows=0 if row is None else 1)
+        if _tracer is not None:
+            _tracer.fetched(elapsed)
+        return row
+
+    def fetchmany(self, size=None):
+        started = _now()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        elapsed = _count_statements(started, rows=len(rows))
+        if _tracer is not None:
+            _tracer.fetched(elapsed)
+        return rows
+
+    def fetchall(self):
+        started = _now()
+        rows = super().fetchall()
+        elapsed = _count_statements(started, rows=len(rows))
+        if _tracer is not None:
+            _tracer.fetched(elapsed)
+        return rows
+
+
+class _Connection(pool.PooledConnection):
+    """Pooled connection whose cursors count their statements, rows and time"""
+
+    # tracer whose trace callback is set on this connection, see _Cursor._trace
+    tracer = None
+    # shard whose database file this connection is open on, see shard_databases()
+    shard = 0
+
+    def cursor(self, factory=_Cursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def reset_query_count():
+    """reset_query_count - start counting statements for the current thread from zero
+    :return: None
+    """
+    _query_counter.count = 0
+    _query_counter.seconds = 0.0
+    _query_counter.rows = 0
+
+
+def get_query_count():
+    """get_query_count - statements run by the current thread since reset_query_count()
+    :return: (int) statement count
+    """
+    return _query_counter.count
+
+
+def get_query_stats():
+    """get_query_stats - sqlite work done by the current thread since reset_query_count()
+    :return: tuple (statements, seconds in execute and fetch calls, rows fetched)
+    """
+    counter = _query_counter
+    return counter.count, counter.seconds, counter.rows
+
+
+def set_tracer(tracer):
+    """set_tracer - install (or with None remove) the SQL tracer; every connection is
+    attached to it at its next statement
+    :param tracer: sqltrace.Tracer or None
+    :return: the previous tracer, or None
+    """
+    global _tracer
+    previous, _tracer = _tracer, tracer
+    return previous
+
+
+def get_tracer():
+    """get_tracer - the installed SQL tracer
+    :return: sqltrace.Tracer, or None when tracing is off
+    """
+    return _tracer
+
+
+def apply_storage_profile(conn, profile=None):
+    """apply_storage_profile - set the journal, sync, cache and mmap pragmas
+    :param conn: (sqlite db connection) Active connection to the database
+    :param profile: (string) name of a preset in config.DB_PROFILES,
+        defaults to config.DB_PROFILE
+    :return: (string) name of the profile that was applied
+    """
+    profile = profile or config.DB_PROFILE
+    try:
+        settings = config.DB_PROFILES[profile]
+    except KeyError:
+        raise ValueError(f"unknown storage profile {profile!r}, "
+                         f"expected one of {sorted(config.DB_PROFILES)}") from None
+
+    c = conn.cursor()
+    for pragma, value in settings.items():
+        # PRAGMA values cannot be bound as parameters, so only accept known values
+        if pragma in _PRAGMA_CHOICES:
+            value = str(value).upper()
+            if value not in _PRAGMA_CHOICES[pragma]:
+                raise ValueError(f"{profile}: invalid {pragma} {value!r}")
+        elif pragma in _PRAGMA_INTEGERS:
+            value = int(value)
+        else:
+            raise ValueError(f"{profile}: unsupported pragma {pragma!r}")
+        c.execute(f"PRAGMA {pragma} = {value};")
+    return profile
+
+
+def get_storage_settings(conn):
+    """get_storage_settings - read back the storage pragmas in effect
+    :param conn: (sqlite db connection) Active connection to the database
+    :return:
+        dict
+        {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            ...
+        }
+    """
+    c = conn.cursor()
+    result = {}
+    for pragma in ("journal_mode", "synchronous", "mmap_size",
+                   "cache_size", "temp_store", "busy_timeout"):
+        value = c.execute(f"PRAGMA {pragma};").fetchone()[0]
+        if pragma in ("synchronous", "temp_store"):
+            value = _PRAGMA_CHOICES[pragma][value]
+        elif pragma == "journal_mode":
+            value = value.upper()
+        result[pragma] = value
+    return result
+
+
+def shard_databases(database=None, count=None):
+    """shard_databases - the sqlite file of each shard (see shards.py). Shard 0 is the
+    database itself, so a single shard is exactly the unsharded database
+    :param database: (string) sqlite file, defaults to config.DATABASE
+    :param count: (int) number of shards, defaults to config.SHARD_COUNT
+    :return: list of paths, sample-rest.db, sample-rest-shard1.db, ...
+    """
+    database = database or config.DATABASE
+    count = count or config.SHARD_COUNT
+    root, ext = os.path.splitext(database)
+    return [database] + [f"{root}-shard{shard}{ext}" for shard in range(1, count)]
+
+
+def init_pool(database=None, max_size=None, idle_timeout=None, read_max_size=None,
+              shard_count=None):
+    """init_pool - (re)create the connection pools, closing any existing ones.
+    Each shard gets its own read-write and read-only pool
+    :param database: (string) sqlite file, defaults to config.DATABASE
+    :param max_size: (int) max open connections, defaults to config.POOL_MAX_SIZE
+    :param idle_timeout: (float) idle seconds before a connection is closed,
+        defaults to config.POOL_IDLE_TIMEOUT
+    :param read_max_size: (int) max open read-only connections,
+        defaults to config.READ_POOL_MAX_SIZE
+    :param shard_count: (int) number of shards, defaults to config.SHARD_COUNT
+    :return: the new (read-write) pool.ConnectionPool of shard 0
+    """
+    global _pools, _databases
+    idle_timeout = config.POOL_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+    databases = shard_databases(database, shard_count)
+    new_pools = []
+    for shard, path in enumerate(databases):
+        new_pool = pool.ConnectionPool(
+            functools.partial(_open_connection, path, shard=shard),
+            max_size=max_size or config.POOL_MAX_SIZE,
+            idle_timeout=idle_timeout,
+            acquire_timeout=config.POOL_ACQUIRE_TIMEOUT,
+            health_check_after=config.POOL_HEALTH_CHECK_AFTER)
+        new_read_pool = pool.ConnectionPool(
+            functools.partial(_open_connection, path, readonly=True,
+                              cached_statements=config.READ_POOL_CACHED_STATEMENTS,
+                              shard=shard),
+            max_size=read_max_size or config.READ_POOL_MAX_SIZE,
+            idle_timeout=idle_timeout,
+            acquire_timeout=config.POOL_ACQUIRE_TIMEOUT,
+            health_check_after=config.POOL_HEALTH_CHECK_AFTER)
+        new_pools.append((new_pool, new_read_pool))
+
+    with _pool_lock:
+        close_coalescer()
+        old_pools, _pools, _databases = _pools, new_pools, databases
+    for pools in old_pools or ():
+        for old_pool in pools:
+            old_pool.close()
+    return new_pools[0][0]
+
+
+def _get_pools():
+    """_get_pools - the pools of every shard, created on first use"""
+    if _pools is None:
+        with _pool_lock:
+            if _pools is None:
+                init_pool()
+    return _pools
+
+
+def get_shard_count():
+    """get_shard_count - number of shards the pools were created for
+    :return: (int)
+    """
+    return len(_get_pools())
+
+
+def get_shard_databases():
+    """get_shard_databases - the sqlite file of each shard the pools were created for
+    :return: list of paths, see shard_databases()
+    """
+    _get_pools()
+    return list(_databases)
+
+
+def get_pool(shard=0):
+    """get_pool - the process wide connection pool of a shard, created on first use
+    :param shard: (int) shard number
+    :return: pool.ConnectionPool
+    """
+    return _get_pools()[shard][0]
+
+
+def get_read_pool(shard=0):
+    """get_read_pool - the process wide pool of read-only connections of a shard,
+    created on first use
+    :param shard: (int) shard number
+    :return: pool.ConnectionPool
+    """
+    return _get_pools()[shard][1]
+
+
+def close_pool():
+    """close_pool - close the process wide connection pools
+    :return: None
+    """
+    global _pools
+    with _pool_lock:
+        close_coalescer()
+        old_pools, _pools = _pools, None
+    for pools in old_pools or ():
+        for old_pool in pools:
+            old_pool.close()
+
+
+def connect_db(readonly=False, shard=0):
+    """connect_db - check out a connection to the database from the pool
+    Use it as a context manager (commits or rolls back, then returns the
+    connection to the pool), or call release() on it when done.
+    A checked out connection must only be used by one thread at a time.
+    :param readonly: (bool) check out a query_only connection from the read pool
+        (see get_read_pool), for requests that only read
+    :param shard: (int) shard number, see shards.py for which shard holds what
+    :return: sqlite database connection (pool.PooledConnection), its shard in .shard
+    """
+    if readonly:
+        return get_read_pool(shard).acquire()
+    return get_pool(shard).acquire()
+
+
+def get_coalescer(shard=0):
+    """get_coalescer - the process wide group commit writer of a shard, created on first use.
+    It holds one pooled connection for as long as it runs.
+    :param shard: (int) shard number
+    :return: coalescer.WriteCoalescer, or None when config.WRITE_COALESCE is off
+    """
+    if not config.WRITE_COALESCE:
+        return None
+    writer = _coalescers.get(shard)
+    if writer is None:
+        with _pool_lock:
+            writer = _coalescers.get(shard)
+            if writer is None:
+                writer = _coalescers[shard] = coalescer.WriteCoalescer(
+                    get_pool(shard).acquire(),
+                    max_delay=config.WRITE_COALESCE_MAX_DELAY,
+                    max_batch=config.WRITE_COALESCE_MAX_BATCH)
+    return writer
+
+
+def close_coalescer():
+    """close_coalescer - commit the queued writes, stop the writers and return their connections
+    :return: None
+    """
+    with _pool_lock:
+        writers = list(_coalescers.values())
+        _coalescers.clear()
+    for writer in writers:
+        writer.close()
+        writer.conn.release()
+
+
 def initialize_db(conn):
     """
-    Creates tables in the database if they do not already exist.
-    Make sure to clean up old .db files on schema changes.
+    Creates tables in the database if they do not already exist,
+    then applies any pending migrations (see migrate_db).
+    Also applies (and logs) the configured storage profile.
     """
+    profile = apply_storage_profile(conn)
+    log.info("sqlite storage profile %s: %s", profile, get_storage_settings(conn))
+
     c = conn.cursor()
     for table, sql in static_sql.SQL.items():
         try:
             c.execute(sql)
             conn.commit()
         except sqlite3.OperationalError as err:
-            # ToDo: proper logging
-            print(f"{table}: {err}")
+            log.error("%s: %s", table, err)
             raise
 
+    migrate_db(conn)
+
+
+def migrate_db(conn):
+    """migrate_db - apply the migrations in static_sql.MIGRATIONS that are
+    newer than the database's user_version, each in its own transaction
+    :param conn: (sqlite db connection) Active connection to the database
+    :return: (int) the schema version after migrating
+    """
+    c = conn.cursor()
+    version = c.execute("PRAGMA user_version;").fetchone()[0]
+
+    previous = 0
+    for number, description, statements in static_sql.MIGRATIONS:
+        if number <= previous:
+            raise ValueError(f"migration {number} is out of order")
+        previous = number
+        if number <= version:
+            continue
+
+        try:
+            # Take the write lock first, another process may have migrated already
+            c.execute("BEGIN IMMEDIATE;")
+            version = c.execute("PRAGMA user_version;").fetchone()[0]
+            if number <= version:
+                conn.rollback()
+                continue
+            for sql in statements:
+                c.execute(sql)
+            c.execute(f"PRAGMA user_version = {int(number)};")
+            conn.commit()
+        except sqlite3.Error as err:
+            conn.rollback()
+            log.error("migration %d (%s): %s", number, description, err)
+            raise
+
+        version = number
+        log.info("applied migration %d: %s", number, description)
+
+    return version
+
 
 def get_num_projects(conn):
     """get_num_projects - returns a count of all projects in the projects table
@@ -43,25 +493,86 @@ def get_num_projects(conn):
             "project_count": <project-count>
         }
     """
+    # Kept up to date by triggers (static_sql migration 2), so this is one
+    # primary key lookup however many projects there are
     c = conn.cursor()
-    sql = "SELECT COUNT(*) AS count FROM projects;"
-    c.execute(sql)
-    count = c.fetchall()[0][0]
-    response = {"project_count": count}
+    sql = """SELECT row_count FROM table_counts
+               WHERE table_name = 'projects';"""
+    row = c.execute(sql).fetchone()
+    response = {"project_count": row[0] if row else 0}
+    return response
+
+
+def get_num_owner_projects(conn, owner_id):
+    """get_num_owner_projects - returns a count of this owner's projects
+    :param conn: (sqlite db connection) Active connection to the database
+    :param owner_id: (string) the owner's uuid
+    :return:
+        dict
+        {
+            "owner_id": <owner_id>,
+            "project_count": <project-count>
+        }
+    """
+    c = conn.cursor()
+    sql = """SELECT project_count FROM owner_project_counts
+               WHERE owner_id = ?;"""
+    row = c.execute(sql, (owner_id,)).fetchone()
+    response = {"owner_id": owner_id,
+                "project_count": row[0] if row else 0}
     return response
 
 
+def rebuild_counters(conn):
+    """rebuild_counters - recompute the project counters from the projects table,
+    for use after the counter triggers were dropped (see datagen.bulk_load)
+    :param conn: (sqlite db connection) Active connection to the database
+    :return: None
+    """
+    c = conn.cursor()
+    for sql in static_sql.REBUILD_COUNTERS:
+        c.execute(sql)
+    conn.commit()
+
+
+def rebuild_search(conn):
+    """rebuild_search - rebuild the full-text index from the comments and projects tables,
+    for use after its triggers were dropped (see datagen.bulk_load)
+    :param conn: (sqlite db connection) Active connection to the database
+    :return: None
+    """
+    c = conn.cursor()
+    for sql in static_sql.REBUILD_SEARCH:
+        c.execute(sql)
+    conn.commit()
+
+
+def flush_search(conn):
+    """flush_search - index the project and comment changes queued since the last flush,
+    so a search sees every write before it. Cheap (one lookup) when nothing is queued
+    :param conn: (sqlite db connection) read-write connection to the shard to search
+    :return: (bool) whether anything was queued
+    """
+    c = conn.cursor()
+    if c.execute("SELECT 1 FROM search_queue LIMIT 1;").fetchone() is None:
+        return False
+    for sql in static_sql.FLUSH_SEARCH:
+        c.execute(sql)
+    conn.commit()
+    return True
+
+
 def get_owner(conn, owner_id):
     """get_owner - get the owner for this owner uuid
     :param conn: (sqlite db connection) Active connection to the database
     :param owner_id: (string) owner uuid value
     :return:
-        If found, the comment row corresponding to owner_uuid
-        If not found, None
+        list with the records.Owner for owner_uuid, empty if not found
     """
     c = conn.cursor()
-    sql = """SELECT * FROM owners
-               WHERE owner_id=?;"""
+    c.row_factory = records.row_factory(records.Owner)
+    sql = f"""SELECT {records.columns(records.Owner)} FROM owners
+                WHERE owner_id=?;"""
     c.execute(sql, (owner_id,))
     return c.fetchall()
 
@@ -69,20 +580,192 @@ def get_owner(conn, owner_id):
 def get_owners(conn):
     """get_owners - get all the owner data
     :param conn: (sqlite db connection) Active connection to the database
-    :return: A list of the owner rows. If no rows exist, the list is empty
+    :return: A list of records.Owner. If no rows exist, the list is empty
     """
     c = conn.cursor()
-    sql = """SELECT * FROM owners;"""
+    c.row_factory = records.row_factory(records.Owner)
+    sql = f"""SELECT {records.columns(records.Owner)} FROM owners;"""
     c.execute(sql)
     return c.fetchall()
 
 
-def add_project(conn, project_id, owner_id, project_name):
+def get_owners_page(conn, limit, after=None):
+    """get_owners_page - get one page of owners, ordered by owner_id (keyset pagination)
+    :param conn: (sqlite db connection) Active connection to the database
+    :param limit: (int) max owners to return
+    :param after: (string) next_after value from the previous page, None for the first page
+    :return:
+        tuple ([records.Owner], next_after or None on the last page)
+    """
+    c = conn.cursor()
+    c.row_factory = records.row_factory(records.Owner)
+    sql = f"""SELECT {records.columns(records.Owner)} FROM owners
+                WHERE owner_id > ?
+                ORDER BY owner_id
+                LIMIT ?;"""
+    c.execute(sql, (after or "", limit + 1))
+    owners = c.fetchall()
+
+    next_after = owners[limit - 1]["owner_id"] if len(owners) > limit else None
+    return owners[:limit], next_after
+
+
+def iter_owners(conn, after=None, batch_size=500):
+    """iter_owners - stream every owner after a key, ordered by owner_id
+    :param conn: (sqlite db connection) Active connection to the database
+    :param after: (string) owner key to start after, None to start at the beginning
+    :param batch_size: (int) rows fetched from the cursor at a time
+    :return: generator of lists (at most batch_size long) of records.Owner
+    """
+    c = conn.cursor()
+    c.row_factory = records.row_factory(records.Owner)
+    sql = f"""SELECT {records.columns(records.Owner)} FROM owners
+                WHERE owner_id > ?
+                ORDER BY owner_id;"""
+    c.execute(sql, (after or "",))
+    while True:
+        owners = c.fetchmany(batch_size)
+        if not owners:
+            break
+        yield owners
+
+
+def get_owner_username(conn, owner_id):
+    """get_owner_username - owner_username for this owner uuid, from the owner cache
+    when possible (see invalidate_owner)
+    :param conn: (sqlite db connection) Active connection to the database
+    :param owner_id: (string) owner uuid value
+    :return:
+        If found, the owner_username
+        If not found, None
+    """
+    owner_username = _owner_cache.get(owner_id)
+    if owner_username is None:
+        c = conn.cursor()
+        sql = """SELECT owner_username FROM owners
+                   WHERE owner_id=?;"""
+        row = c.execute(sql, (owner_id,)).fetchone()
+        if row is None:
+            return None
+        owner_username = row[0]
+        _owner_cache.set(owner_id, owner_username)
+    return owner_username
+
+
+def get_owner_usernames(conn, owner_ids):
+    """get_owner_usernames - owner_username for many owners, from the owner cache when
+    possible and with one query per 500 cache misses
+    :param conn: (sqlite db connection) Active connection to the database
+    :param owner_ids: iterable of owner uuid values
+    :return: dict {<owner_uuid>: <owner_username>} of the owners that were found
+    """
+    result = {}
+    missing = []
+    for owner_id in set(owner_ids):
+        owner_username = _owner_cache.get(owner_id)
+        if owner_username is None:
+            missing.append(owner_id)
+        else:
+            result[owner_id] = owner_username
+
+    c = conn.cursor()
+    # stay well below sqlite's host parameter limit
+    for start in range(0, len(missing), 500):
+        chunk = missing[start:start + 500]
+        sql = f"""SELECT owner_id, owner_username FROM owners
+                    WHERE owner_id IN ({",".join("?" * len(chunk))});"""
+        for owner_id, owner_username in c.execute(sql, chunk).fetchall():
+            result[owner_id] = owner_username
+            _owner_cache.set(owner_id, owner_username)
+    return result
+
+
+def invalidate_owner(owner_id=None):
+    """invalidate_owner - drop an owner from the owner cache.
+    Call it after changing the owners table outside of add_owner / update_owner.
+    :param owner_id: (string) owner uuid value, None drops every owner
+    :return: None
+    """
+    if owner_id is None:
+        _owner_cache.clear()
+    else:
+        _owner_cache.delete(owner_id)
+
+
+def get_owner_cache_stats():
+    """get_owner_cache_stats - owner cache size and hit/miss counters
+    :return: dict (see cache.LRUCache.stats)
+    """
+    return _owner_cache.stats()
+
+
+def _write_other_shards(conn, sql, parameters):
+    """_write_other_shards - run an owners table write on every shard but the one conn is
+    open on, one transaction each: the owners table is copied to every shard (see shards.py)
+    :param conn: the connection the write was committed on
+    :param sql: (string) the statement
+    :param parameters: its parameters
+    :return: None
+    """
+    for shard in range(get_shard_count()):
+        if shard != getattr(conn, "shard", 0):
+            with connect_db(shard=shard) as other:
+                other.cursor().execute(sql, parameters)
+
+
+def add_owner(conn, owner_id, owner_username):
+    """add_owner - Add a new owner to the owners table, in every shard. The owner cache
+    is invalidated once every shard has committed
+    :param conn: (sqlite db connection) Active connection to the database
+    :param owner_id: (string) the uuid of the new owner
+    :param owner_username: (string) the owner's username
+    :return: dict {"owner_id": <owner_uuid>, "owner_username": <owner_username>}
+    """
+    c = conn.cursor()
+    sql = """INSERT INTO owners (owner_id, owner_username)
+               VALUES (?,?);"""
+    c.execute(sql, (owner_id, owner_username))
+    conn.commit()
+    sql = """INSERT INTO owners (owner_id, owner_username)
+               VALUES (?,?)
+               ON CONFLICT (owner_id) DO UPDATE SET owner_username=excluded.owner_username;"""
+    _write_other_shards(conn, sql, (owner_id, owner_username))
+    invalidate_owner(owner_id)
+
+    return {"owner_id": owner_id, "owner_username": owner_username}
+
+
+def update_owner(conn, owner_id, owner_username):
+    """update_owner - Change an owner's username, in every shard. The owner cache is
+    invalidated once every shard has committed
+    :param conn: (sqlite db connection) Active connection to the database
+    :param owner_id: (string) the uuid of the owner
+    :param owner_username: (string) the owner's new username
+    :return:
+        If found, dict {"owner_id": <owner_uuid>, "owner_username": <owner_username>}
+        If not found, None
+    """
+    c = conn.cursor()
+    sql = """UPDATE owners SET owner_username=?
+               WHERE owner_id=?;"""
+    c.execute(sql, (owner_username, owner_id))
+    conn.commit()
+    if c.rowcount:
+        _write_other_shards(conn, sql, (owner_username, owner_id))
+    invalidate_owner(owner_id)
+
+    if c.rowcount == 0:
+        return None
+    return {"owner_id": owner_id, "owner_username": owner_username}
+
+
+def add_project(conn, project_id, owner_id, project_name, commit=True):
     """add_project - Add a new project to the projects table for this owner
     :param conn: (sqlite db connection) Active connection to the database
     :param project_id: (string) the uuid of the new project
     :param owner_id: (string) the owner of the project
     :param project_name: (string) the new project name
+    :param commit: (bool) False leaves the commit to the caller (see coalescer.py)
     :return:
         returns a dict with the following
           {"project_id": "<new-project-uuid>",
@@ -91,10 +774,13 @@ def add_project(conn, project_id, owner_id, project_name):
            "project_name": "<project_name>",
            “comments”: []
           }
+        If the owner does not exist, None
     """
     c = conn.cursor()
 
-    rows = get_owner(conn, owner_id)
+    owner_username = get_owner_username(conn, owner_id)
+    if owner_username is None:
+        return None
 
     sql = """INSERT INTO projects (project_id, 
                                    owner_id,
@@ -103,99 +789,290 @@ def add_project(conn, project_id, owner_id, project_name):
 
     c.execute(sql, (project_id, owner_id, project_name))
 
-    conn.commit()
+    if commit:
+        conn.commit()
 
     result = {"project_id": project_id,
               "owner_id": owner_id,
-              "owner_username": rows[0][1],
+              "owner_username": owner_username,
               "project_name": project_name,
               "comments": []}
 
     return result
 
 
-def get_project(conn, owner_id, project_id):
-    """get_project
-    get the project data associated with this owner_id/project_id
+def add_projects(conn, owner_id, projects):
+    """add_projects - Add many projects for this owner in a single transaction
+    :param conn: (sqlite db connection) Active connection to the database
+    :param owner_id: (string) the owner of the projects
+    :param projects: list of (project_id, project_name) tuples
+    :return:
+        list of project dicts (see add_project), in the order given
+        If the owner does not exist, None
+    """
+    owner_username = get_owner_username(conn, owner_id)
+    if owner_username is None:
+        return None
+
+    c = conn.cursor()
+    sql = """INSERT INTO projects (project_id,
+                                   owner_id,
+                                   project_name)
+                        VALUES (?,?,?);"""
+
+    c.executemany(sql, [(project_id, owner_id, project_name)
+                        for project_id, project_name in projects])
+
+    conn.commit()
+
+    return [{"project_id": project_id,
+             "owner_id": owner_id,
+             "owner_username": owner_username,
+             "project_name": project_name,
+             "comments": []}
+            for project_id, project_name in projects]
+
+
+def get_projects_page(conn, owner_id, limit, after=None):
+    """get_projects_page - get one page of this owner's projects, ordered by project_id
+    (keyset pagination)
+    :param conn: (sqlite db connection) Active connection to the database
+    :param owner_id: (string) the owner's uuid
+    :param limit: (int) max projects to return
+    :param after: (string) next_after value from the previous page, None for the first page
+    :return:
+        tuple ([records.Project], next_after or None on the last page)
+    """
+    c = conn.cursor()
+    c.row_factory = records.row_factory(records.Project)
+    sql = f"""SELECT {records.columns(records.Project)} FROM projects
+                WHERE owner_id=? AND project_id > ?
+                ORDER BY project_id
+                LIMIT ?;"""
+    c.execute(sql, (owner_id, after or "", limit + 1))
+    projects = c.fetchall()
+
+    next_after = projects[limit - 1]["project_id"] if len(projects) > limit else None
+    return projects[:limit], next_after
+
+
+def iter_projects(conn, owner_id, after=None, batch_size=500):
+    """iter_projects - stream every project of this owner after a key, ordered by project_id
+    :param conn: (sqlite db connection) Active connection to the database
+    :param owner_id: (string) the owner's uuid
+    :param after: (string) project key to start after, None to start at the beginning
+    :param batch_size: (int) rows fetched from the cursor at a time
+    :return: generator of lists (at most batch_size long) of records.Project
+    """
+    c = conn.cursor()
+    c.row_factory = records.row_factory(records.Project)
+    sql = f"""SELECT {records.columns(records.Project)} FROM projects
+                WHERE owner_id=? AND project_id > ?
+                ORDER BY project_id;"""
+    c.execute(sql, (owner_id, after or ""))
+    while True:
+        projects = c.fetchmany(batch_size)
+        if not projects:
+            break
+        yield projects
+
+
+def _hydrate_project(conn, owner_id, project_id, limit=None, after=None):
+    """_hydrate_project - fetch a project and (a page of) its comments in one query,
+    the owner comes from the owner cache
     :param conn: (sqlite db connection) Active connection to the database
     :param owner_id: (string): the owner's uuid
     :param project_id: (string): the project's uuid
+    :param limit: (int) max comments to return, None for all of them
+    :param after: (int) comment key to continue after, from a previous page
     :return:
-        If found, the corresponding project row
+        If found, tuple (project dict (see get_project), key of the next page or None,
+        project version (see get_project_version), None for a page)
         If not found, None
     """
     c = conn.cursor()
+    # comments are keyed (and returned) in insertion order, by rowid.
+    # Ordering by project_id first lets sqlite walk idx_comments_project
+    # in order instead of sorting every comment of the project.
+    sql = f"""SELECT projects.project_name,
+                     projects.version,
+                     comments.rowid,
+                     {records.columns(records.Comment, "comments")}
+               FROM projects
+               LEFT JOIN comments ON comments.project_id = projects.project_id
+                                 AND comments.rowid > ?
+               WHERE projects.owner_id=? AND projects.project_id=?
+               ORDER BY projects.project_id, comments.rowid
+               LIMIT ?;"""
+    # fetch one extra row to find out whether there is a next page
+    c.execute(sql, (after or 0, owner_id, project_id, -1 if limit is None else limit + 1))
 
-    sql = """SELECT * FROM projects
-               WHERE owner_id=? AND project_id=?;"""
-    c.execute(sql, (owner_id, project_id))
+    rows = c.fetchall()
+    if not rows:
+        return None
 
-    project_rows = c.fetchall()
+    next_after = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_after = rows[-1][2]  # comments.rowid
+    project_name, version = rows[0][:2]
+    # comments come in rowid order, so the last one is the newest
+    version = None if limit is not None else (version, rows[-1][2] or 0)
 
-    if project_rows is None:
-        result = {"message": "No project to delete"}
+    # A project without comments comes back as one row of NULL comment columns.
+    # (records.Comment fields; the joined rows also carry the project columns)
+    comments = [{"comment_id": comment_id,
+                 "commenter_id": commenter_id,
+                 "commenter_username": commenter_username,
+                 "message": message}
+                for _, _, _, comment_id, commenter_id, commenter_username, message in rows
+                if comment_id is not None]
 
-    else:
-        owner_rows = get_owner(conn, owner_id)
-
-        comment_rows = get_comments(conn, project_id)
-        comment_data = []
-        for comment_row in comment_rows:
-
-            comment_data.append({"comment_id": comment_row[0],
-                                 "commenter_id": comment_row[1],
-                                 "commenter_username": comment_row[2],
-                                 "message": comment_row[4]
-                                 }
-                                )
-
-        result = {"project_id": project_id,
-                  "owner_id": owner_id,
-                  "owner_username": owner_rows[0][1],
-                  "project_name": project_rows[0][2],
-                  "comments": comment_data
-                  }
+    project = {"project_id": project_id,
+               "owner_id": owner_id,
+               "owner_username": get_owner_username(conn, owner_id),
+               "project_name": project_name,
+               "comments": comments}
+    return project, next_after, version
 
-    return result
 
-
-def delete_project(conn, owner_id, project_id):
-    """delete_project - Delete an existing project & associated comments
+def get_project(conn, owner_id, project_id):
+    """get_project
+    get the project data associated with this owner_id/project_id
     :param conn: (sqlite db connection) Active connection to the database
-    :param owner_id: (string) the uuid of the project owner
-    :param project_id: (string) the uuid of the project to delete
+    :param owner_id: (string): the owner's uuid
+    :param project_id: (string): the project's uuid
     :return:
-      dict containing
+        If found, dict containing
         {"project_id": <project_uuid>,
             "owner_id": <project_owner_uuid>,
             "owner_username": <project_owner_username>,
             "project_name": <project_name>,
             "comments":
-                [{"comment_id": <deleted_comment_uuid>,
-                  "commenter_id": <deleted_commenter_id>,
-                   "commenter_username": <deleted_commenter_username>,
-                   "message": <deleted_message>
+                [{"comment_id": <comment_uuid>,
+                  "commenter_id": <commenter_id>,
+                   "commenter_username": <commenter_username>,
+                   "message": <message>
                 }]
         }
+        If not found, None
+    """
+    result = _hydrate_project(conn, owner_id, project_id)
+    return None if result is None else result[0]
+
+
+def get_project_versioned(conn, owner_id, project_id):
+    """get_project_versioned - get_project, with the project version read by the same query
+    :param conn: (sqlite db connection) Active connection to the database
+    :param owner_id: (string): the owner's uuid
+    :param project_id: (string): the project's uuid
+    :return:
+        If found, tuple (project dict (see get_project), version)
+        If not found, None
+    """
+    result = _hydrate_project(conn, owner_id, project_id)
+    return None if result is None else (result[0], result[2])
+
+
+def get_project_version(conn, owner_id, project_id):
+    """get_project_version - the project's version, greater after any change to the project,
+    its comments or its owner's username: projects.version, increased by the schema triggers
+    when a comment is changed or deleted or the project or username change, then the rowid
+    of the newest comment, which a new comment increases
+    :param conn: (sqlite db connection) Active connection to the database
+    :param owner_id: (string): the owner's uuid
+    :param project_id: (string): the project's uuid
+    :return: tuple (projects.version, newest comment rowid or 0), None if not found
+    """
+    c = conn.cursor()
+    # max(rowid) is the last entry of the project in idx_comments_project
+    sql = """SELECT version,
+                    (SELECT max(rowid) FROM comments WHERE project_id=projects.project_id)
+               FROM projects
+               WHERE project_id=? AND owner_id=?;"""
+    row = c.execute(sql, (project_id, owner_id)).fetchone()
+    return None if row is None else (row[0], row[1] or 0)
+
+
+def get_project_page(conn, owner_id, project_id, limit, after=None):
+    """get_project_page - get a project with one page of its comments (keyset pagination)
+    :param conn: (sqlite db connection) Active connection to the database
+    :param owner_id: (string): the owner's uuid
+    :param project_id: (string): the project's uuid
+    :param limit: (int) max comments to return
+    :param after: (int) next_after value from the previous page, None for the first page
+    :return:
+        If found, tuple (project dict (see get_project), next_after or None on the last page)
+        If not found, None
+    """
+    result = _hydrate_project(conn, owner_id, project_id, limit, after)
+    return None if result is None else result[:2]
+
+
+def get_project_summary(conn, owner_id, project_id):
+    """get_project_summary - get the project and owner data, without the comments
+    :param conn: (sqlite db connection) Active connection to the database
+    :param owner_id: (string): the owner's uuid
+    :param project_id: (string): the project's uuid
+    :return:
+        If found, dict containing
+        {"project_id": <project_uuid>,
+         "owner_id": <project_owner_uuid>,
+         "owner_username": <project_owner_username>,
+         "project_name": <project_name>
+        }
+        If not found, None
     """
     c = conn.cursor()
-    owner_rows = get_owner(conn, owner_id)
-    project_response = get_project(conn, owner_id, project_id)
-    comment_rows = get_comments(conn, project_id)
+    sql = """SELECT project_name FROM projects
+               WHERE owner_id=? AND project_id=?;"""
+    row = c.execute(sql, (owner_id, project_id)).fetchone()
+    if row is None:
+        return None
 
-    comments = [{"comment_id": row[0],
-                 "commenter_id": row[1],
-                 "commenter_username": row[2],
-                 "message": row[4]}
-                for row in comment_rows]
+    return {"project_id": project_id,
+            "owner_id": owner_id,
+            "owner_username": get_owner_username(conn, owner_id),
+            "project_name": row[0]}
 
-    response = {"project_id": project_id,
-                "owner_id": owner_id,
-                "owner_username": owner_rows[0][1],
-                "project_name": project_response["project_name"],
-                "comments": comments
-    }
 
+def iter_comments(conn, project_id, after=None, batch_size=500):
+    """iter_comments - stream every comment on this project after a key, in insertion order
+    :param conn: (sqlite db connection) Active connection to the database
+    :param project_id: (string) the project's uuid
+    :param after: (int) comment key to start after, None to start at the beginning
+    :param batch_size: (int) rows fetched from the cursor at a time
+    :return: generator of lists (at most batch_size long) of records.Comment
+    """
+    c = conn.cursor()
+    c.row_factory = records.row_factory(records.Comment)
+    sql = f"""SELECT {records.columns(records.Comment)}
+                FROM comments
+                WHERE project_id=? AND rowid > ?
+                ORDER BY rowid;"""
+    c.execute(sql, (project_id, after or 0))
+    while True:
+        comments = c.fetchmany(batch_size)
+        if not comments:
+            break
+        yield comments
+
+
+def delete_project(conn, owner_id, project_id):
+    """delete_project - Delete an existing project & associated comments
+    :param conn: (sqlite db connection) Active connection to the database
+    :param owner_id: (string) the uuid of the project owner
+    :param project_id: (string) the uuid of the project to delete
+    :return:
+      If found, dict containing the deleted project (see get_project)
+      If not found, None
+    """
+    result = _hydrate_project(conn, owner_id, project_id)
+    if result is None:
+        return None
+    response = result[0]
+
+    c = conn.cursor()
     sql = """DELETE FROM projects
                WHERE project_id=?"""
 
@@ -206,32 +1083,52 @@ def delete_project(conn, owner_id, project_id):
     return response
 
 
-def add_comment(conn, commenter_id, project_id, message):
+def created_now():
+    """created_now - the current time as stored in comments.created_at
+    :return: (int) milliseconds since the epoch
+    """
+    return time.time_ns() // 1_000_000
+
+
+def add_comment(conn, commenter_id, project_id, message, commit=True):
     """add_comment - add comment to this project for this commenter_id
     :param conn: (sqlite db connection) Active connection to the database
     :param commenter_id: (string) owner_id of commenter
     :param project_id: (string) project_id of project for new message
     :param message: (string) new comment message
+    :param commit: (bool) False leaves the commit to the caller (see coalescer.py)
     :return:
+        dict containing the new comment
+        {"comment_id": <comment_uuid>,
+         "commenter_id": <commenter_id>,
+         "commenter_username": <commenter_username>,
+         "message": <message>
+        }
+        If the commenter does not exist, None
     """
+    commenter_username = get_owner_username(conn, commenter_id)
+    if commenter_username is None:
+        return None
 
     c = conn.cursor()
     sql = """INSERT INTO comments (comment_id,
                                    commenter_id,
                                    commenter_username,
                                    project_id,
-                                   message)
-                VALUES(?,?,?,?,?);
+                                   message,
+                                   created_at,
+                                   project_owner_id)
+                VALUES(?,?,?,?,?,?,(SELECT owner_id FROM projects WHERE project_id=?));
             """
     comment_id = str(uuid.uuid1())
-    rows = get_owner(conn, commenter_id)
-    commenter_username = rows[0][1]
 
-    values = (comment_id, commenter_id, commenter_username, project_id, message)
+    values = (comment_id, commenter_id, commenter_username, project_id, message,
+              created_now(), project_id)
 
     c.execute(sql, values)
 
-    conn.commit()
+    if commit:
+        conn.commit()
 
     response = {"comment_id": comment_id,
                 "commenter_id": commenter_id,
@@ -243,17 +1140,69 @@ def add_comment(conn, commenter_id, project_id, message):
     return response
 
 
+def add_comments(conn, project_id, comments):
+    """add_comments - add many comments to this project in a single transaction
+    :param conn: (sqlite db connection) Active connection to the database
+    :param project_id: (string) project_id of project for the new messages
+    :param comments: list of (commenter_id, message) tuples
+    :return:
+        list, in the order given, of comment dicts (see add_comment),
+        or None for a comment whose commenter does not exist (it is not added)
+        If the project does not exist, None
+    """
+    c = conn.cursor()
+    sql = """SELECT owner_id FROM projects
+               WHERE project_id=?;"""
+    row = c.execute(sql, (project_id,)).fetchone()
+    if row is None:
+        return None
+    project_owner_id = row[0]
+
+    usernames = get_owner_usernames(conn, [commenter_id for commenter_id, _ in comments])
+
+    created_at = created_now()
+    results = []
+    values = []
+    for commenter_id, message in comments:
+        commenter_username = usernames.get(commenter_id)
+        if commenter_username is None:
+            results.append(None)
+            continue
+        comment_id = str(uuid.uuid1())
+        values.append((comment_id, commenter_id, commenter_username, project_id, message,
+                       created_at, project_owner_id))
+        results.append({"comment_id": comment_id,
+                        "commenter_id": commenter_id,
+                        "commenter_username": commenter_username,
+                        "message": message})
+
+    sql = """INSERT INTO comments (comment_id,
+                                   commenter_id,
+                                   commenter_username,
+                                   project_id,
+                                   message,
+                                   created_at,
+                                   project_owner_id)
+                VALUES(?,?,?,?,?,?,?);
+            """
+    c.executemany(sql, values)
+
+    conn.commit()
+
+    return results
+
+
 def get_comment(conn, comment_id):
     """get_comment - get the comment data associated with this user/project/comment
     :param conn: (sqlite db connection) Active connection to the database
     :param comment_id: (string) the comment's uuid
     :return:
-        If found, the corresponding comment row
-        If not found, None
+        list with the corresponding records.Comment, empty if not found
     """
     c = conn.cursor()
-    sql = """SELECT * FROM comments
-               WHERE comment_id=?;"""
+    c.row_factory = records.row_factory(records.Comment)
+    sql = f"""SELECT {records.columns(records.Comment)} FROM comments
+                WHERE comment_id=?;"""
     c.execute(sql, (comment_id,))
     return c.fetchall()
 
@@ -263,12 +1212,13 @@ def get_comments(conn, project_id):
     :param conn: (sqlite db connection) Active connection to the database
     :param project_id: (string) the project's uuid
     :return:
-        If found, all corresponding comment rows
-        If not found, None
+        list of the project's records.Comment in insertion order, empty if none
     """
     c = conn.cursor()
-    sql = """SELECT * FROM comments
-               WHERE project_id=?;"""
+    c.row_factory = records.row_factory(records.Comment)
+    sql = f"""SELECT {records.columns(records.Comment)} FROM comments
+                WHERE project_id=?
+                ORDER BY rowid;"""
     c.execute(sql, (project_id,))
     return c.fetchall()
 
@@ -276,14 +1226,94 @@ def get_comments(conn, project_id):
 def get_owner_comments(conn, owner_id):
     """get_owner_comments - gets all comments for the project by the project owner
     :param conn: (sqlite db connection) Active connection to the database
-    :param owner_id:
+    :param owner_id: (string) the owner's uuid
     :return:
-        If found, all corresponding comment rows
-        If not found, None
+        list of records.OwnerComment, empty if none
     """
     c = conn.cursor()
-    sql = """SELECT * FROM v_owner_project_comments
-               WHERE owner_id=?;"""
+    c.row_factory = records.row_factory(records.OwnerComment)
+    sql = f"""SELECT {records.columns(records.OwnerComment)} FROM v_owner_project_comments
+                WHERE owner_id=?;"""
     c.execute(sql, (owner_id,))
     return c.fetchall()
 
+
+def get_owner_comments_page(conn, owner_id, limit, after=None):
+    """get_owner_comments_page - one page of the comments on this owner's projects,
+    newest first (keyset pagination on created_at, then comment_id)
+    :param conn: (sqlite db connection) Active connection to the database
+    :param owner_id: (string) the owner's uuid
+    :param limit: (int) max comments to return
+    :param after: [created_at, comment_id] next_after value from the previous page,
+        None for the first page
+    :return:
+        tuple ([records.FeedComment], next_after or None on the last page)
+    """
+    c = conn.cursor()
+    c.row_factory = records.row_factory(records.FeedComment)
+    # idx_comments_owner_created yields the owner's comments in order, so the page
+    # stops after limit rows instead of sorting the owner's whole history
+    sql = """SELECT comments.project_id, projects.project_name, comments.comment_id,
+                    comments.commenter_id, comments.commenter_username, comments.message,
+                    comments.created_at
+               FROM comments
+               INNER JOIN projects ON projects.owner_id = comments.project_owner_id
+                                  AND projects.project_id = comments.project_id
+               WHERE comments.project_owner_id = ?
+                 AND (comments.created_at, comments.comment_id) < (?, ?)
+               ORDER BY comments.created_at DESC, comments.comment_id DESC
+               LIMIT ?;"""
+    created_at, comment_id = after or (_MAX_CREATED_AT, "")
+    c.execute(sql, (owner_id, created_at, comment_id, limit + 1))
+    comments = c.fetchall()
+
+    next_after = None
+    if len(comments) > limit:
+        last = comments[limit - 1]
+        next_after = [last["created_at"], last["comment_id"]]
+    return comments[:limit], next_after
+
+
+def search(conn, owner_id, match, limit, after=None):
+    """search - one page of the owner's projects and comments on them matching a
+    full-text query, best match first (bm25), then in index order (keyset pagination
+    on the bm25 score, then the search_docs doc_id). Changes still queued are not seen,
+    run flush_search() first
+    :param conn: (sqlite db connection) Active connection to the database
+    :param owner_id: (string) the owner's uuid
+    :param match: (string) FTS5 query, matched against project names and comment messages
+    :param limit: (int) max hits to return
+    :param after: [score, doc_id] next_after value from the previous page, None for the
+        first page
+    :return:
+        tuple ([records.SearchHit], next_after or None on the last page)
+    """
+    c = conn.cursor()
+    # the owner column narrows the match to the owner's rows inside the index, and the
+    # page is cut there too, so only limit hits are joined to their rows. The owner
+    # column has no weight in the score
+    sql = """SELECT search_docs.kind, projects.project_id, projects.project_name,
+                    comments.comment_id, comments.commenter_id, comments.commenter_username,
+                    comments.message, hits.score, hits.doc_id
+               FROM (SELECT doc_id, score
+                       FROM (SELECT rowid AS doc_id, bm25(search_fts, 0.0, 1.0) AS score
+                               FROM search_fts
+                               WHERE search_fts MATCH ?)
+                       WHERE (score, doc_id) > (?, ?)
+                       ORDER BY score, doc_id
+                       LIMIT ?) AS hits
+               INNER JOIN search_docs ON search_docs.doc_id = hits.doc_id
+               LEFT JOIN comments ON search_docs.kind = 'comment'
+                                 AND comments.comment_id = search_docs.key
+               INNER JOIN projects
+                       ON projects.project_id = COALESCE(comments.project_id, search_docs.key)
+               ORDER BY hits.score, hits.doc_id;"""
+    owner = '"' + owner_id.replace('"', '""') + '"'
+    score, doc_id = after or (float("-inf"), 0)
+    c.execute(sql, (f"owner : {owner} AND body : ({match})", score, doc_id, limit + 1))
+    rows = c.fetchall()
+
+    # the row factory leaves out the trailing score and doc_id columns
+    hit = records.row_factory(records.SearchHit)
+    next_after = list(rows[limit - 1][-2:]) if len(rows) > limit else None
+    return [hit(c, row) for row in rows[:limit]], next_after
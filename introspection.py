@@ -0,0 +1,296 @@
+"""
+introspection.py: Cached OAuth2 token introspection.
+The app calls introspect_token(); results come from a TTL/LRU cache in front of
+a backend, either the mock in auth.py or a remote RFC 7662 introspection endpoint.
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import ssl
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+import requests
+
+import auth
+import cache
+import config
+
+
+class IntrospectionError(Exception):
+    """Raised when the introspection backend cannot be reached or answers badly"""
+
+
+class IntrospectionBackend:
+    """Base class for token introspection backends"""
+
+    def introspect(self, access_token):
+        """introspect - look up an access token
+        :param access_token: (string) the bearer token
+        :return:
+            dict
+            {
+                "token_is_valid": <bool>,
+                "user_info": {"user_id": <uuid>, "username": <username>} or None,
+                "exp": <unix expiry time> (optional)
+            }
+        """
+        raise NotImplementedError
+
+    async def introspect_async(self, access_token):
+        """introspect_async - introspect() for the asyncio serving mode.
+        Backends doing network I/O should override this with non-blocking I/O,
+        the default runs introspect() on the loop's default executor.
+        :param access_token: (string) the bearer token
+        :return: token_info dict (see introspect)
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.introspect, access_token)
+
+
+class LocalBackend(IntrospectionBackend):
+    """Introspects against the hard coded tokens in auth.py"""
+
+    def introspect(self, access_token):
+        return auth.introspect_token(access_token)
+
+    async def introspect_async(self, access_token):
+        # in-process dict lookup, nothing to wait for
+        return auth.introspect_token(access_token)
+
+
+class HttpBackend(IntrospectionBackend):
+    """Introspects against a remote RFC 7662 endpoint
+
+    :param url: (string) the introspection endpoint
+    :param timeout: (float) request timeout in seconds
+    :param auth: optional (client_id, client_secret) for HTTP basic auth
+    """
+
+    def __init__(self, url, timeout=5.0, auth=None):
+        self.url = url
+        self.timeout = timeout
+        self.auth = auth
+        # keep-alive connections to the authorization server
+        self._session = requests.Session()
+
+    def introspect(self, access_token):
+        try:
+            r = self._session.post(self.url,
+                                   data={"token": access_token,
+                                         "token_type_hint": "access_token"},
+                                   headers={"Accept": "application/json"},
+                                   auth=self.auth,
+                                   timeout=self.timeout)
+            r.raise_for_status()
+            return from_rfc7662(r.json())
+        except (requests.RequestException, ValueError) as err:
+            raise IntrospectionError(f"{self.url}: {err}") from err
+
+    async def introspect_async(self, access_token):
+        body = urlencode({"token": access_token, "token_type_hint": "access_token"}).encode()
+        headers = {"Accept": "application/json",
+                   "Content-Type": "application/x-www-form-urlencoded"}
+        if self.auth:
+            credentials = base64.b64encode(":".join(self.auth).encode()).decode()
+            headers["Authorization"] = "Basic " + credentials
+        try:
+            status, payload = await asyncio.wait_for(
+                _post_async(self.url, body, headers), self.timeout)
+            if status != 200:
+                raise IntrospectionError(f"{self.url}: HTTP {status}")
+            return from_rfc7662(json.loads(payload))
+        except (OSError, asyncio.TimeoutError, ValueError) as err:
+            raise IntrospectionError(f"{self.url}: {err!r}") from err
+
+
+async def _post_async(url, body, headers):
+    """_post_async - minimal non-blocking HTTP/1.1 POST over asyncio streams
+    :param url: (string) http:// or https:// URL
+    :param body: (bytes) request body
+    :param headers: (dict) extra request headers
+    :return: tuple (status code, response body bytes)
+    """
+    parts = urlsplit(url)
+    tls = parts.scheme == "https"
+    port = parts.port or (443 if tls else 80)
+    reader, writer = await asyncio.open_connection(
+        parts.hostname, port, ssl=ssl.create_default_context() if tls else None)
+    try:
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        lines = [f"POST {path} HTTP/1.1",
+                 f"Host: {parts.netloc}",
+                 f"Content-Length: {len(body)}",
+                 "Connection: close"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        await writer.drain()
+
+        status = int((await reader.readline()).split()[1])
+        response_headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        if "content-length" in response_headers:
+            payload = await reader.readexactly(int(response_headers["content-length"]))
+        elif response_headers.get("transfer-encoding", "").lower() == "chunked":
+            payload = b""
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    break
+                payload += await reader.readexactly(size)
+                await reader.readline()
+        else:
+            payload = await reader.read()
+        return status, payload
+    finally:
+        writer.close()
+
+
+def from_rfc7662(body):
+    """from_rfc7662 - convert an RFC 7662 introspection response to a token_info dict
+    :param body: (dict) decoded JSON response, e.g. {"active": true, "sub": ..., "username": ..., "exp": ...}
+    :return: token_info dict (see IntrospectionBackend.introspect)
+    """
+    if not body.get("active"):
+        return {"token_is_valid": False, "user_info": None}
+
+    token_info = {"token_is_valid": True,
+                  "user_info": {"user_id": body["sub"],
+                                "username": body.get("username")}}
+    if "exp" in body:
+        token_info["exp"] = body["exp"]
+    return token_info
+
+
+class CachingIntrospector:
+    """CachingIntrospector - TTL/LRU cache in front of an introspection backend
+
+    Valid tokens are cached for ttl seconds, but never past their "exp".
+    Invalid tokens are cached for negative_ttl seconds. Backend errors are not cached.
+
+    :param backend: IntrospectionBackend
+    :param max_size: (int) max cached tokens
+    :param ttl: (float) seconds a valid token is cached
+    :param negative_ttl: (float) seconds an invalid token is cached
+    """
+
+    def __init__(self, backend, max_size=10000, ttl=60.0, negative_ttl=5.0):
+        self.backend = backend
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache = cache.LRUCache(max_size)
+        # asyncio mode: one backend call per token however many requests wait for it
+        self._inflight = {}
+
+    def introspect(self, access_token):
+        """introspect - cached lookup of an access token
+        :param access_token: (string) the bearer token
+        :return: token_info dict (see IntrospectionBackend.introspect)
+        """
+        key = _cache_key(access_token)
+        token_info = self.cache.get(key)
+        if token_info is None:
+            token_info = self.backend.introspect(access_token)
+            self.store(key, token_info)
+        return token_info
+
+    async def introspect_async(self, access_token):
+        """introspect_async - cached, non-blocking lookup of an access token
+        (for the asyncio serving mode, call it from the event loop thread)
+        :param access_token: (string) the bearer token
+        :return: token_info dict (see IntrospectionBackend.introspect)
+        """
+        key = _cache_key(access_token)
+        token_info = self.cache.get(key)
+        if token_info is not None:
+            return token_info
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        inflight = asyncio.ensure_future(self.backend.introspect_async(access_token))
+        self._inflight[key] = inflight
+        try:
+            token_info = await asyncio.shield(inflight)
+        finally:
+            del self._inflight[key]
+        self.store(key, token_info)
+        return token_info
+
+    def store(self, key, token_info):
+        """store - cache a backend answer for as long as it may be trusted
+        :param key: cache key from _cache_key()
+        :param token_info: token_info dict from the backend
+        :return: None
+        """
+        if not token_info["token_is_valid"]:
+            ttl = self.negative_ttl
+        else:
+            ttl = self.ttl
+            if "exp" in token_info:
+                ttl = min(ttl, token_info["exp"] - time.time())
+        if ttl > 0:
+            self.cache.set(key, token_info, ttl)
+
+
+def _cache_key(access_token):
+    """_cache_key - hash the token so raw bearer tokens are not kept in memory"""
+    return hashlib.sha256(access_token.encode()).digest()
+
+
+_introspector = None
+_introspector_lock = threading.Lock()
+
+
+def get_introspector():
+    """get_introspector - the process wide CachingIntrospector, built from config
+    :return: CachingIntrospector
+    """
+    global _introspector
+    if _introspector is None:
+        with _introspector_lock:
+            if _introspector is None:
+                if config.INTROSPECTION_URL:
+                    backend = HttpBackend(config.INTROSPECTION_URL,
+                                          timeout=config.INTROSPECTION_TIMEOUT)
+                else:
+                    backend = LocalBackend()
+                _introspector = CachingIntrospector(backend,
+                                                    max_size=config.TOKEN_CACHE_SIZE,
+                                                    ttl=config.TOKEN_CACHE_TTL,
+                                                    negative_ttl=config.TOKEN_CACHE_NEGATIVE_TTL)
+    return _introspector
+
+
+def set_introspector(introspector):
+    """set_introspector - replace the process wide introspector (tests, custom backends)
+    :param introspector: CachingIntrospector, or None to rebuild it from config
+    :return: None
+    """
+    global _introspector
+    with _introspector_lock:
+        _introspector = introspector
+
+
+def introspect_token(access_token):
+    """introspect_token - cached drop-in for auth.introspect_token
+    :param access_token: (string) the bearer token
+    :return: token_info dict (see IntrospectionBackend.introspect)
+    """
+    return get_introspector().introspect(access_token)
+
+
+async def introspect_token_async(access_token):
+    """introspect_token_async - introspect_token() as non-blocking I/O, for the asyncio serving mode
+    :param access_token: (string) the bearer token
+    :return: token_info dict (see IntrospectionBackend.introspect)
+    """
+    return await get_introspector().introspect_async(access_token)
@@ -0,0 +1,88 @@
+"""
+introspection_server.py: Local stand-in for an RFC 7662 token introspection server.
+Answers POST /introspect from the hard coded tokens in auth.py, for tests and local runs:
+
+    python introspection_server.py [port]
+    SAMPLE_REST_INTROSPECTION_URL=http://127.0.0.1:8900/introspect python app.py
+"""
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import auth
+
+# lifetime of the tokens handed out by the stand-in server
+TOKEN_LIFETIME = 3600
+
+
+class IntrospectionHandler(BaseHTTPRequestHandler):
+    """Handles POST /introspect (token=<access token>)"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        if self.path != "/introspect":
+            self.send_error(404)
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        token = form.get("token", [""])[0]
+
+        self.server.request_count += 1
+        if self.server.delay:
+            time.sleep(self.server.delay)  # simulate a slow authorization server
+        token_info = auth.introspect_token(token)
+        if token_info["token_is_valid"]:
+            body = {"active": True,
+                    "sub": token_info["user_info"]["user_id"],
+                    "username": token_info["user_info"]["username"],
+                    "token_type": "Bearer",
+                    "exp": int(time.time()) + self.server.token_lifetime}
+        else:
+            body = {"active": False}
+
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class IntrospectionServer(ThreadingHTTPServer):
+    """IntrospectionServer - accepts bursts of concurrent connections (the default
+    listen backlog of 5 would make the rest retry after a second)"""
+    request_queue_size = 128
+
+
+def start_server(host="127.0.0.1", port=0, token_lifetime=TOKEN_LIFETIME, delay=0.0):
+    """start_server - run the stand-in server on a background thread
+    :param host: (string) interface to bind
+    :param port: (int) port to bind, 0 picks a free one
+    :param token_lifetime: (int) seconds until the returned "exp"
+    :param delay: (float) seconds to wait before answering each request
+    :return: the server; its url attribute is the introspection endpoint,
+        request_count counts the introspection calls it answered
+    """
+    server = IntrospectionServer((host, port), IntrospectionHandler)
+    server.daemon_threads = True
+    server.request_count = 0
+    server.token_lifetime = token_lifetime
+    server.delay = delay
+    server.url = f"http://{host}:{server.server_address[1]}/introspect"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8900
+    server = start_server(port=port)
+    print(f"introspection server at {server.url}")
+    threading.Event().wait()
@@ -0,0 +1,243 @@
+"""
+metrics.py: Per-request performance metrics in the Prometheus text format
+
+app.py and asgi_app.py time every request with a RequestTiming: total latency,
+time in token introspection, time in sqlite, SQL statements run and rows fetched
+(the last three counted by the db.py cursor). observe_request() adds them to the
+histograms below, labelled by route, and GET /metrics renders them for scraping.
+"""
+import contextlib
+import threading
+import time
+
+# seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# statements / rows per request
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 1000, 10000, 100000)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    """_escape - a label value as the text format wants it"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    """_labels - render {name="value",...}, empty string without labels"""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    """_number - a sample value, integers without a trailing .0"""
+    if value == float("inf"):
+        return "+Inf"
+    return repr(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """Counter - a monotonically increasing count per label set
+
+    :param name: (string) metric name
+    :param documentation: (string) HELP text
+    :param labels: tuple of label names
+    """
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        """inc - add amount to the count for label_values (in the order of labels)"""
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        """value - current count for label_values, 0 if never increased"""
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def render(self):
+        """render - the sample lines of this metric
+        :return: list of strings
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labels, key)} {_number(value)}" for key, value in values]
+
+
+class Histogram:
+    """Histogram - observations counted into cumulative buckets per label set
+
+    :param name: (string) metric name
+    :param documentation: (string) HELP text
+    :param labels: tuple of label names
+    :param buckets: increasing upper bounds; +Inf is added
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """observe - count value into the buckets for label_values (in the order of labels)"""
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                # [count per bucket (not cumulative)..., sum]
+                series = self._values[label_values] = [0] * len(self.buckets) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            series[-1] += value
+
+    def count(self, *label_values):
+        """count - observations for label_values"""
+        with self._lock:
+            series = self._values.get(label_values)
+            return sum(series[:-1]) if series else 0
+
+    def render(self):
+        """render - the _bucket, _sum and _count sample lines of this metric
+        :return: list of strings
+        """
+        with self._lock:
+            values = sorted((key, list(series)) for key, series in self._values.items())
+        lines = []
+        for key, series in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                labels = _labels(self.labels, key, [("le", _number(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_number(series[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Registry - the metrics rendered by GET /metrics"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        """register - add a metric
+        :return: the metric
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """render - every metric in the Prometheus text exposition format
+        :return: (string)
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter(
+    "sample_rest_requests_total", "Requests handled",
+    ("method", "route", "status")))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "sample_rest_request_duration_seconds", "Request latency, streamed bodies included",
+    ("method", "route")))
+INTROSPECTION_SECONDS = REGISTRY.register(Histogram(
+    "sample_rest_request_introspection_seconds", "Time per request in token introspection",
+    ("method", "route")))
+SQL_SECONDS = REGISTRY.register(Histogram(
+    "sample_rest_request_sql_seconds", "Time per request in sqlite (execute and fetch)",
+    ("method", "route")))
+SQL_STATEMENTS = REGISTRY.register(Histogram(
+    "sample_rest_request_sql_statements", "SQL statements run per request",
+    ("method", "route"), COUNT_BUCKETS))
+SQL_ROWS = REGISTRY.register(Histogram(
+    "sample_rest_request_sql_rows", "Rows fetched from sqlite per request",
+    ("method", "route"), COUNT_BUCKETS))
+
+
+class RequestTiming:
+    """RequestTiming - where one request spent its time; started when created"""
+    __slots__ = ("started", "introspection_seconds", "sql_seconds", "statements", "rows")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.introspection_seconds = 0.0
+        self.sql_seconds = 0.0
+        self.statements = 0
+        self.rows = 0
+
+    @contextlib.contextmanager
+    def introspection(self):
+        """introspection - context manager adding its duration to introspection_seconds"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.introspection_seconds += time.perf_counter() - started
+
+    def add_sql(self, statements, seconds, rows):
+        """add_sql - add sqlite work (see db.get_query_stats)"""
+        self.statements += statements
+        self.sql_seconds += seconds
+        self.rows += rows
+
+    def set_sql(self, statements, seconds, rows):
+        """set_sql - set the sqlite work to a running total (see db.get_query_stats)"""
+        self.statements = statements
+        self.sql_seconds = seconds
+        self.rows = rows
+
+    def elapsed(self):
+        """elapsed - seconds since the request started"""
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """server_timing - Server-Timing header value, durations in milliseconds so far
+        :return: (string)
+        """
+        return (f"introspection;dur={self.introspection_seconds * 1000:.3f}, "
+                f'sql;dur={self.sql_seconds * 1000:.3f};desc="{self.statements} statements, '
+                f'{self.rows} rows", '
+                f"total;dur={self.elapsed() * 1000:.3f}")
+
+
+def observe_request(method, route, status, timing):
+    """observe_request - record a finished request
+    :param method: (string) HTTP method
+    :param route: (string) route pattern, e.g. /projects/<project_id>, not the raw path
+    :param status: (int) HTTP status
+    :param timing: RequestTiming of the request
+    :return: None
+    """
+    REQUESTS.inc(method, route, str(status))
+    REQUEST_SECONDS.observe(timing.elapsed(), method, route)
+    INTROSPECTION_SECONDS.observe(timing.introspection_seconds, method, route)
+    SQL_SECONDS.observe(timing.sql_seconds, method, route)
+    SQL_STATEMENTS.observe(timing.statements, method, route)
+    SQL_ROWS.observe(timing.rows, method, route)
+
+
+def render():
+    """render - the registered metrics, for GET /metrics
+    :return: (string) Prometheus text exposition format
+    """
+    return REGISTRY.render()
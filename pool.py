@@ -0,0 +1,206 @@
+"""
+pool.py: A small, thread safe pool of reusable sqlite connections
+"""
+import sqlite3
+import threading
+import time
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out before the timeout"""
+
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection that goes back to its pool instead of being dropped.
+
+    Used as a context manager it behaves like a plain sqlite3 connection
+    (commit on success, rollback on error) and is then returned to the pool.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool = None
+        self.released_at = time.monotonic()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            return super().__exit__(exc_type, exc_value, traceback)
+        finally:
+            self.release()
+
+    def release(self):
+        """release - hand the connection back to the pool it was checked out from
+        :return: None
+        """
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.release(self)
+
+
+class ConnectionPool:
+    """ConnectionPool - check out / return sqlite connections
+
+    :param connect: callable returning a new PooledConnection
+    :param max_size: (int) maximum number of open connections (idle + in use)
+    :param idle_timeout: (float) seconds an idle connection is kept before it is closed
+    :param acquire_timeout: (float) seconds acquire() waits for a free connection
+    :param health_check_after: (float) idle seconds after which a connection is
+        pinged with "SELECT 1" before being handed out
+    """
+
+    def __init__(self, connect, max_size=8, idle_timeout=300.0,
+                 acquire_timeout=30.0, health_check_after=30.0):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self._connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self.health_check_after = health_check_after
+
+        self._cond = threading.Condition()
+        self._idle = []  # LIFO stack, most recently released last
+        self._size = 0
+        self._closed = False
+        self._stats = {"created": 0, "reused": 0, "evicted": 0,
+                       "discarded": 0, "waits": 0, "timeouts": 0}
+
+    def acquire(self, timeout=None):
+        """acquire - check out a connection, opening a new one if below max_size
+        :param timeout: (float) seconds to wait, defaults to acquire_timeout
+        :return: a PooledConnection owned by the caller until release()
+        """
+        timeout = self.acquire_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+
+        while True:
+            conn = self._checkout(deadline)
+            if conn is None:
+                conn = self._open()
+            elif not self._healthy(conn):
+                self._discard(conn)
+                continue
+            else:
+                with self._cond:
+                    self._stats["reused"] += 1
+            conn._pool = self
+            return conn
+
+    def release(self, conn):
+        """release - return a connection to the idle stack
+        :param conn: a connection previously returned by acquire()
+        :return: None
+        """
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.ProgrammingError:
+            # closed by the caller
+            self._discard(conn)
+            return
+
+        with self._cond:
+            if self._closed:
+                self._size -= 1
+                conn.close()
+                return
+            conn.released_at = time.monotonic()
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def close(self):
+        """close - close every idle connection; in-use ones are closed on release
+        :return: None
+        """
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        """stats - pool counters for diagnostics
+        :return: dict of sizes and lifetime counters
+        """
+        with self._cond:
+            result = {"max_size": self.max_size,
+                      "size": self._size,
+                      "idle": len(self._idle),
+                      "in_use": self._size - len(self._idle)}
+            result.update(self._stats)
+        return result
+
+    def _checkout(self, deadline):
+        """_checkout - take an idle connection or reserve a slot for a new one
+        :return: an idle connection, or None when the caller should open one
+        """
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout("connection pool is closed")
+                self._evict_idle()
+                if self._idle:
+                    return self._idle.pop()
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(
+                        f"no connection available after waiting; max_size={self.max_size}")
+                self._stats["waits"] += 1
+                self._cond.wait(remaining)
+
+    def _open(self):
+        """_open - open a new connection in a slot reserved by _checkout()"""
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._stats["created"] += 1
+        return conn
+
+    def _evict_idle(self):
+        """_evict_idle - close connections idle for longer than idle_timeout
+        (caller holds the lock)
+        """
+        cutoff = time.monotonic() - self.idle_timeout
+        # The stack is ordered by release time, so stale entries sit at the bottom
+        stale = 0
+        while stale < len(self._idle) and self._idle[stale].released_at < cutoff:
+            stale += 1
+        if stale:
+            evicted, self._idle = self._idle[:stale], self._idle[stale:]
+            self._size -= stale
+            self._stats["evicted"] += stale
+            for conn in evicted:
+                conn.close()
+
+    def _healthy(self, conn):
+        """_healthy - ping connections that have been idle for a while"""
+        if time.monotonic() - conn.released_at < self.health_check_after:
+            return True
+        try:
+            conn.execute("SELECT 1;").fetchall()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def _discard(self, conn):
+        """_discard - drop a broken connection and free its slot"""
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._stats["discarded"] += 1
+            self._cond.notify()
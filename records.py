@@ -0,0 +1,89 @@
+"""
+records.py: Row types returned by the db.py reads
+
+Each type names its columns once, in SELECT order. db.py selects exactly those
+columns and sets row_factory(Type) on the cursor, so rows come out of sqlite
+already as the dicts the API returns: fields are read by name rather than by
+position, and response bodies encode them without another copy.
+"""
+import functools
+from typing import TypedDict
+
+
+class Owner(TypedDict):
+    owner_id: str
+    owner_username: str
+
+
+class Project(TypedDict):
+    """a project as listed, without its owner and comments (see db.get_project)"""
+    project_id: str
+    project_name: str
+
+
+class Comment(TypedDict):
+    comment_id: str
+    commenter_id: str
+    commenter_username: str
+    message: str
+
+
+class OwnerComment(TypedDict):
+    """a comment on one of an owner's projects (see db.get_owner_comments)"""
+    project_id: str
+    project_name: str
+    comment_id: str
+    commenter_id: str
+    commenter_username: str
+    message: str
+
+
+class FeedComment(TypedDict):
+    """a comment in an owner's activity feed (see db.get_owner_comments_page)"""
+    project_id: str
+    project_name: str
+    comment_id: str
+    commenter_id: str
+    commenter_username: str
+    message: str
+    created_at: int
+
+
+class SearchHit(TypedDict):
+    """a full-text search match (see db.search): a project by its name, or a comment
+    by its message, the comment fields None for a project"""
+    type: str
+    project_id: str
+    project_name: str
+    comment_id: str
+    commenter_id: str
+    commenter_username: str
+    message: str
+
+
+def fields(row_type):
+    """fields - the field names of a row type, in SELECT order
+    :param row_type: one of the TypedDict row types above
+    :return: tuple of strings
+    """
+    return tuple(row_type.__annotations__)
+
+
+def columns(row_type, table=None):
+    """columns - the SELECT list for a row type
+    :param row_type: one of the TypedDict row types above
+    :param table: (string) table or alias to qualify the columns with
+    :return: (string) comma separated column names
+    """
+    prefix = f"{table}." if table else ""
+    return ", ".join(prefix + name for name in fields(row_type))
+
+
+@functools.cache
+def row_factory(row_type):
+    """row_factory - sqlite3 row_factory building row_type dicts from rows of columns(row_type)
+    :param row_type: one of the TypedDict row types above
+    :return: callable(cursor, row) returning a dict
+    """
+    names = fields(row_type)
+    return lambda cursor, row: dict(zip(names, row))
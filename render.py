@@ -0,0 +1,88 @@
+"""
+render.py: JSON encoding of every response body
+
+Encodes straight to compact UTF-8 bytes with orjson when it is installed (an
+optional dependency), or with the standard library json module otherwise.
+config.JSON_SERIALIZER picks one explicitly.
+"""
+import json
+import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_dumps(obj):
+    """_json_dumps - standard library encoder, same output shape as orjson"""
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+# serializer name -> callable(obj) returning bytes
+SERIALIZERS = {"json": _json_dumps}
+if orjson is not None:
+    SERIALIZERS["orjson"] = orjson.dumps
+
+_serializer = None
+_dumps = None
+
+
+def set_serializer(name=None):
+    """set_serializer - choose the encoder used by dumps()
+    :param name: (string) "auto" (orjson if installed, else json), or a key of
+        SERIALIZERS; defaults to config.JSON_SERIALIZER
+    :return: (string) name of the serializer now in use
+    """
+    global _serializer, _dumps
+    name = name or config.JSON_SERIALIZER
+    if name == "auto":
+        name = "orjson" if "orjson" in SERIALIZERS else "json"
+    try:
+        _dumps = SERIALIZERS[name]
+    except KeyError:
+        raise ValueError(f"unknown JSON serializer {name!r}, "
+                         f"expected 'auto' or one of {sorted(SERIALIZERS)}") from None
+    _serializer = name
+    return name
+
+
+def get_serializer():
+    """get_serializer - name of the serializer in use
+    :return: (string) a key of SERIALIZERS
+    """
+    return _serializer
+
+
+def dumps(obj):
+    """dumps - encode a JSON serializable object
+    :param obj: dicts, lists, strings, numbers, booleans and None
+    :return: bytes, compact UTF-8 JSON
+    """
+    return _dumps(obj)
+
+
+def stream_json(head, list_key, batches, tail=None):
+    """stream_json - yield the JSON of head + {list_key: [...]} + tail,
+    one fragment per batch, so a large list is never held in memory at once
+    :param head: (dict) fields written before the list
+    :param list_key: (string) name of the list field
+    :param batches: iterable of lists of JSON serializable items
+    :param tail: (dict) fields written after the list
+    :return: generator of bytes fragments
+    """
+    fields = _dumps(head)[1:-1]
+    yield b"{" + fields + (b"," if fields else b"") + _dumps(list_key) + b":["
+
+    separator = b""
+    for batch in batches:
+        if batch:
+            # one encoder call per batch, without the enclosing brackets
+            yield separator + _dumps(batch)[1:-1]
+            separator = b","
+
+    fields = _dumps(tail or {})[1:-1]
+    yield b"]" + (b"," + fields if fields else b"") + b"}"
+
+
+set_serializer()
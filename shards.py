@@ -0,0 +1,298 @@
+"""
+shards.py: Owner based sharding across several sqlite database files
+
+Each owner's projects, with their comments, live in one shard, so the writes of
+different owners go through different sqlite write locks. shard_for_owner() picks
+the shard from a stable hash of the owner_id: every process computes the same
+answer without a directory table. The owners table is small and is copied to
+every shard, so a comment by an owner of another shard and the owner lookups work
+on any shard.
+
+config.SHARD_COUNT sets the number of shards; shard 0 is config.DATABASE (see
+db.shard_databases), so 1 shard is the unsharded database. After changing the
+count, move the data with rebalance():
+
+    python shards.py --shards 4 [--database sample-rest.db]
+"""
+import argparse
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+
+import api
+import cache
+import config
+import datagen
+import db
+
+log = logging.getLogger(__name__)
+
+# project_id -> shard, see shard_for_project(). Projects only move in rebalance()
+_project_shards = cache.LRUCache(config.PROJECT_SHARD_CACHE_SIZE)
+
+
+def shard_for_owner(owner_id, count=None):
+    """shard_for_owner - the shard holding an owner's projects and comments
+    :param owner_id: (string) the owner's uuid
+    :param count: (int) number of shards, defaults to the shards the pools were created for
+    :return: (int) shard number
+    """
+    count = count or db.get_shard_count()
+    if count == 1:
+        return 0
+    digest = hashlib.blake2b(owner_id.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % count
+
+
+def has_project(conn, project_id):
+    """has_project - does the shard conn is open on hold a project
+    :param conn: sqlite connection to one shard
+    :param project_id: (string) the project's uuid
+    :return: bool
+    """
+    return conn.execute("SELECT 1 FROM projects WHERE project_id=?;",
+                        (project_id,)).fetchone() is not None
+
+
+def cached_shard_for_project(project_id):
+    """cached_shard_for_project - the shard of a project if known without a lookup
+    :param project_id: (string) the project's uuid
+    :return: (int) shard number, None if it has to be looked up (see shard_for_project)
+    """
+    if db.get_shard_count() == 1:
+        return 0
+    return _project_shards.get(project_id)
+
+
+def remember_project(project_id, shard):
+    """remember_project - cache the shard a project was found in
+    :param project_id: (string) the project's uuid
+    :param shard: (int) shard number
+    :return: None
+    """
+    _project_shards.set(project_id, shard)
+
+
+def shard_for_project(project_id):
+    """shard_for_project - the shard holding a project, for the routes that only know
+    the project_id (adding comments). Looked up in every shard once, then cached
+    :param project_id: (string) the project's uuid
+    :return: (int) shard number, None if no shard holds the project. With a single
+        shard this is always 0, without a lookup
+    """
+    shard = cached_shard_for_project(project_id)
+    if shard is not None:
+        return shard
+    for shard in range(db.get_shard_count()):
+        with db.connect_db(readonly=True, shard=shard) as conn:
+            found = has_project(conn, project_id)
+        if found:
+            remember_project(project_id, shard)
+            return shard
+    return None
+
+
+def forget_project(project_id=None):
+    """forget_project - drop a project's cached shard, or with None every project's
+    :param project_id: (string) the project's uuid
+    :return: None
+    """
+    if project_id is None:
+        _project_shards.clear()
+    else:
+        _project_shards.delete(project_id)
+
+
+def connect_owner(owner_id, readonly=False):
+    """connect_owner - check out a connection to the shard of an owner (see db.connect_db)
+    :param owner_id: (string) the owner's uuid
+    :param readonly: (bool) check out a read-only connection
+    :return: sqlite database connection (pool.PooledConnection)
+    """
+    return db.connect_db(readonly=readonly, shard=shard_for_owner(owner_id))
+
+
+def initialize_db():
+    """initialize_db - create the tables and apply the migrations in every shard
+    :return: None
+    """
+    for shard in range(db.get_shard_count()):
+        with db.connect_db(shard=shard) as conn:
+            db.initialize_db(conn)
+
+
+def get_num_projects():
+    """get_num_projects - number of projects in all shards
+    :return: {"project_count": <count>}
+    """
+    total = 0
+    for shard in range(db.get_shard_count()):
+        with db.connect_db(readonly=True, shard=shard) as conn:
+            total += api.get_num_projects(conn)["project_count"]
+    return {"project_count": total}
+
+
+def load(conn, sizes):
+    """load - replace the data in every shard with the fixtures or a generated dataset
+    (see datagen.load): it is loaded into shard 0, then spread by rebalance()
+    :param conn: sqlite connection to shard 0
+    :param sizes: see datagen.load
+    :return: dict {"owners": <count>, "projects": <count>, "comments": <count>}
+    """
+    databases = db.get_shard_databases()
+    for shard in range(1, len(databases)):
+        with db.connect_db(shard=shard) as shard_conn:
+            for table in ("comments", "projects", "owners"):
+                shard_conn.execute(f"DELETE FROM {table};")
+    counts = datagen.load(conn, sizes)
+    if len(databases) > 1:
+        conn.commit()
+        rebalance(databases[0], len(databases))
+    forget_project()
+    return counts
+
+
+def _connect(path):
+    """_connect - a plain autocommit connection for rebalance()"""
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA foreign_keys = ON;")
+    db.apply_storage_profile(conn)
+    return conn
+
+
+def _columns(conn, table):
+    """_columns - comma separated column list of a table, as the migrations left it"""
+    return ", ".join(row[1] for row in conn.execute(f"PRAGMA table_info({table});"))
+
+
+def rebalance(database=None, count=None):
+    """rebalance - move every owner's projects and comments to the shard
+    shard_for_owner() gives them for count shards, and copy the owners to every shard.
+    Shard files beyond count (left from a larger count) are emptied, not deleted.
+    Each owner group is copied, committed, then deleted from its old shard, so an
+    interrupted rebalance can simply be run again.
+    :param database: (string) shard 0 sqlite file, defaults to config.DATABASE
+    :param count: (int) number of shards, defaults to config.SHARD_COUNT
+    :return: dict {"owners": <owners>, "projects": <moved>, "comments": <moved>}
+    """
+    count = count or config.SHARD_COUNT
+    targets = db.shard_databases(database, count)
+    sources = list(targets)
+    while True:
+        extra = db.shard_databases(database, len(sources) + 1)[-1]
+        if not os.path.exists(extra):
+            break
+        sources.append(extra)
+
+    for path in targets:
+        conn = _connect(path)
+        try:
+            db.initialize_db(conn)
+        finally:
+            conn.close()
+
+    # the owners of every shard, copied to every shard
+    owners = {}
+    for path in sources:
+        conn = _connect(path)
+        try:
+            owners.update(conn.execute("SELECT owner_id, owner_username FROM owners;").fetchall())
+        finally:
+            conn.close()
+    for path in targets:
+        conn = _connect(path)
+        try:
+            conn.execute("BEGIN;")
+            conn.executemany("""INSERT INTO owners (owner_id, owner_username) VALUES (?,?)
+                                  ON CONFLICT (owner_id) DO NOTHING;""", owners.items())
+            conn.execute("COMMIT;")
+        finally:
+            conn.close()
+
+    moved = {"owners": len(owners), "projects": 0, "comments": 0}
+    for source, path in enumerate(sources):
+        conn = _connect(path)
+        try:
+            moving = {}
+            for owner_id, in conn.execute("SELECT DISTINCT owner_id FROM projects;").fetchall():
+                target = shard_for_owner(owner_id, count)
+                if target != source:
+                    moving.setdefault(target, []).append(owner_id)
+
+            for target, owner_ids in sorted(moving.items()):
+                for key, value in _move(conn, targets[target], owner_ids).items():
+                    moved[key] += value
+                log.info("moved %d owners from shard %d to shard %d", len(owner_ids), source, target)
+        finally:
+            conn.close()
+
+    forget_project()
+    api.invalidate_project()
+    db.invalidate_owner()
+    return moved
+
+
+def _move(conn, target_path, owner_ids):
+    """_move - copy the owners' projects and comments to the target shard, then delete them
+    :param conn: _connect() connection to the source shard
+    :param target_path: (string) target shard file
+    :param owner_ids: owners to move
+    :return: dict {"projects": <moved>, "comments": <moved>}
+    """
+    conn.execute("ATTACH DATABASE ? AS target;", (target_path,))
+    try:
+        conn.execute("CREATE TEMP TABLE moving (owner_id TEXT PRIMARY KEY);")
+        conn.executemany("INSERT INTO temp.moving (owner_id) VALUES (?);",
+                         ((owner_id,) for owner_id in owner_ids))
+        project_columns = _columns(conn, "projects")
+        comment_columns = _columns(conn, "comments")
+
+        # copied first (with the target's triggers keeping its counters), deleted after
+        conn.execute("BEGIN;")
+        projects = conn.execute(f"""
+            INSERT INTO target.projects ({project_columns})
+              SELECT {project_columns} FROM main.projects
+                WHERE owner_id IN (SELECT owner_id FROM temp.moving)
+              ON CONFLICT (project_id) DO NOTHING;""").rowcount
+        comments = conn.execute(f"""
+            INSERT INTO target.comments ({comment_columns})
+              SELECT {comment_columns} FROM main.comments
+                WHERE project_id IN (SELECT project_id FROM main.projects
+                                       WHERE owner_id IN (SELECT owner_id FROM temp.moving))
+              ON CONFLICT (comment_id) DO NOTHING;""").rowcount
+        conn.execute("COMMIT;")
+
+        # comments go with their projects (ON DELETE CASCADE)
+        conn.execute("BEGIN;")
+        conn.execute("""DELETE FROM main.projects
+                          WHERE owner_id IN (SELECT owner_id FROM temp.moving);""")
+        conn.execute("COMMIT;")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK;")
+        raise
+    finally:
+        conn.execute("DROP TABLE IF EXISTS temp.moving;")
+        conn.execute("DETACH DATABASE target;")
+    return {"projects": projects, "comments": comments}
+
+
+def main(argv=None):
+    """main - command line entry point, see the module docstring"""
+    parser = argparse.ArgumentParser(description="Move owners' data to their shards")
+    parser.add_argument("--shards", type=int, default=config.SHARD_COUNT,
+                        help="number of shards (default: config.SHARD_COUNT)")
+    parser.add_argument("--database", help="shard 0 sqlite file (default: config.DATABASE)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    start = time.perf_counter()
+    moved = rebalance(args.database, args.shards)
+    log.info("rebalanced to %d shards: %s in %.1fs", args.shards, moved,
+             time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
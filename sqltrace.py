@@ -0,0 +1,213 @@
+"""
+sqltrace.py: SQL statement log, query plans and slow query logging
+
+A Tracer is attached to every connection db.py opens while it is installed
+(db.set_tracer, or SAMPLE_REST_SQL_TRACE=1). sqlite's trace callback hands it the
+text of each statement as sqlite runs it, bound values filled in, and the db.py
+cursor hands it the time spent executing and fetching. Each statement is logged
+with its duration (logger "sqltrace", DEBUG), statements slower than
+slow_threshold are logged as warnings with their plan, and the first time a
+distinct statement runs its EXPLAIN QUERY PLAN is captured.
+
+    tracer = sqltrace.Tracer(slow_threshold=0.05)
+    db.set_tracer(tracer)
+    ...
+    tracer.flush()
+    assert not tracer.scans()
+"""
+import logging
+import sqlite3
+import threading
+
+log = logging.getLogger(__name__)
+
+# statements EXPLAIN QUERY PLAN is run for
+_EXPLAINED = ("SELECT", "WITH", "INSERT", "REPLACE", "UPDATE", "DELETE")
+
+
+class Tracer:
+    """Tracer - per statement timing, logging and query plans
+
+    :param slow_threshold: (float) seconds; slower statements are logged as warnings,
+        None logs none
+    :param explain: (bool) capture EXPLAIN QUERY PLAN for each distinct statement
+    """
+
+    def __init__(self, slow_threshold=0.1, explain=True):
+        self.slow_threshold = slow_threshold
+        self.explain = explain
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # statement text (with ? placeholders) -> stats dict, see statements()
+        self._statements = {}
+
+    def attach(self, conn):
+        """attach - trace the statements sqlite runs on a connection
+        :param conn: sqlite connection
+        :return: None
+        """
+        conn.set_trace_callback(self._traced)
+
+    def starting(self, sql):
+        """starting - a statement is about to be executed; called by the db.py cursor
+        :param sql: (string) the statement, with its placeholders
+        :return: None
+        """
+        local = self._local
+        local.text = None
+        local.prefix = sql.split("?", 1)[0]
+
+    def _traced(self, text):
+        """_traced - sqlite trace callback: the statement about to run, values bound.
+        sqlite also calls back for the implicit BEGIN before it and for the statements
+        its triggers and FTS5 run inside it, so only the first text that reads like the
+        statement up to its first placeholder is kept (executemany calls back per row)"""
+        local = self._local
+        prefix = getattr(local, "prefix", None)
+        if prefix is not None and local.text is None and text.startswith(prefix):
+            local.text = text
+
+    def executed(self, conn, sql, parameters, seconds):
+        """executed - a statement was executed on conn; called by the db.py cursor
+        :param conn: the connection it ran on
+        :param sql: (string) the statement, with its placeholders
+        :param parameters: its parameters, None for executemany
+        :param seconds: (float) time spent in execute
+        :return: None
+        """
+        local = self._local
+        self._finish(local)
+        text = getattr(local, "text", None) or sql
+        local.text = local.prefix = None
+        local.current = [sql, text, seconds]
+
+        with self._lock:
+            new = sql not in self._statements
+            stats = self._stats(sql)
+        if new and self.explain and parameters is not None:
+            stats["plan"] = explain(conn, sql, parameters)
+
+    def fetched(self, seconds):
+        """fetched - rows of the current statement were fetched; called by the db.py cursor
+        :param seconds: (float) time spent in the fetch call
+        :return: None
+        """
+        current = getattr(self._local, "current", None)
+        if current is not None:
+            current[2] += seconds
+
+    def flush(self):
+        """flush - log and count the current thread's last statement; the others are
+        counted when the next statement starts (fetches add to a statement's time)
+        :return: None
+        """
+        self._finish(self._local)
+
+    def _finish(self, local):
+        """_finish - log and count the statement local is timing, if any"""
+        current = getattr(local, "current", None)
+        if current is None:
+            return
+        local.current = None
+        sql, text, seconds = current
+
+        with self._lock:
+            stats = self._stats(sql)
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            plan = stats["plan"]
+
+        log.debug("%.3f ms %s", seconds * 1000, text)
+        if self.slow_threshold is not None and seconds >= self.slow_threshold:
+            log.warning("slow query, %.3f ms: %s\n%s", seconds * 1000, text,
+                        "\n".join(plan or ["(no query plan)"]))
+
+    def _stats(self, sql):
+        """_stats - the stats dict of a statement, created empty; call with _lock held"""
+        stats = self._statements.get(sql)
+        if stats is None:
+            stats = self._statements[sql] = {"calls": 0, "seconds": 0.0, "max_seconds": 0.0,
+                                             "plan": None}
+        return stats
+
+    def statements(self):
+        """statements - every distinct statement seen
+        :return: dict {statement: {"calls", "seconds", "max_seconds",
+            "plan": list of EXPLAIN QUERY PLAN lines, None if not explained}}
+        """
+        with self._lock:
+            return {sql: dict(stats) for sql, stats in self._statements.items()}
+
+    def slowest(self, count=10):
+        """slowest - the statements with the most total time
+        :param count: (int) max statements
+        :return: list of dicts with "sql" and the statements() stats
+        """
+        ranked = sorted(self.statements().items(), key=lambda item: -item[1]["seconds"])
+        return [dict(stats, sql=sql) for sql, stats in ranked[:count]]
+
+    def scans(self):
+        """scans - the statements whose query plan reads a whole table or index
+        :return: dict {statement: list of its SCAN plan lines}
+        """
+        result = {}
+        for sql, stats in self.statements().items():
+            plan = stats["plan"] or ()
+            subqueries = {line.split()[1] for line in plan
+                          if line.strip().startswith(("MATERIALIZE ", "CO-ROUTINE "))}
+            lines = [line for line in plan if is_scan(line, subqueries)]
+            if lines:
+                result[sql] = lines
+        return result
+
+    def reset(self):
+        """reset - forget the statements seen so far
+        :return: None
+        """
+        with self._lock:
+            self._statements.clear()
+
+
+def explain(conn, sql, parameters=()):
+    """explain - EXPLAIN QUERY PLAN of a statement
+    :param conn: sqlite connection
+    :param sql: (string) the statement
+    :param parameters: its parameters
+    :return: list of plan lines, indented by depth; None if it cannot be explained
+    """
+    if not sql.lstrip().upper().startswith(_EXPLAINED):
+        return None
+    try:
+        # a plain cursor, so explaining is not itself counted and traced
+        rows = sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    except sqlite3.Error as err:
+        log.debug("cannot explain %s: %s", sql, err)
+        return None
+
+    depth = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node_id] + detail)
+    return lines
+
+
+def is_scan(line, subqueries=()):
+    """is_scan - does a query plan line read a whole table or index (SCAN) rather
+    than look rows up (SEARCH). sqlite reports every virtual table as a SCAN; one is
+    only a full read when no constraint went to its module (an empty idxStr, as in
+    "INDEX 0:"), FTS5 MATCH lookups show as e.g. "VIRTUAL TABLE INDEX 0:M1"
+    :param line: (string) a line from explain()
+    :param subqueries: names of the plan's MATERIALIZE / CO-ROUTINE subqueries, whose
+        rows the query already narrowed down (a SCAN of one reads no table)
+    :return: bool
+    """
+    detail = line.strip()
+    if not detail.startswith("SCAN ") or detail == "SCAN CONSTANT ROW":
+        return False
+    if detail.split()[1] in subqueries:
+        return False
+    if " VIRTUAL TABLE INDEX " in detail:
+        return detail.endswith(":")
+    return True
@@ -36,3 +36,332 @@ SQL = {"owners": """CREATE TABLE IF NOT EXISTS owners
                 INNER JOIN comments ON projects.project_id = comments.project_id;
              """
        }
+
+# Recompute the trigger-maintained project counters (migration 2) from the projects table,
+# after the triggers were dropped for a bulk load (see db.rebuild_counters)
+REBUILD_COUNTERS = (
+    """DELETE FROM table_counts WHERE table_name = 'projects';""",
+    """INSERT INTO table_counts (table_name, row_count)
+         SELECT 'projects', COUNT(*) FROM projects;
+    """,
+    """DELETE FROM owner_project_counts;""",
+    """INSERT INTO owner_project_counts (owner_id, project_count)
+         SELECT owner_id, COUNT(*) FROM projects GROUP BY owner_id;
+    """,
+)
+
+# Index the projects and comments the search triggers (migration 4) queued in search_queue:
+# drop their old entries, then add the ones still there, all in the caller's transaction
+# (see db.flush_search)
+FLUSH_SEARCH = (
+    """DELETE FROM search_fts
+         WHERE rowid IN (SELECT doc_id FROM search_docs
+                           WHERE (kind, key) IN (SELECT kind, key FROM search_queue));
+    """,
+    """DELETE FROM search_docs
+         WHERE (kind, key) IN (SELECT kind, key FROM search_queue);
+    """,
+    """INSERT INTO search_docs (kind, key)
+         SELECT 'project', project_id FROM projects
+           WHERE project_id IN (SELECT key FROM search_queue WHERE kind = 'project');
+    """,
+    """INSERT INTO search_docs (kind, key)
+         SELECT 'comment', comment_id FROM comments
+           WHERE comment_id IN (SELECT key FROM search_queue WHERE kind = 'comment');
+    """,
+    """INSERT INTO search_fts (rowid, owner, body)
+         SELECT doc_id, owner_id, project_name
+           FROM search_docs
+           INNER JOIN projects ON kind = 'project' AND project_id = key
+           WHERE (kind, key) IN (SELECT kind, key FROM search_queue);
+    """,
+    """INSERT INTO search_fts (rowid, owner, body)
+         SELECT doc_id, projects.owner_id, message
+           FROM search_docs
+           INNER JOIN comments ON kind = 'comment' AND comment_id = key
+           INNER JOIN projects ON projects.project_id = comments.project_id
+           WHERE (kind, key) IN (SELECT kind, key FROM search_queue);
+    """,
+    """DELETE FROM search_queue;""",
+)
+
+# Rebuild the full-text index (migration 4) from the projects and comments tables, after
+# the triggers that queue changes for it were dropped for a bulk load (see db.rebuild_search)
+REBUILD_SEARCH = (
+    """DELETE FROM search_queue;""",
+    """DELETE FROM search_docs;""",
+    """DELETE FROM search_fts;""",
+    """INSERT INTO search_docs (kind, key)
+         SELECT 'project', project_id FROM projects;
+    """,
+    """INSERT INTO search_docs (kind, key)
+         SELECT 'comment', comment_id FROM comments;
+    """,
+    """INSERT INTO search_fts (rowid, owner, body)
+         SELECT doc_id, owner_id, project_name
+           FROM search_docs
+           INNER JOIN projects ON kind = 'project' AND project_id = key;
+    """,
+    """INSERT INTO search_fts (rowid, owner, body)
+         SELECT doc_id, projects.owner_id, message
+           FROM search_docs
+           INNER JOIN comments ON kind = 'comment' AND comment_id = key
+           INNER JOIN projects ON projects.project_id = comments.project_id;
+    """,
+)
+
+# Ordered schema migrations, applied by db.migrate_db() after the tables in SQL exist.
+# PRAGMA user_version records the number of the last migration applied to a database.
+# Only ever append new migrations; never edit or renumber one that has shipped.
+MIGRATIONS = [
+    (1, "secondary indexes for owner and project lookups",
+     (
+         # covers get_project (owner_id, project_id) and the owner side of the view join
+         """CREATE INDEX IF NOT EXISTS idx_projects_owner
+              ON projects (owner_id, project_id, project_name);
+         """,
+         # comments of a project, in insertion (rowid) order
+         """CREATE INDEX IF NOT EXISTS idx_comments_project
+              ON comments (project_id);
+         """,
+     )),
+    (2, "trigger-maintained project counters, total and per owner",
+     (
+         """CREATE TABLE IF NOT EXISTS table_counts
+              (table_name TEXT PRIMARY KEY,
+               row_count INTEGER NOT NULL
+              ) WITHOUT ROWID;
+         """,
+         """CREATE TABLE IF NOT EXISTS owner_project_counts
+              (owner_id TEXT PRIMARY KEY,
+               project_count INTEGER NOT NULL
+              ) WITHOUT ROWID;
+         """,
+         """CREATE TRIGGER IF NOT EXISTS trg_projects_count_insert
+              AFTER INSERT ON projects
+            BEGIN
+              UPDATE table_counts SET row_count = row_count + 1
+                WHERE table_name = 'projects';
+              INSERT INTO owner_project_counts (owner_id, project_count)
+                VALUES (NEW.owner_id, 1)
+                ON CONFLICT (owner_id) DO UPDATE SET project_count = project_count + 1;
+            END;
+         """,
+         """CREATE TRIGGER IF NOT EXISTS trg_projects_count_delete
+              AFTER DELETE ON projects
+            BEGIN
+              UPDATE table_counts SET row_count = row_count - 1
+                WHERE table_name = 'projects';
+              UPDATE owner_project_counts SET project_count = project_count - 1
+                WHERE owner_id = OLD.owner_id;
+              DELETE FROM owner_project_counts
+                WHERE owner_id = OLD.owner_id AND project_count <= 0;
+            END;
+         """,
+         """CREATE TRIGGER IF NOT EXISTS trg_projects_count_update
+              AFTER UPDATE OF owner_id ON projects
+              WHEN NEW.owner_id IS NOT OLD.owner_id
+            BEGIN
+              UPDATE owner_project_counts SET project_count = project_count - 1
+                WHERE owner_id = OLD.owner_id;
+              DELETE FROM owner_project_counts
+                WHERE owner_id = OLD.owner_id AND project_count <= 0;
+              INSERT INTO owner_project_counts (owner_id, project_count)
+                VALUES (NEW.owner_id, 1)
+                ON CONFLICT (owner_id) DO UPDATE SET project_count = project_count + 1;
+            END;
+         """,
+         # start from the rows already there (REBUILD_COUNTERS as of this migration)
+         """INSERT OR REPLACE INTO table_counts (table_name, row_count)
+              SELECT 'projects', COUNT(*) FROM projects;
+         """,
+         """INSERT OR REPLACE INTO owner_project_counts (owner_id, project_count)
+              SELECT owner_id, COUNT(*) FROM projects GROUP BY owner_id;
+         """,
+     )),
+    (3, "projects.version, bumped whenever a project's response changes (ETags)",
+     (
+         """ALTER TABLE projects ADD COLUMN version INTEGER NOT NULL DEFAULT 0;""",
+         # pin the view to its columns from before version, SELECT * would now include it
+         """DROP VIEW IF EXISTS v_owner_project_comments;""",
+         """CREATE VIEW v_owner_project_comments AS
+              SELECT owners.owner_id,
+                     owners.owner_username,
+                     projects.project_id,
+                     projects.owner_id,
+                     projects.project_name,
+                     comments.comment_id,
+                     comments.commenter_id,
+                     comments.commenter_username,
+                     comments.project_id,
+                     comments.message
+              FROM owners
+              INNER JOIN projects ON owners.owner_id = projects.owner_id
+              INNER JOIN comments ON projects.project_id = comments.project_id;
+         """,
+         # A new comment is not counted here: its rowid is larger than any before it, and the
+         # project version includes the newest comment rowid (see db.get_project_version).
+         # That spares add_comment a write to projects
+         """CREATE TRIGGER IF NOT EXISTS trg_comments_version_update
+              AFTER UPDATE ON comments
+            BEGIN
+              UPDATE projects SET version = version + 1
+                WHERE project_id IN (OLD.project_id, NEW.project_id);
+            END;
+         """,
+         """CREATE TRIGGER IF NOT EXISTS trg_comments_version_delete
+              AFTER DELETE ON comments
+            BEGIN
+              UPDATE projects SET version = version + 1
+                WHERE project_id = OLD.project_id;
+            END;
+         """,
+         """CREATE TRIGGER IF NOT EXISTS trg_projects_version_update
+              AFTER UPDATE OF project_name, owner_id ON projects
+            BEGIN
+              UPDATE projects SET version = version + 1
+                WHERE project_id = NEW.project_id;
+            END;
+         """,
+         # the owner's username is part of every one of its project responses
+         """CREATE TRIGGER IF NOT EXISTS trg_owners_version_update
+              AFTER UPDATE OF owner_username ON owners
+            BEGIN
+              UPDATE projects SET version = version + 1
+                WHERE owner_id = NEW.owner_id;
+            END;
+         """,
+     )),
+    (4, "full-text search over project names and comment messages (FTS5), owner filterable",
+     (
+         # every indexed project and comment: doc_id is its rowid in search_fts, an INTEGER
+         # PRIMARY KEY so VACUUM and dump / restore keep it (the rowids of the TEXT keyed
+         # projects / comments may change)
+         """CREATE TABLE IF NOT EXISTS search_docs
+              (doc_id INTEGER PRIMARY KEY,
+               kind TEXT NOT NULL,
+               key TEXT NOT NULL,
+               UNIQUE (kind, key)
+              );
+         """,
+         # One index gives every hit the same bm25 scale, and the owner column lets MATCH
+         # select one owner's rows
+         """CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5 (owner, body);""",
+         # Writing an FTS5 index costs a segment flush per transaction, several times a
+         # comment insert, so the triggers only note what changed and FLUSH_SEARCH indexes
+         # it in one go before the next search (see db.flush_search)
+         # A rowid table, so each write appends to its last page. A key changed twice is
+         # queued twice; FLUSH_SEARCH indexes it once
+         """CREATE TABLE IF NOT EXISTS search_queue
+              (kind TEXT NOT NULL,
+               key TEXT NOT NULL
+              );
+         """,
+         """CREATE TRIGGER IF NOT EXISTS trg_projects_search_insert
+              AFTER INSERT ON projects
+            BEGIN
+              INSERT INTO search_queue (kind, key) VALUES ('project', NEW.project_id);
+            END;
+         """,
+         """CREATE TRIGGER IF NOT EXISTS trg_projects_search_delete
+              AFTER DELETE ON projects
+            BEGIN
+              INSERT INTO search_queue (kind, key) VALUES ('project', OLD.project_id);
+            END;
+         """,
+         """CREATE TRIGGER IF NOT EXISTS trg_projects_search_update
+              AFTER UPDATE OF project_name, owner_id ON projects
+              WHEN NEW.project_name IS NOT OLD.project_name OR NEW.owner_id IS NOT OLD.owner_id
+            BEGIN
+              INSERT INTO search_queue (kind, key) VALUES ('project', NEW.project_id);
+            END;
+         """,
+         # a project's comments are indexed under its owner, and move with it
+         """CREATE TRIGGER IF NOT EXISTS trg_projects_search_owner
+              AFTER UPDATE OF owner_id ON projects
+              WHEN NEW.owner_id IS NOT OLD.owner_id
+            BEGIN
+              INSERT INTO search_queue (kind, key)
+                SELECT 'comment', comment_id FROM comments WHERE project_id = NEW.project_id;
+            END;
+         """,
+         """CREATE TRIGGER IF NOT EXISTS trg_comments_search_insert
+              AFTER INSERT ON comments
+            BEGIN
+              INSERT INTO search_queue (kind, key) VALUES ('comment', NEW.comment_id);
+            END;
+         """,
+         """CREATE TRIGGER IF NOT EXISTS trg_comments_search_delete
+              AFTER DELETE ON comments
+            BEGIN
+              INSERT INTO search_queue (kind, key) VALUES ('comment', OLD.comment_id);
+            END;
+         """,
+         """CREATE TRIGGER IF NOT EXISTS trg_comments_search_update
+              AFTER UPDATE OF message, project_id ON comments
+              WHEN NEW.message IS NOT OLD.message OR NEW.project_id IS NOT OLD.project_id
+            BEGIN
+              INSERT INTO search_queue (kind, key) VALUES ('comment', NEW.comment_id);
+            END;
+         """,
+         # index the rows already there (REBUILD_SEARCH as of this migration)
+         """INSERT INTO search_docs (kind, key)
+              SELECT 'project', project_id FROM projects;
+         """,
+         """INSERT INTO search_docs (kind, key)
+              SELECT 'comment', comment_id FROM comments;
+         """,
+         """INSERT INTO search_fts (rowid, owner, body)
+              SELECT doc_id, owner_id, project_name
+                FROM search_docs
+                INNER JOIN projects ON kind = 'project' AND project_id = key;
+         """,
+         """INSERT INTO search_fts (rowid, owner, body)
+              SELECT doc_id, projects.owner_id, message
+                FROM search_docs
+                INNER JOIN comments ON kind = 'comment' AND comment_id = key
+                INNER JOIN projects ON projects.project_id = comments.project_id;
+         """,
+     )),
+    (5, "comments.created_at and project_owner_id, indexed for the owner activity feed",
+     (
+         # milliseconds since the epoch (UTC); 0 for comments from before this migration
+         """ALTER TABLE comments ADD COLUMN created_at INTEGER NOT NULL DEFAULT 0;""",
+         # the project's owner, copied so an owner's comments are one index range
+         """ALTER TABLE comments ADD COLUMN project_owner_id TEXT;""",
+         """UPDATE comments SET project_owner_id =
+              (SELECT owner_id FROM projects WHERE projects.project_id = comments.project_id);
+         """,
+         # newest first feed pages (see db.get_owner_comments_page) without a sort
+         """CREATE INDEX IF NOT EXISTS idx_comments_owner_created
+              ON comments (project_owner_id, created_at, comment_id);
+         """,
+         # db.py writes project_owner_id itself; this fills it in for any other insert
+         """CREATE TRIGGER IF NOT EXISTS trg_comments_owner_insert
+              AFTER INSERT ON comments
+              WHEN NEW.project_owner_id IS NULL
+            BEGIN
+              UPDATE comments SET project_owner_id =
+                  (SELECT owner_id FROM projects WHERE project_id = NEW.project_id)
+                WHERE rowid = NEW.rowid;
+            END;
+         """,
+         """CREATE TRIGGER IF NOT EXISTS trg_comments_owner_update
+              AFTER UPDATE OF project_id ON comments
+              WHEN NEW.project_id IS NOT OLD.project_id
+            BEGIN
+              UPDATE comments SET project_owner_id =
+                  (SELECT owner_id FROM projects WHERE project_id = NEW.project_id)
+                WHERE rowid = NEW.rowid;
+            END;
+         """,
+         """CREATE TRIGGER IF NOT EXISTS trg_projects_owner_update
+              AFTER UPDATE OF owner_id ON projects
+              WHEN NEW.owner_id IS NOT OLD.owner_id
+            BEGIN
+              UPDATE comments SET project_owner_id = NEW.owner_id
+                WHERE project_id = NEW.project_id;
+            END;
+         """,
+     )),
+]
@@ -2,8 +2,11 @@
 Tests for the api.py functions
 """
 
+import json
+import threading
 import unittest
 import api
+import config
 import db
 import testdb_config as tdc
 
@@ -68,6 +71,8 @@ class TestAPI(unittest.TestCase):
             c.execute("DELETE FROM comments;")
 
             conn.commit()
+            db.invalidate_owner()
+            api.invalidate_project()
 
     def tearDown(self):
         pass
@@ -106,6 +111,204 @@ class TestAPI(unittest.TestCase):
             self.assertEqual(response["commenter_username"], tdc.USERNAME_4)
             self.assertEqual(response["message"], "New Test Comment")
 
+    def test_add_comment_coalesced(self):
+        """test_add_comment_coalesced - concurrent comments through the group commit writer
+        """
+        with db.connect_db() as conn:
+            db_add(conn, tdc.TEST_ROWS['owners'])
+            db_add(conn, tdc.TEST_ROWS['projects'])
+
+        config.WRITE_COALESCE = True
+        try:
+            def add(i):
+                with db.connect_db() as conn:
+                    api.add_comment(conn, tdc.USER_UUID_4, tdc.MOCK_PROJ_UUID_11, f"comment {i}")
+
+            threads = [threading.Thread(target=add, args=(i,)) for i in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            stats = db.get_coalescer().stats()
+        finally:
+            db.close_coalescer()
+            config.WRITE_COALESCE = False
+
+        self.assertEqual(stats["writes"], 10)
+        with db.connect_db() as conn:
+            self.assertEqual(len(api.get_project(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_11)["comments"]), 10)
+
+    def test_project_response_cache(self):
+        """test_project_response_cache - cached responses and their invalidation
+        """
+        with db.connect_db() as conn:
+            db_add(conn, tdc.TEST_ROWS['owners'])
+            db_add(conn, tdc.TEST_ROWS['projects'])
+
+            etag, body = api.get_project_response(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_11)
+            db.reset_query_count()
+            self.assertEqual(api.get_project_response(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_11),
+                             (etag, body))
+            self.assertEqual(db.get_query_count(), 0)
+            # Cached per owner: another owner still gets nothing
+            self.assertIsNone(api.get_project_response(conn, tdc.USER_UUID_2, tdc.MOCK_PROJ_UUID_11))
+
+            api.add_comment(conn, tdc.USER_UUID_4, tdc.MOCK_PROJ_UUID_11, "New Test Comment")
+            etag, body = api.get_project_response(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_11)
+            self.assertEqual(len(json.loads(body)["comments"]), 1)
+
+            api.update_owner(conn, tdc.USER_UUID_1, "renamed")
+            etag, body = api.get_project_response(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_11)
+            self.assertEqual(json.loads(body)["owner_username"], "renamed")
+
+            api.delete_project(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_11)
+            self.assertIsNone(api.get_project_response(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_11))
+            self.assertGreater(api.get_project_cache_stats()["hit_ratio"], 0)
+
+    def test_list_comments(self):
+        """test_list_comments - walk the comments of a project page by page
+        """
+        with db.connect_db() as conn:
+            db_add(conn, tdc.TEST_ROWS['owners'])
+            db_add(conn, tdc.TEST_ROWS['projects'])
+            db_add(conn, tdc.TEST_ROWS['comments'])
+            for i in range(5):
+                api.add_comment(conn, tdc.USER_UUID_4, tdc.MOCK_PROJ_UUID_11, f"comment {i}")
+
+            messages, cursor = [], None
+            for _ in range(3):
+                page = api.list_comments(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_11, 3, cursor)
+                messages += [comment["message"] for comment in page["comments"]]
+                cursor = page["next_cursor"]
+            self.assertIsNone(cursor)
+            self.assertEqual(messages[:2], ["Owner 1, project 1, comment 1",
+                                            "Owner 1, project 1, comment 2"])
+            self.assertEqual(messages[2:], [f"comment {i}" for i in range(5)])
+
+            # Only the project owner can list its comments
+            self.assertIsNone(api.list_comments(conn, tdc.USER_UUID_2, tdc.MOCK_PROJ_UUID_11, 3))
+            page = api.list_comments(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_12, 3)
+            self.assertEqual(page, {"comments": [], "next_cursor": None})
+
+            with self.assertRaises(api.InvalidCursor):
+                api.list_comments(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_11, 3, "not-a-cursor")
+
+    def test_list_owner_comments(self):
+        """test_list_owner_comments - page through the comments on an owner's projects
+        """
+        with db.connect_db() as conn:
+            db_add(conn, tdc.TEST_ROWS['owners'])
+            db_add(conn, tdc.TEST_ROWS['projects'])
+            for i in range(3):
+                api.add_comment(conn, tdc.USER_UUID_4, tdc.MOCK_PROJ_UUID_11, f"comment {i}")
+            api.add_comments(conn, tdc.MOCK_PROJ_UUID_12, [{"commenter_id": tdc.USER_UUID_4,
+                                                            "message": "batch"}])
+
+            page = api.list_owner_comments(conn, tdc.USER_UUID_1, 3)
+            self.assertEqual(len(page["comments"]), 3)
+            self.assertGreater(page["comments"][0]["created_at"], 0)
+            page = api.list_owner_comments(conn, tdc.USER_UUID_1, 3, page["next_cursor"])
+            self.assertEqual(len(page["comments"]), 1)
+            self.assertIsNone(page["next_cursor"])
+            self.assertEqual(api.list_owner_comments(conn, tdc.USER_UUID_2, 3),
+                             {"comments": [], "next_cursor": None})
+
+            for cursor in ("not-a-cursor", api.encode_cursor(5), api.encode_cursor(["x", "y"])):
+                with self.assertRaises(api.InvalidCursor):
+                    api.list_owner_comments(conn, tdc.USER_UUID_1, 3, cursor)
+
+    def test_search(self):
+        """test_search - search box text, pages and invalid input
+        """
+        self.assertEqual(api.search_query('deploy  fail* "x'), '"deploy" "fail"* """x"')
+        with self.assertRaises(api.InvalidSearch):
+            api.search_query(" * ")
+
+        with db.connect_db() as conn:
+            db_add(conn, tdc.TEST_ROWS['owners'])
+            db_add(conn, tdc.TEST_ROWS['projects'])
+            db_add(conn, tdc.TEST_ROWS['comments'])
+            db.flush_search(conn)
+
+            page = api.search(conn, tdc.USER_UUID_1, "owner comm*", 1)
+            self.assertEqual(page["hits"][0]["type"], "comment")
+            page = api.search(conn, tdc.USER_UUID_1, "owner comm*", 1, page["next_cursor"])
+            self.assertEqual(len(page["hits"]), 1)
+            self.assertIsNone(page["next_cursor"])
+
+            # FTS5 operators are searched for as text
+            self.assertEqual(api.search(conn, tdc.USER_UUID_1, "NOT AND (", 10)["hits"], [])
+
+            with self.assertRaises(api.InvalidSearch):
+                api.search(conn, tdc.USER_UUID_1, "", 10)
+            with self.assertRaises(api.InvalidCursor):
+                api.search(conn, tdc.USER_UUID_1, "owner", 10, api.encode_cursor("x"))
+
+    def test_list_owners_projects(self):
+        """test_list_owners_projects - page through owners and projects
+        """
+        with db.connect_db() as conn:
+            db_add(conn, tdc.TEST_ROWS['owners'])
+            db_add(conn, tdc.TEST_ROWS['projects'])
+
+            page = api.list_owners(conn, 3)
+            self.assertEqual(len(page["owners"]), 3)
+            page = api.list_owners(conn, 3, page["next_cursor"])
+            self.assertEqual(len(page["owners"]), 1)
+            self.assertIsNone(page["next_cursor"])
+
+            page = api.list_projects(conn, tdc.USER_UUID_1, 1)
+            self.assertEqual(page["projects"], [{"project_id": tdc.MOCK_PROJ_UUID_11,
+                                                 "project_name": tdc.PROJECT_11}])
+            page = api.list_projects(conn, tdc.USER_UUID_1, 1, page["next_cursor"])
+            self.assertEqual(page["projects"][0]["project_id"], tdc.MOCK_PROJ_UUID_12)
+            self.assertIsNone(page["next_cursor"])
+
+    def test_add_projects(self):
+        """test_add_projects - add a batch of projects, one of them invalid
+        """
+        with db.connect_db() as conn:
+            db_add(conn, tdc.TEST_ROWS['owners'])
+
+            db.reset_query_count()
+            response = api.add_projects(conn, tdc.USER_UUID_1,
+                                        [{"project_name": "one"}, {}, {"project_name": "two"}])
+            # owner lookup + one INSERT for the whole batch
+            self.assertEqual(db.get_query_count(), 2)
+
+            self.assertEqual(response["created"], 2)
+            self.assertEqual(response["failed"], 1)
+            self.assertEqual([result["status"] for result in response["results"]],
+                             ["created", "error", "created"])
+            project = response["results"][2]["project"]
+            self.assertEqual(api.get_project(conn, tdc.USER_UUID_1, project["project_id"])["project_name"],
+                             "two")
+
+            self.assertIsNone(api.add_projects(conn, "no-such-owner", [{"project_name": "x"}]))
+
+    def test_add_comments(self):
+        """test_add_comments - add a batch of comments, some of them invalid
+        """
+        with db.connect_db() as conn:
+            db_add(conn, tdc.TEST_ROWS['owners'])
+            db_add(conn, tdc.TEST_ROWS['projects'])
+
+            items = [{"commenter_id": tdc.USER_UUID_4, "message": f"batch {i}"} for i in range(100)]
+            items += [{"commenter_id": "no-such-owner", "message": "x"},
+                      {"commenter_id": tdc.USER_UUID_2}]
+            response = api.add_comments(conn, tdc.MOCK_PROJ_UUID_12, items)
+
+            self.assertEqual(response["created"], 100)
+            self.assertEqual(response["results"][100],
+                             {"status": "error", "error": "unknown commenter_id"})
+            self.assertEqual(response["results"][101],
+                             {"status": "error", "error": "message is required"})
+            comments = api.get_project(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_12)["comments"]
+            self.assertEqual([comment["message"] for comment in comments],
+                             [f"batch {i}" for i in range(100)])
+
+            self.assertIsNone(api.add_comments(conn, "no-such-project", items))
+
 
 if __name__ == '__main__':
     unittest.main()
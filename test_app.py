@@ -0,0 +1,258 @@
+"""
+Tests for the app.py Flask routes, using the Flask test client
+"""
+
+import unittest
+import api
+import app
+import config
+import db
+import test_db
+import testdb_config as tdc
+
+ACCESS_TOKEN_1 = "31cd894de101a0e31ec4aa46503e59c8"
+HEADERS_1 = {"Authorization": "Bearer " + ACCESS_TOKEN_1}
+
+
+class TestApp(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.app.test_client()
+
+        with db.connect_db() as conn:
+            db.initialize_db(conn)
+            c = conn.cursor()
+
+            # Clear out data from previous test
+            c.execute("DELETE FROM owners;")
+            c.execute("DELETE FROM projects;")
+            c.execute("DELETE FROM comments;")
+
+            conn.commit()
+            db.invalidate_owner()
+            api.invalidate_project()
+            test_db.db_add(conn, tdc.TEST_ROWS['owners'])
+            test_db.db_add(conn, tdc.TEST_ROWS['projects'])
+            test_db.db_add(conn, tdc.TEST_ROWS['comments'])
+
+    def tearDown(self):
+        pass
+
+    def test_diagnostics(self):
+        r = self.client.get("/app/diagnostics")
+        self.assertEqual(r.status_code, 401)
+        r = self.client.get("/app/diagnostics", headers=HEADERS_1)
+        self.assertEqual(r.status_code, 200)
+
+        body = r.get_json()
+        self.assertEqual(body["storage_profile"], config.DB_PROFILE)
+        profile = config.DB_PROFILES[config.DB_PROFILE]
+        self.assertEqual(body["storage"]["synchronous"], profile["synchronous"])
+        self.assertEqual(body["storage"]["journal_mode"], profile["journal_mode"])
+        self.assertGreaterEqual(body["pool"]["size"], 1)
+        self.assertGreaterEqual(body["read_pool"]["size"], 1)
+
+    def test_projects_count(self):
+        r = self.client.get("/projects/count", headers=HEADERS_1)
+        self.assertEqual(r.status_code, 200)
+        self.assertIn("there are 4 projects", r.get_json()["message"])
+
+    def test_owner_projects_count(self):
+        r = self.client.get("/owners/me/projects/count", headers=HEADERS_1)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.get_json()["project_count"], 2)
+        self.assertEqual(r.headers["X-Query-Count"], "1")
+
+    def test_get_project(self):
+        # the second request is served from the project response cache
+        for query_count in ("2", "0"):
+            r = self.client.get("/projects/" + tdc.MOCK_PROJ_UUID_11, headers=HEADERS_1)
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(len(r.get_json()["comments"]), 2)
+            self.assertEqual(r.headers["X-Query-Count"], query_count)
+
+        r = self.client.get("/projects/" + tdc.MOCK_PROJ_UUID_21, headers=HEADERS_1)
+        self.assertEqual(r.status_code, 404)
+
+    def test_metrics(self):
+        config.SERVER_TIMING = True
+        try:
+            r = self.client.get("/projects/" + tdc.MOCK_PROJ_UUID_12, headers=HEADERS_1)
+        finally:
+            config.SERVER_TIMING = False
+        self.assertIn('sql;dur=', r.headers["Server-Timing"])
+        self.assertIn('desc="2 statements, ', r.headers["Server-Timing"])
+        r.close()  # the request is recorded when its response is closed
+
+        r = self.client.get("/metrics")
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.content_type.startswith("text/plain"))
+        self.assertIn('sample_rest_request_duration_seconds_count{method="GET",'
+                      'route="/projects/<project_id>"}', r.get_data(as_text=True))
+        self.assertNotIn("Server-Timing", r.headers)
+
+    def test_get_project_etag(self):
+        url = "/projects/" + tdc.MOCK_PROJ_UUID_11
+        r = self.client.get(url, headers=HEADERS_1)
+        etag = r.headers["ETag"]
+
+        r = self.client.get(url, headers=dict(HEADERS_1, **{"If-None-Match": etag}))
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.data, b"")
+        self.assertEqual(r.headers["ETag"], etag)
+        self.assertEqual(r.headers["X-Query-Count"], "0")  # the ETag came from the cache
+
+        api.invalidate_project()
+        r = self.client.get(url, headers=dict(HEADERS_1, **{"If-None-Match": etag}))
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.headers["X-Query-Count"], "1")  # the version lookup only
+
+        r = self.client.get(url, headers=dict(HEADERS_1, **{"If-None-Match": '"x", W/' + etag}))
+        self.assertEqual(r.status_code, 304)
+
+        # A new comment changes the ETag
+        r = self.client.post(url + "/comments", headers=HEADERS_1,
+                             json={"commenter_id": tdc.USER_UUID_4, "message": "new"})
+        self.assertEqual(r.status_code, 200)
+        r = self.client.get(url, headers=dict(HEADERS_1, **{"If-None-Match": etag}))
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(r.headers["ETag"], etag)
+        self.assertEqual(len(r.get_json()["comments"]), 3)
+
+        r = self.client.get("/projects/" + tdc.MOCK_PROJ_UUID_21,
+                            headers=dict(HEADERS_1, **{"If-None-Match": etag}))
+        self.assertEqual(r.status_code, 404)
+
+    def test_get_project_page(self):
+        r = self.client.get("/projects/" + tdc.MOCK_PROJ_UUID_11 + "?limit=1", headers=HEADERS_1)
+        body = r.get_json()
+        self.assertEqual(body["comments"][0]["comment_id"], tdc.MOCK_COMMENT_UUID_11)
+
+        r = self.client.get("/projects/" + tdc.MOCK_PROJ_UUID_11 + "/comments?limit=1&cursor="
+                            + body["next_cursor"], headers=HEADERS_1)
+        body = r.get_json()
+        self.assertEqual(body["comments"][0]["comment_id"], tdc.MOCK_COMMENT_UUID_12)
+        self.assertIsNone(body["next_cursor"])
+
+        for query in ("?limit=0", "?limit=x", "?cursor=not-a-cursor"):
+            r = self.client.get("/projects/" + tdc.MOCK_PROJ_UUID_11 + "/comments" + query,
+                                headers=HEADERS_1)
+            self.assertEqual(r.status_code, 400)
+
+    def test_list_projects(self):
+        r = self.client.get("/projects", headers=HEADERS_1)
+        self.assertEqual(len(r.get_json()["projects"]), 2)
+
+        r = self.client.get("/owners?limit=2", headers=HEADERS_1)
+        self.assertEqual(len(r.get_json()["owners"]), 2)
+
+    def test_cursor_types(self):
+        """test_cursor_types - a cursor of another endpoint's key type is a 400, not a 500"""
+        list_cursor = api.encode_cursor([1, "a"])
+        for path in ("/owners", "/projects",
+                     "/projects/" + tdc.MOCK_PROJ_UUID_11,
+                     "/projects/" + tdc.MOCK_PROJ_UUID_11 + "/comments"):
+            # a whole-project stream takes no cursor
+            streams = () if path.endswith(tdc.MOCK_PROJ_UUID_11) else ("?stream=1&cursor=",)
+            for query in ("?cursor=",) + streams:
+                for cursor in (list_cursor, api.encode_cursor(True)):
+                    r = self.client.get(path + query + cursor, headers=HEADERS_1)
+                    self.assertEqual(r.status_code, 400, path + query)
+                    r.close()
+        r = self.client.get("/owners?cursor=" + api.encode_cursor(5), headers=HEADERS_1)
+        self.assertEqual(r.status_code, 400)
+        r = self.client.get("/owners/me/comments?cursor=" + api.encode_cursor("a"), headers=HEADERS_1)
+        self.assertEqual(r.status_code, 400)
+
+    def test_list_owner_comments(self):
+        r = self.client.get("/owners/me/comments?limit=1", headers=HEADERS_1)
+        self.assertEqual(r.status_code, 200)
+        body = r.get_json()
+        self.assertEqual(len(body["comments"]), 1)
+        r = self.client.get("/owners/me/comments?cursor=" + body["next_cursor"], headers=HEADERS_1)
+        self.assertEqual(len(r.get_json()["comments"]), 1)
+        self.assertIsNone(r.get_json()["next_cursor"])
+
+        r = self.client.get("/owners/me/comments?cursor=not-a-cursor", headers=HEADERS_1)
+        self.assertEqual(r.status_code, 400)
+
+    def test_search(self):
+        r = self.client.get("/search?q=gnome", headers=HEADERS_1)
+        self.assertEqual(r.status_code, 200)
+        hits = r.get_json()["hits"]
+        self.assertEqual([hit["project_id"] for hit in hits], [tdc.MOCK_PROJ_UUID_11])
+
+        r = self.client.get("/search?q=shed", headers=HEADERS_1)
+        self.assertEqual(r.get_json(), {"hits": [], "next_cursor": None})
+        r = self.client.get("/search", headers=HEADERS_1)
+        self.assertEqual(r.status_code, 400)
+
+    def test_stream(self):
+        pool_stats = db.get_pool().stats()
+        for path in ("/projects/" + tdc.MOCK_PROJ_UUID_11,
+                     "/projects/" + tdc.MOCK_PROJ_UUID_11 + "/comments",
+                     "/projects/" + tdc.MOCK_PROJ_UUID_12,
+                     "/projects",
+                     "/owners"):
+            streamed = self.client.get(path + "?stream=1", headers=HEADERS_1)
+            self.assertTrue(streamed.is_streamed)
+            body = streamed.get_json()
+            expected = self.client.get(path, headers=HEADERS_1).get_json()
+            if "next_cursor" in expected:
+                # a stream always runs to the end
+                expected = self.client.get(path + "?limit=1000", headers=HEADERS_1).get_json()
+            self.assertEqual(body, expected)
+            streamed.close()  # what the WSGI server does once the body is sent
+
+        r = self.client.get("/projects/" + tdc.MOCK_PROJ_UUID_21 + "?stream=1", headers=HEADERS_1)
+        self.assertEqual(r.status_code, 404)
+        r = self.client.get("/owners?stream=1&cursor=not-a-cursor", headers=HEADERS_1)
+        self.assertEqual(r.status_code, 400)
+
+        # every streamed connection went back to the pool
+        self.assertEqual(db.get_pool().stats()["in_use"], pool_stats["in_use"])
+
+    def test_batch(self):
+        r = self.client.post("/projects/batch", headers=HEADERS_1,
+                             json=[{"project_name": "one"}, {"project_name": "two"}])
+        self.assertEqual(r.get_json()["created"], 2)
+
+        r = self.client.post("/projects/" + tdc.MOCK_PROJ_UUID_12 + "/comments/batch", headers=HEADERS_1,
+                             json=[{"commenter_id": tdc.USER_UUID_4, "message": "hi"}])
+        self.assertEqual(r.get_json()["results"][0]["comment"]["commenter_username"], tdc.USERNAME_4)
+
+        r = self.client.post("/projects/batch", headers=HEADERS_1, json={"project_name": "one"})
+        self.assertEqual(r.status_code, 400)
+        r = self.client.post("/projects/no-such-project/comments/batch", headers=HEADERS_1, json=[])
+        self.assertEqual(r.status_code, 404)
+
+    def test_populate_test_data(self):
+        r = self.client.post("/app/populate_test_data?owners=5&projects_per_owner=3&comments=20",
+                             headers=HEADERS_1)
+        self.assertEqual(r.get_json()["rows"], {"owners": 5, "projects": 15, "comments": 20})
+        r = self.client.get("/projects/count", headers=HEADERS_1)
+        self.assertIn("there are 15 projects", r.get_json()["message"])
+
+        r = self.client.post("/app/populate_test_data", headers=HEADERS_1)
+        self.assertEqual(r.get_json()["rows"], {"owners": 4, "projects": 4, "comments": 4})
+
+        # it replaces every row, so it needs a token and is not a GET
+        r = self.client.post("/app/populate_test_data")
+        self.assertEqual(r.status_code, 401)
+        r = self.client.get("/app/populate_test_data", headers=HEADERS_1)
+        self.assertEqual(r.status_code, 405)
+
+        for query in ("owners=-1", "comments=x", "skew=nan", "skew=-0.5",
+                      f"comments={config.DATAGEN_MAX_COMMENTS + 1}",
+                      f"projects_per_owner={config.DATAGEN_MAX_PROJECTS_PER_OWNER + 1}"):
+            r = self.client.post(f"/app/populate_test_data?{query}", headers=HEADERS_1)
+            self.assertEqual(r.status_code, 400, query)
+
+    def test_invalid_token(self):
+        r = self.client.get("/projects/count",
+                            headers={"Authorization": "Bearer not-a-token"})
+        self.assertEqual(r.status_code, 401)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,238 @@
+"""
+Tests for the asgi_app.py asyncio serving mode, calling the ASGI app directly
+"""
+
+import asyncio
+import json
+import time
+import unittest
+from unittest import mock
+import api
+import asgi_app
+import db
+import introspection
+import introspection_server
+import metrics
+import test_db
+import testdb_config as tdc
+
+ACCESS_TOKEN_1 = "31cd894de101a0e31ec4aa46503e59c8"
+HEADERS_1 = [(b"authorization", b"Bearer " + ACCESS_TOKEN_1.encode())]
+
+
+async def call(app, method, path, query=b"", headers=(), body=b""):
+    """call - send one http request through the ASGI app
+    :return: tuple (status, headers dict, body bytes)
+    """
+    scope = {"type": "http", "method": method, "path": path, "query_string": query,
+             "headers": list(headers)}
+    messages = []
+    received = False
+
+    async def receive():
+        nonlocal received
+        if received:
+            await asyncio.Event().wait()
+        received = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    start = messages[0]
+    return (start["status"],
+            {name.decode(): value.decode() for name, value in start["headers"]},
+            b"".join(m.get("body", b"") for m in messages[1:]))
+
+
+class TestASGIApp(unittest.TestCase):
+
+    def setUp(self):
+        with db.connect_db() as conn:
+            db.initialize_db(conn)
+            c = conn.cursor()
+
+            # Clear out data from previous test
+            c.execute("DELETE FROM owners;")
+            c.execute("DELETE FROM projects;")
+            c.execute("DELETE FROM comments;")
+
+            conn.commit()
+            db.invalidate_owner()
+            api.invalidate_project()
+            test_db.db_add(conn, tdc.TEST_ROWS['owners'])
+            test_db.db_add(conn, tdc.TEST_ROWS['projects'])
+            test_db.db_add(conn, tdc.TEST_ROWS['comments'])
+
+        self.app = asgi_app.ASGIApp()
+
+    def tearDown(self):
+        self.app.stop()
+
+    def request(self, method, path, **kwargs):
+        return asyncio.run(call(self.app, method, path, **kwargs))
+
+    def test_get_project(self):
+        # the second request is served from the project response cache
+        for query_count in ("2", "0"):
+            status, headers, body = self.request("GET", "/projects/" + tdc.MOCK_PROJ_UUID_11,
+                                                 headers=HEADERS_1)
+            self.assertEqual(status, 200)
+            self.assertEqual(len(json.loads(body)["comments"]), 2)
+            self.assertEqual(headers["x-query-count"], query_count)
+
+        status, _, _ = self.request("GET", "/projects/no-such-project", headers=HEADERS_1)
+        self.assertEqual(status, 404)
+
+    def test_metrics(self):
+        route = ("GET", "/projects/<project_id>/comments", "200")
+        before = metrics.REQUESTS.value(*route)
+        status, _, _ = self.request("GET", "/projects/" + tdc.MOCK_PROJ_UUID_11 + "/comments",
+                                    headers=HEADERS_1)
+        self.assertEqual(status, 200)
+        self.assertEqual(metrics.REQUESTS.value(*route), before + 1)
+
+        status, headers, body = self.request("GET", "/metrics")
+        self.assertEqual(status, 200)
+        self.assertTrue(headers["content-type"].startswith("text/plain"))
+        self.assertIn(b'sample_rest_request_sql_rows_count{method="GET",'
+                      b'route="/projects/<project_id>/comments"}', body)
+
+        # an unexpected exception is counted as a 500, and left to the server to answer
+        route = ("GET", "/projects/<project_id>/comments", "500")
+        before = metrics.REQUESTS.value(*route)
+        with mock.patch.object(api, "list_comments", side_effect=RuntimeError("boom")):
+            with self.assertRaises(RuntimeError):
+                self.request("GET", "/projects/" + tdc.MOCK_PROJ_UUID_11 + "/comments",
+                             headers=HEADERS_1)
+        self.assertEqual(metrics.REQUESTS.value(*route), before + 1)
+
+    def test_get_project_etag(self):
+        path = "/projects/" + tdc.MOCK_PROJ_UUID_11
+        _, headers, _ = self.request("GET", path, headers=HEADERS_1)
+        etag = headers["etag"]
+        api.invalidate_project()
+        status, headers, body = self.request(
+            "GET", path, headers=HEADERS_1 + [(b"if-none-match", etag.encode())])
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b"")
+        self.assertEqual(headers["x-query-count"], "1")
+
+    def test_invalid_token(self):
+        status, headers, _ = self.request("GET", "/projects/count")
+        self.assertEqual(status, 401)
+        self.assertIn("www-authenticate", headers)
+
+        status, _, _ = self.request("GET", "/projects/count",
+                                    headers=[(b"authorization", b"Bearer not-a-token")])
+        self.assertEqual(status, 401)
+
+    def test_populate_test_data(self):
+        path = "/app/populate_test_data"
+        status, _, body = self.request("POST", path, query=b"owners=5&projects_per_owner=3&comments=20",
+                                       headers=HEADERS_1)
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["rows"], {"owners": 5, "projects": 15, "comments": 20})
+
+        status, _, _ = self.request("POST", path)
+        self.assertEqual(status, 401)
+        status, _, _ = self.request("GET", path, headers=HEADERS_1)
+        self.assertEqual(status, 405)
+        status, _, _ = self.request("POST", path, query=b"comments=-1", headers=HEADERS_1)
+        self.assertEqual(status, 400)
+
+        status, _, _ = self.request("GET", "/app/diagnostics")
+        self.assertEqual(status, 401)
+        status, _, body = self.request("GET", "/app/diagnostics", headers=HEADERS_1)
+        self.assertEqual(status, 200)
+        self.assertIn("storage_profile", json.loads(body))
+
+    def test_routing(self):
+        status, _, _ = self.request("GET", "/no/such/path", headers=HEADERS_1)
+        self.assertEqual(status, 404)
+        status, _, _ = self.request("PUT", "/projects", headers=HEADERS_1)
+        self.assertEqual(status, 405)
+        status, _, _ = self.request("GET", "/projects", query=b"limit=x", headers=HEADERS_1)
+        self.assertEqual(status, 400)
+
+    def test_list_and_add(self):
+        status, _, body = self.request("POST", "/projects", headers=HEADERS_1,
+                                       body=b'{"project_name": "asgi project"}')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["project_name"], "asgi project")
+
+        status, _, body = self.request("GET", "/projects", query=b"limit=2", headers=HEADERS_1)
+        self.assertEqual(status, 200)
+        page = json.loads(body)
+        self.assertEqual(len(page["projects"]), 2)
+        self.assertIsNotNone(page["next_cursor"])
+
+    def test_stream(self):
+        status, _, body = self.request("GET", "/projects/" + tdc.MOCK_PROJ_UUID_11,
+                                       query=b"stream=1", headers=HEADERS_1)
+        self.assertEqual(status, 200)
+        self.assertEqual(len(json.loads(body)["comments"]), 2)
+
+        status, _, _ = self.request("GET", "/projects/no-such-project",
+                                    query=b"stream=1", headers=HEADERS_1)
+        self.assertEqual(status, 404)
+        status, _, _ = self.request("GET", "/owners", query=b"stream=1&cursor=bad",
+                                    headers=HEADERS_1)
+        self.assertEqual(status, 400)
+
+        # the streams gave their worker slots back
+        self.assertEqual(self.app.executor._slots._value, self.app.executor._slots_max)
+
+    def test_stream_limit(self):
+        async def scenario():
+            executor = asgi_app.DBExecutor(workers=2, max_pending=16, max_streams=2)
+            request = asgi_app.Request({"method": "GET", "path": "/owners"}, b"", executor)
+
+            async def read(fragments):
+                return json.loads(b"".join([chunk async for chunk in fragments]))["owners"]
+
+            try:
+                # one stream at most with 2 workers: it holds one, the other serves calls
+                first = await executor.stream(request, api.stream_owners, 1)
+                owners = await asyncio.wait_for(executor.run(request, db.get_owners), 5)
+                self.assertEqual(len(owners), 4)
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(executor.stream(request, api.stream_owners, 1), 0.2)
+
+                self.assertEqual(len(await read(first)), 4)
+                second = await asyncio.wait_for(executor.stream(request, api.stream_owners, 1), 5)
+                self.assertEqual(len(await read(second)), 4)
+                self.assertEqual(executor._streams._value, executor._streams_max)
+            finally:
+                executor.close()
+
+        asyncio.run(scenario())
+
+    def test_slow_introspection_overlaps(self):
+        server = introspection_server.start_server(delay=0.2)
+        previous = introspection.get_introspector()
+        introspection.set_introspector(introspection.CachingIntrospector(
+            introspection.HttpBackend(server.url)))
+        try:
+            async def burst():
+                return await asyncio.gather(*[
+                    call(self.app, "GET", "/projects/count",
+                         headers=[(b"authorization", b"Bearer invalid-%d" % i)])
+                    for i in range(10)])
+
+            start = time.monotonic()
+            results = asyncio.run(burst())
+            elapsed = time.monotonic() - start
+        finally:
+            introspection.set_introspector(previous)
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual([status for status, _, _ in results], [401] * 10)
+        self.assertEqual(server.request_count, 10)
+        self.assertLess(elapsed, 1.0)  # 10 x 0.2s one after another would take 2s
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+Tests for the cache.py LRU cache
+"""
+
+import time
+import unittest
+import cache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get_set(self):
+        lru = cache.LRUCache(max_size=2)
+        lru.set("a", 1)
+        self.assertEqual(lru.get("a"), 1)
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(lru.get("b", 0), 0)
+
+        stats = lru.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 2)
+
+    def test_lru_eviction(self):
+        lru = cache.LRUCache(max_size=2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")  # "b" is now the least recently used
+        lru.set("c", 3)
+
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(lru.get("a"), 1)
+        self.assertEqual(lru.get("c"), 3)
+        self.assertEqual(lru.stats()["evictions"], 1)
+
+    def test_ttl(self):
+        lru = cache.LRUCache(max_size=3, ttl=60)
+        lru.set("a", 1)
+        lru.set("b", 2, ttl=0.01)
+        lru.set("c", 3, ttl=None)
+        time.sleep(0.02)
+
+        self.assertEqual(lru.get("a"), 1)
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(lru.get("c"), 3)
+
+    def test_delete_clear(self):
+        lru = cache.LRUCache()
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.delete("a")
+        self.assertIsNone(lru.get("a"))
+        lru.clear()
+        self.assertEqual(len(lru), 0)
+
+    def test_delete_where(self):
+        lru = cache.LRUCache()
+        for key in range(10):
+            lru.set(key, key % 2)
+        self.assertEqual(lru.delete_where(lambda key, value: value == 1), 5)
+        self.assertEqual(len(lru), 5)
+        self.assertIsNone(lru.get(1))
+        self.assertEqual(lru.get(2), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+Tests for the coalescer.py group commit writer
+"""
+
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+import coalescer
+
+
+def insert(conn, value):
+    conn.execute("INSERT INTO items (value) VALUES (?);", (value,))
+    return value
+
+
+class TestWriteCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.database = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        conn = sqlite3.connect(self.database, check_same_thread=False)
+        conn.execute("CREATE TABLE items (value INTEGER UNIQUE);")
+        conn.commit()
+        self.writer = coalescer.WriteCoalescer(conn, max_delay=0.05, max_batch=100)
+
+    def tearDown(self):
+        self.writer.close()
+        self.writer.conn.close()
+        os.remove(self.database)
+
+    def count(self):
+        with sqlite3.connect(self.database) as conn:
+            return conn.execute("SELECT COUNT(*) FROM items;").fetchone()[0]
+
+    def test_concurrent_writes_share_commits(self):
+        results = []
+        threads = [threading.Thread(target=lambda i=i: results.append(self.writer.call(insert, i)))
+                   for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results), list(range(20)))
+        self.assertEqual(self.count(), 20)
+        stats = self.writer.stats()
+        self.assertEqual(stats["writes"], 20)
+        self.assertLess(stats["batches"], 20)
+        self.assertGreater(stats["max_batch_size"], 1)
+
+    def test_failed_write_is_rolled_back_alone(self):
+        futures = [self.writer.submit(insert, value) for value in (1, 1, 2)]
+
+        self.assertEqual(futures[0].result(), 1)
+        with self.assertRaises(sqlite3.IntegrityError):
+            futures[1].result()
+        self.assertEqual(futures[2].result(), 2)
+        self.assertEqual(self.count(), 2)
+        self.assertEqual(self.writer.stats()["failed"], 1)
+
+    def test_max_batch(self):
+        self.writer.close()
+        self.writer = coalescer.WriteCoalescer(self.writer.conn, max_delay=0.05, max_batch=2)
+
+        futures = [self.writer.submit(insert, value) for value in range(5)]
+        for future in futures:
+            future.result()
+        self.assertEqual(self.writer.stats()["max_batch_size"], 2)
+        self.assertGreaterEqual(self.writer.stats()["batches"], 3)
+
+    def test_close(self):
+        future = self.writer.submit(insert, 1)
+        self.writer.close()
+        self.assertEqual(future.result(timeout=0), 1)  # queued writes are committed first
+        with self.assertRaises(coalescer.CoalescerClosed):
+            self.writer.submit(insert, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+Tests for the datagen.py bulk loader
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+from collections import Counter
+import api
+import config
+import datagen
+import db
+
+USER_ID_1 = "8bde3e84-a964-479c-9c7b-4d7991717a1b"
+
+
+class TestDatagen(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        db.init_pool(database=os.path.join(self.directory.name, "datagen.db"))
+        with db.connect_db() as conn:
+            db.initialize_db(conn)
+
+    def tearDown(self):
+        db.close_pool()
+        self.directory.cleanup()
+
+    def test_bulk_load(self):
+        with db.connect_db() as conn:
+            counts = datagen.bulk_load(conn, owners=50, projects_per_owner=4, comments=5000,
+                                       batch_size=1000)
+            self.assertEqual(counts, {"owners": 50, "projects": 200, "comments": 5000})
+            self.assertEqual(api.get_num_projects(conn)["project_count"], 200)
+
+            # the auth.py users own some of the data
+            self.assertEqual(len(api.list_projects(conn, USER_ID_1, 10)["projects"]), 4)
+
+            # comments are skewed towards a few hot projects
+            c = conn.cursor()
+            per_project = Counter(row[0] for row in c.execute("SELECT project_id FROM comments;"))
+            self.assertGreater(per_project.most_common(1)[0][1], 10 * 5000 / 200)
+
+            # indexes were rebuilt and the configured profile restored
+            indexes = {row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type='index';")}
+            self.assertIn("idx_comments_project", indexes)
+            self.assertEqual(len(api.search(conn, USER_ID_1, "project", 10)["hits"]), 4)
+            feed = api.list_owner_comments(conn, USER_ID_1, 10)["comments"]
+            self.assertEqual(feed, sorted(feed, key=lambda comment: -comment["created_at"]))
+            self.assertEqual(db.get_storage_settings(conn)["synchronous"],
+                             config.DB_PROFILES[config.DB_PROFILE]["synchronous"])
+
+    def test_failed_load(self):
+        def failing_comments(project_ids, *args):
+            yield ("c1", USER_ID_1, "u", project_ids[0], "m")
+            raise RuntimeError("generator failed")
+
+        with db.connect_db() as conn:
+            sql = "SELECT name FROM sqlite_master WHERE type IN ('index', 'trigger') ORDER BY name;"
+            schema = conn.execute(sql).fetchall()
+            with mock.patch.object(datagen, "generate_comments", failing_comments):
+                with self.assertRaises(RuntimeError):
+                    datagen.bulk_load(conn, owners=5, projects_per_owner=2, comments=20)
+
+            # the indexes and triggers are back, and the counters match the rows loaded so far
+            self.assertEqual(conn.execute(sql).fetchall(), schema)
+            self.assertEqual(api.get_num_projects(conn)["project_count"], 10)
+            self.assertEqual(db.get_num_owner_projects(conn, USER_ID_1)["project_count"], 2)
+            self.assertEqual(db.get_storage_settings(conn)["synchronous"],
+                             config.DB_PROFILES[config.DB_PROFILE]["synchronous"])
+
+    def test_reproducible(self):
+        with db.connect_db() as conn:
+            datagen.bulk_load(conn, owners=5, projects_per_owner=2, comments=20, seed=7)
+            first = db.get_owners(conn)
+            datagen.bulk_load(conn, owners=5, projects_per_owner=2, comments=20, seed=7)
+            self.assertEqual(db.get_owners(conn), first)
+
+
+if __name__ == '__main__':
+    unittest.main()
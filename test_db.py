@@ -4,7 +4,9 @@ Tests for the db.py functions
 
 import unittest
 import sqlite3
+import config
 import db
+import static_sql
 import testdb_config as tdc
 
 
@@ -42,6 +44,7 @@ class TestDB(unittest.TestCase):
             c.execute("DELETE FROM comments;")
 
             conn.commit()
+            db.invalidate_owner()
 
     def tearDown(self):
         pass
@@ -51,14 +54,14 @@ class TestDB(unittest.TestCase):
             db_add(conn, tdc.TEST_ROWS['owners'])
 
             result = db.get_owner(conn, tdc.USER_UUID_1)
-            self.assertEqual(result[0][1], tdc.USERNAME_1)
+            self.assertEqual(result[0]["owner_username"], tdc.USERNAME_1)
 
     def test_get_owners(self):
         with db.connect_db() as conn:
             db_add(conn, tdc.TEST_ROWS['owners'])
 
             result = db.get_owners(conn)
-            self.assertEqual(result[1][1], tdc.USERNAME_2)
+            self.assertEqual(result[1]["owner_username"], tdc.USERNAME_2)
 
     def test_get_project(self):
         with db.connect_db() as conn:
@@ -69,7 +72,74 @@ class TestDB(unittest.TestCase):
 
             self.assertEqual(result['project_id'], tdc.MOCK_PROJ_UUID_12)
             self.assertEqual(result['project_name'], tdc.PROJECT_12)
+            self.assertEqual(result['comments'], [])
 
+            self.assertIsNone(db.get_project(conn, tdc.USER_UUID_2, tdc.MOCK_PROJ_UUID_12))
+
+    def test_get_project_comments(self):
+        with db.connect_db() as conn:
+            db_add(conn, tdc.TEST_ROWS['owners'])
+            db_add(conn, tdc.TEST_ROWS['projects'])
+            db_add(conn, tdc.TEST_ROWS['comments'])
+
+            db.reset_query_count()
+            result = db.get_project(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_11)
+            self.assertEqual(db.get_query_count(), 2)
+
+            # once the owner is cached, project and comments come back in a single statement
+            db.reset_query_count()
+            result = db.get_project(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_11)
+            self.assertEqual(db.get_query_count(), 1)
+            statements, seconds, rows = db.get_query_stats()
+            self.assertEqual((statements, rows), (1, 2))
+            self.assertGreater(seconds, 0)
+            self.assertEqual(result['owner_username'], tdc.USERNAME_1)
+            self.assertEqual([comment['comment_id'] for comment in result['comments']],
+                             [tdc.MOCK_COMMENT_UUID_11, tdc.MOCK_COMMENT_UUID_12])
+
+    def test_delete_project(self):
+        with db.connect_db() as conn:
+            db_add(conn, tdc.TEST_ROWS['owners'])
+            db_add(conn, tdc.TEST_ROWS['projects'])
+            db_add(conn, tdc.TEST_ROWS['comments'])
+
+            db.get_owner_username(conn, tdc.USER_UUID_1)
+            db.reset_query_count()
+            result = db.delete_project(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_11)
+
+            self.assertEqual(db.get_query_count(), 2)
+            self.assertEqual(len(result['comments']), 2)
+            self.assertEqual(db.get_comments(conn, tdc.MOCK_PROJ_UUID_11), [])
+            self.assertIsNone(db.delete_project(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_11))
+
+    def test_project_version(self):
+        with db.connect_db() as conn:
+            db_add(conn, tdc.TEST_ROWS['owners'])
+            db_add(conn, tdc.TEST_ROWS['projects'])
+            db_add(conn, tdc.TEST_ROWS['comments'])
+
+            version = db.get_project_version(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_11)
+            self.assertEqual(db.get_project_versioned(conn, tdc.USER_UUID_1,
+                                                      tdc.MOCK_PROJ_UUID_11)[1], version)
+            self.assertIsNone(db.get_project_version(conn, tdc.USER_UUID_2, tdc.MOCK_PROJ_UUID_11))
+
+            # Every change to the project's response bumps its version, and only its version
+            other = db.get_project_version(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_12)
+            unrelated = db.get_project_version(conn, tdc.USER_UUID_2, tdc.MOCK_PROJ_UUID_21)
+            for change in (lambda: db.add_comment(conn, tdc.USER_UUID_4, tdc.MOCK_PROJ_UUID_11, "x"),
+                           lambda: conn.execute("UPDATE comments SET message='y' WHERE project_id=?;",
+                                                (tdc.MOCK_PROJ_UUID_11,)),
+                           lambda: conn.execute("DELETE FROM comments WHERE comment_id=?;",
+                                                (tdc.MOCK_COMMENT_UUID_11,)),
+                           lambda: db.update_owner(conn, tdc.USER_UUID_1, "renamed")):
+                change()
+                new_version = db.get_project_version(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_11)
+                self.assertGreater(new_version, version)
+                version = new_version
+            self.assertGreater(db.get_project_version(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_12),
+                               other)  # the owner rename changed it too
+            self.assertEqual(db.get_project_version(conn, tdc.USER_UUID_2, tdc.MOCK_PROJ_UUID_21),
+                             unrelated)
 
     def test_get_comment(self):
         with db.connect_db() as conn:
@@ -78,7 +148,7 @@ class TestDB(unittest.TestCase):
             db_add(conn, tdc.TEST_ROWS['comments'])
 
             result = db.get_comment(conn, tdc.MOCK_COMMENT_UUID_12)
-            self.assertEqual(result[0][4], "Owner 1, project 1, comment 2")
+            self.assertEqual(result[0]["message"], "Owner 1, project 1, comment 2")
 
     def test_get_comments(self):
         with db.connect_db() as conn:
@@ -87,7 +157,7 @@ class TestDB(unittest.TestCase):
             db_add(conn, tdc.TEST_ROWS['comments'])
 
             result = db.get_comments(conn, tdc.MOCK_PROJ_UUID_11)
-            self.assertEqual(result[1][4], "Owner 1, project 1, comment 2")
+            self.assertEqual(result[1]["message"], "Owner 1, project 1, comment 2")
 
     def test_get_owner_comments(self):
         with db.connect_db() as conn:
@@ -100,7 +170,220 @@ class TestDB(unittest.TestCase):
 
             result = db.get_owner_comments(conn, tdc.USER_UUID_3)
             self.assertEqual(len(result), 1)
-            self.assertEqual(result[0][9], "Owner 3, project 1, comment 1")
+            self.assertEqual(result[0]["message"], "Owner 3, project 1, comment 1")
+
+    def test_owner_cache(self):
+        with db.connect_db() as conn:
+            db_add(conn, tdc.TEST_ROWS['owners'])
+            db_add(conn, tdc.TEST_ROWS['projects'])
+
+            before = db.get_owner_cache_stats()
+            self.assertEqual(db.get_owner_username(conn, tdc.USER_UUID_1), tdc.USERNAME_1)
+
+            # The write paths no longer look the owner up
+            db.reset_query_count()
+            db.add_comment(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_11, "cached")
+            db.add_project(conn, "MOCK_PROJ_UUID_13", tdc.USER_UUID_1, "cached")
+            self.assertEqual(db.get_query_count(), 2)
+
+            after = db.get_owner_cache_stats()
+            self.assertEqual(after["misses"] - before["misses"], 1)
+            self.assertEqual(after["hits"] - before["hits"], 2)
+
+            # Changing the owner invalidates the cached username
+            db.update_owner(conn, tdc.USER_UUID_1, "renamed")
+            self.assertEqual(db.get_owner_username(conn, tdc.USER_UUID_1), "renamed")
+
+            self.assertIsNone(db.get_owner_username(conn, "no-such-owner"))
+            self.assertIsNone(db.add_comment(conn, "no-such-owner", tdc.MOCK_PROJ_UUID_11, "x"))
+
+    def test_read_only_connection(self):
+        with db.connect_db() as conn:
+            db_add(conn, tdc.TEST_ROWS['owners'])
+
+        with db.connect_db(readonly=True) as conn:
+            self.assertEqual(conn.execute("PRAGMA query_only;").fetchone()[0], 1)
+            self.assertEqual(db.get_owner(conn, tdc.USER_UUID_1)[0]["owner_username"], tdc.USERNAME_1)
+            with self.assertRaises(sqlite3.OperationalError):
+                db.add_owner(conn, "new-owner", "new owner")
+        self.assertGreaterEqual(db.get_read_pool().stats()["created"], 1)
+
+    def test_storage_profile(self):
+        with db.connect_db() as conn:
+            for profile, settings in config.DB_PROFILES.items():
+                db.apply_storage_profile(conn, profile)
+                result = db.get_storage_settings(conn)
+                self.assertEqual(result["journal_mode"], settings["journal_mode"])
+                self.assertEqual(result["synchronous"], settings["synchronous"])
+                self.assertEqual(result["cache_size"], settings["cache_size"])
+                self.assertEqual(result["busy_timeout"], settings["busy_timeout"])
+
+            db.apply_storage_profile(conn)
+
+            with self.assertRaises(ValueError):
+                db.apply_storage_profile(conn, "no-such-profile")
+
+    def test_migrate_db(self):
+        latest = static_sql.MIGRATIONS[-1][0]
+        # A database from before any migration: the base tables only, with data
+        conn = sqlite3.connect(":memory:")
+        conn.execute("PRAGMA foreign_keys = ON;")
+        for sql in static_sql.SQL.values():
+            conn.execute(sql)
+        db_add(conn, tdc.TEST_ROWS['owners'])
+        db_add(conn, tdc.TEST_ROWS['projects'])
+        db_add(conn, tdc.TEST_ROWS['comments'])
+        c = conn.cursor()
+
+        with conn:
+            self.assertEqual(db.migrate_db(conn), latest)
+            self.assertEqual(c.execute("PRAGMA user_version;").fetchone()[0], latest)
+            # Nothing left to do the second time around
+            self.assertEqual(db.migrate_db(conn), latest)
+
+            # Data survived, and the hot lookups now use the indexes
+            self.assertEqual(len(db.get_comments(conn, tdc.MOCK_PROJ_UUID_11)), 2)
+            plan = c.execute("EXPLAIN QUERY PLAN SELECT * FROM comments WHERE project_id=?;",
+                             (tdc.MOCK_PROJ_UUID_11,)).fetchall()
+            self.assertIn("idx_comments_project", plan[0][3])
+            plan = c.execute("EXPLAIN QUERY PLAN SELECT project_id, project_name FROM projects "
+                             "WHERE owner_id=?;", (tdc.USER_UUID_1,)).fetchall()
+            self.assertIn("COVERING INDEX", plan[0][3])
+            self.assertEqual(db.get_num_projects(conn)["project_count"], 4)
+            # comments from before migration 5 know their project's owner
+            page, _ = db.get_owner_comments_page(conn, tdc.USER_UUID_1, 10)
+            self.assertEqual(len(page), 2)
+            # rows from before the full-text migration were indexed
+            hits, _ = db.search(conn, tdc.USER_UUID_1, '"argle"', 10)
+            self.assertEqual(hits[0]["project_id"], tdc.MOCK_PROJ_UUID_12)
+        conn.close()
+
+    def test_get_owner_comments_page(self):
+        with db.connect_db() as conn:
+            db_add(conn, tdc.TEST_ROWS['owners'])
+            db_add(conn, tdc.TEST_ROWS['projects'])
+            db_add(conn, tdc.TEST_ROWS['comments'])
+            for i in range(3):
+                db.add_comment(conn, tdc.USER_UUID_4, tdc.MOCK_PROJ_UUID_12, f"new {i}")
+                conn.execute("UPDATE comments SET created_at=? WHERE message=?;",
+                             (db.created_now() + i, f"new {i}"))
+            conn.commit()
+
+            comments, after = [], None
+            while True:
+                page, after = db.get_owner_comments_page(conn, tdc.USER_UUID_1, 2, after)
+                comments += page
+                if after is None:
+                    break
+            # newest first; the fixtures were inserted without a time (0)
+            self.assertEqual([comment["message"] for comment in comments[:3]],
+                             ["new 2", "new 1", "new 0"])
+            self.assertEqual(sorted(comment["comment_id"] for comment in comments[3:]),
+                             [tdc.MOCK_COMMENT_UUID_11, tdc.MOCK_COMMENT_UUID_12])
+            self.assertEqual(comments[0]["project_name"], tdc.PROJECT_12)
+            self.assertEqual(comments[3]["created_at"], 0)
+
+            # comments follow their project to a new owner
+            conn.execute("UPDATE projects SET owner_id=? WHERE project_id=?;",
+                         (tdc.USER_UUID_2, tdc.MOCK_PROJ_UUID_12))
+            page, _ = db.get_owner_comments_page(conn, tdc.USER_UUID_2, 10)
+            self.assertEqual(len(page), 4)
+
+            # the page is read from idx_comments_owner_created, without a sort
+            plan = conn.execute("EXPLAIN QUERY PLAN SELECT comment_id FROM comments "
+                                "WHERE project_owner_id=? ORDER BY created_at DESC, comment_id DESC;",
+                                (tdc.USER_UUID_1,)).fetchall()
+            self.assertEqual([row[3] for row in plan],
+                             ["SEARCH comments USING COVERING INDEX idx_comments_owner_created "
+                              "(project_owner_id=?)"])
+
+    def test_search(self):
+        with db.connect_db() as conn:
+            db_add(conn, tdc.TEST_ROWS['owners'])
+            db_add(conn, tdc.TEST_ROWS['projects'])
+            db_add(conn, tdc.TEST_ROWS['comments'])
+
+            def found(match, owner_id=tdc.USER_UUID_1):
+                db.flush_search(conn)
+                hits, _ = db.search(conn, owner_id, match, 10)
+                return [(hit["type"], hit["comment_id"] or hit["project_id"]) for hit in hits]
+
+            # only the owner's projects and the comments on them
+            self.assertEqual(sorted(found('"comment"')), [("comment", tdc.MOCK_COMMENT_UUID_11),
+                                                          ("comment", tdc.MOCK_COMMENT_UUID_12)])
+            self.assertEqual(found('"gnome"'), [("project", tdc.MOCK_PROJ_UUID_11)])
+            self.assertEqual(found('"shed"'), [])
+            self.assertEqual(found('"shed"', tdc.USER_UUID_2), [("project", tdc.MOCK_PROJ_UUID_21)])
+
+            # the triggers queue updates and deletes, a flush indexes them
+            conn.execute("UPDATE comments SET message='renamed' WHERE comment_id=?;",
+                         (tdc.MOCK_COMMENT_UUID_11,))
+            conn.execute("UPDATE projects SET project_name='Gnome Garden' WHERE project_id=?;",
+                         (tdc.MOCK_PROJ_UUID_12,))
+            hits, _ = db.search(conn, tdc.USER_UUID_1, '"renamed"', 10)
+            self.assertEqual(hits, [])
+            self.assertEqual(found('"renamed"'), [("comment", tdc.MOCK_COMMENT_UUID_11)])
+            self.assertEqual(len(found('"comment"')), 1)
+            self.assertEqual(len(found('"gnome"')), 2)
+            db.delete_project(conn, tdc.USER_UUID_1, tdc.MOCK_PROJ_UUID_11)
+            self.assertEqual(found('"gnome" OR "renamed"'), [("project", tdc.MOCK_PROJ_UUID_12)])
+
+            # pages of limit hits, next_after is the [score, doc_id] of the last one
+            for i in range(5):
+                db.add_comment(conn, tdc.USER_UUID_4, tdc.MOCK_PROJ_UUID_12, f"page {i}")
+            self.assertTrue(db.flush_search(conn))
+            self.assertFalse(db.flush_search(conn))
+            hits, after = db.search(conn, tdc.USER_UUID_1, '"page"', 3)
+            self.assertEqual(len(hits), 3)
+            self.assertEqual([type(part) for part in after], [float, int])
+            more, after = db.search(conn, tdc.USER_UUID_1, '"page"', 3, after)
+            self.assertEqual((len(more), after), (2, None))
+            self.assertEqual(sorted(hit["message"] for hit in hits + more),
+                             [f"page {i}" for i in range(5)])
+
+            # the index is keyed by search_docs.doc_id, which VACUUM keeps
+            conn.commit()
+            conn.execute("VACUUM;")
+            self.assertEqual(found('"gnome"'), [("project", tdc.MOCK_PROJ_UUID_12)])
+            self.assertEqual(conn.execute("INSERT INTO search_fts (search_fts, rank) "
+                                          "VALUES ('integrity-check', 0);").rowcount, 1)
+
+    def test_project_counters(self):
+        with db.connect_db() as conn:
+            db_add(conn, tdc.TEST_ROWS['owners'])
+            db_add(conn, tdc.TEST_ROWS['projects'])
+
+            def counts():
+                return (db.get_num_projects(conn)["project_count"],
+                        db.get_num_owner_projects(conn, tdc.USER_UUID_1)["project_count"],
+                        db.get_num_owner_projects(conn, tdc.USER_UUID_2)["project_count"])
+
+            self.assertEqual(counts(), (4, 2, 1))
+
+            db.add_project(conn, "new-project", tdc.USER_UUID_1, "new")
+            self.assertEqual(counts(), (5, 3, 1))
+
+            db.delete_project(conn, tdc.USER_UUID_1, "new-project")
+            self.assertEqual(counts(), (4, 2, 1))
+
+            conn.execute("UPDATE projects SET owner_id=? WHERE project_id=?;",
+                         (tdc.USER_UUID_2, tdc.MOCK_PROJ_UUID_12))
+            self.assertEqual(counts(), (4, 1, 2))
+
+            # Projects removed by the owner delete cascade are counted too
+            conn.execute("DELETE FROM owners WHERE owner_id=?;", (tdc.USER_UUID_2,))
+            conn.commit()
+            db.invalidate_owner()
+            self.assertEqual(counts(), (2, 1, 0))
+
+            # The counts are lookups, not scans
+            plan = conn.execute("EXPLAIN QUERY PLAN SELECT project_count FROM owner_project_counts "
+                                "WHERE owner_id=?;", (tdc.USER_UUID_1,)).fetchall()
+            self.assertIn("PRIMARY KEY", plan[0][3])
+
+            conn.execute("DELETE FROM owner_project_counts;")
+            db.rebuild_counters(conn)
+            self.assertEqual(counts(), (2, 1, 0))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,73 @@
+"""
+Tests for introspection.py, against the introspection_server.py stand-in
+"""
+
+import unittest
+import introspection
+import introspection_server
+
+ACCESS_TOKEN_1 = "31cd894de101a0e31ec4aa46503e59c8"
+USER_ID_1 = "8bde3e84-a964-479c-9c7b-4d7991717a1b"
+
+
+class TestIntrospection(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = introspection_server.start_server()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.request_count = 0
+        self.server.token_lifetime = introspection_server.TOKEN_LIFETIME
+        self.introspector = introspection.CachingIntrospector(
+            introspection.HttpBackend(self.server.url))
+
+    def test_http_backend(self):
+        token_info = self.introspector.backend.introspect(ACCESS_TOKEN_1)
+        self.assertTrue(token_info["token_is_valid"])
+        self.assertEqual(token_info["user_info"]["user_id"], USER_ID_1)
+        self.assertIn("exp", token_info)
+
+        token_info = self.introspector.backend.introspect("not-a-token")
+        self.assertFalse(token_info["token_is_valid"])
+
+    def test_repeat_token_is_cached(self):
+        for _ in range(3):
+            token_info = self.introspector.introspect(ACCESS_TOKEN_1)
+            self.assertTrue(token_info["token_is_valid"])
+        self.assertEqual(self.server.request_count, 1)
+
+    def test_invalid_token_is_cached(self):
+        for _ in range(3):
+            self.assertFalse(self.introspector.introspect("not-a-token")["token_is_valid"])
+        self.assertEqual(self.server.request_count, 1)
+
+    def test_expired_token_is_not_cached(self):
+        self.server.token_lifetime = 0
+        self.introspector.introspect(ACCESS_TOKEN_1)
+        self.introspector.introspect(ACCESS_TOKEN_1)
+        self.assertEqual(self.server.request_count, 2)
+
+    def test_backend_error(self):
+        introspector = introspection.CachingIntrospector(
+            introspection.HttpBackend(self.server.url + "/missing"))
+        with self.assertRaises(introspection.IntrospectionError):
+            introspector.introspect(ACCESS_TOKEN_1)
+        self.assertEqual(len(introspector.cache), 0)
+
+    def test_max_size(self):
+        introspector = introspection.CachingIntrospector(
+            introspection.LocalBackend(), max_size=1)
+        introspector.introspect(ACCESS_TOKEN_1)
+        introspector.introspect("not-a-token")
+        self.assertEqual(len(introspector.cache), 1)
+        self.assertEqual(introspector.cache.stats()["evictions"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+"""
+Tests for the metrics.py Prometheus metrics
+"""
+
+import unittest
+import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counter(self):
+        counter = metrics.Counter("test_total", "Test counter", ("route",))
+        counter.inc('/a"b')
+        counter.inc('/a"b', amount=2)
+        self.assertEqual(counter.value('/a"b'), 3)
+        self.assertEqual(counter.render(), ['test_total{route="/a\\"b"} 3'])
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("test_seconds", "Test histogram", ("route",), (0.1, 1))
+        for value in (0.05, 0.5, 0.5, 10):
+            histogram.observe(value, "/a")
+        self.assertEqual(histogram.count("/a"), 4)
+        self.assertEqual(histogram.render(),
+                         ['test_seconds_bucket{route="/a",le="0.1"} 1',
+                          'test_seconds_bucket{route="/a",le="1"} 3',
+                          'test_seconds_bucket{route="/a",le="+Inf"} 4',
+                          'test_seconds_sum{route="/a"} 11.05',
+                          'test_seconds_count{route="/a"} 4'])
+
+    def test_registry(self):
+        registry = metrics.Registry()
+        registry.register(metrics.Counter("test_total", "Test counter")).inc()
+        self.assertEqual(registry.render(),
+                         "# HELP test_total Test counter\n"
+                         "# TYPE test_total counter\n"
+                         "test_total 1\n")
+
+    def test_observe_request(self):
+        timing = metrics.RequestTiming()
+        with timing.introspection():
+            pass
+        timing.add_sql(2, 0.001, 5)
+        timing.add_sql(1, 0.001, 0)
+        self.assertIn('desc="3 statements, 5 rows"', timing.server_timing())
+
+        before = metrics.SQL_ROWS.count("GET", "/test")
+        metrics.observe_request("GET", "/test", 200, timing)
+        self.assertEqual(metrics.SQL_ROWS.count("GET", "/test"), before + 1)
+        self.assertEqual(metrics.REQUESTS.value("GET", "/test", "200"), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
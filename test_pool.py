@@ -0,0 +1,91 @@
+"""
+Tests for the pool.py connection pool
+"""
+
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+import pool
+
+
+class TestPool(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.database = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.pool = self.make_pool()
+
+    def tearDown(self):
+        self.pool.close()
+        os.remove(self.database)
+
+    def make_pool(self, **kwargs):
+        return pool.ConnectionPool(
+            lambda: sqlite3.connect(self.database,
+                                    factory=pool.PooledConnection,
+                                    check_same_thread=False),
+            **kwargs)
+
+    def test_connection_is_reused(self):
+        with self.pool.acquire() as conn:
+            first = conn
+        with self.pool.acquire() as conn:
+            self.assertIs(conn, first)
+
+        stats = self.pool.stats()
+        self.assertEqual(stats["created"], 1)
+        self.assertEqual(stats["reused"], 1)
+        self.assertEqual(stats["idle"], 1)
+
+    def test_max_size(self):
+        self.pool.close()
+        self.pool = self.make_pool(max_size=1, acquire_timeout=0.05)
+
+        conn = self.pool.acquire()
+        with self.assertRaises(pool.PoolTimeout):
+            self.pool.acquire()
+
+        # A waiting thread gets the connection as soon as it is released
+        threading.Timer(0.01, conn.release).start()
+        self.assertIs(self.pool.acquire(timeout=1), conn)
+
+    def test_idle_eviction(self):
+        self.pool.close()
+        self.pool = self.make_pool(idle_timeout=0)
+
+        with self.pool.acquire() as conn:
+            first = conn
+        with self.pool.acquire() as conn:
+            self.assertIsNot(conn, first)
+        self.assertEqual(self.pool.stats()["evicted"], 1)
+
+    def test_health_check(self):
+        self.pool.close()
+        self.pool = self.make_pool(health_check_after=0)
+
+        conn = self.pool.acquire()
+        conn.release()
+        conn.close()
+
+        with self.pool.acquire() as new_conn:
+            self.assertIsNot(new_conn, conn)
+            new_conn.execute("SELECT 1;")
+        self.assertEqual(self.pool.stats()["discarded"], 1)
+
+    def test_release_rolls_back(self):
+        with self.pool.acquire() as conn:
+            conn.execute("CREATE TABLE t (x INTEGER);")
+
+        conn = self.pool.acquire()
+        conn.execute("INSERT INTO t VALUES (1);")
+        conn.release()
+
+        with self.pool.acquire() as conn:
+            self.assertFalse(conn.in_transaction)
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM t;").fetchone()[0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
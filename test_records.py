@@ -0,0 +1,33 @@
+"""
+Tests for the records.py row types
+"""
+
+import sqlite3
+import unittest
+import records
+
+
+class TestRecords(unittest.TestCase):
+
+    def test_columns(self):
+        self.assertEqual(records.fields(records.Owner), ("owner_id", "owner_username"))
+        self.assertEqual(records.columns(records.Project), "project_id, project_name")
+        self.assertEqual(records.columns(records.Project, "p"), "p.project_id, p.project_name")
+
+    def test_row_factory(self):
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE TABLE comments (message TEXT, comment_id TEXT, "
+                     "commenter_username TEXT, commenter_id TEXT);")
+        conn.execute("INSERT INTO comments VALUES ('it''s', 'c1', 'name', 'o1');")
+        c = conn.cursor()
+        c.row_factory = records.row_factory(records.Comment)
+        comment = c.execute(f"SELECT {records.columns(records.Comment)} FROM comments;").fetchone()
+        conn.close()
+
+        self.assertEqual(comment, {"comment_id": "c1", "commenter_id": "o1",
+                                   "commenter_username": "name", "message": "it's"})
+        self.assertIs(records.row_factory(records.Comment), c.row_factory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+"""
+Tests for the render.py JSON encoding
+"""
+
+import json
+import unittest
+import render
+
+DOCUMENT = {"project_id": "p1",
+            "owner_username": "grün",
+            "count": 3,
+            "flag": None,
+            "comments": [{"comment_id": str(i), "message": f"message {i}"} for i in range(5)]}
+
+
+class TestRender(unittest.TestCase):
+
+    def tearDown(self):
+        render.set_serializer()
+
+    def test_serializers_agree(self):
+        for name in render.SERIALIZERS:
+            render.set_serializer(name)
+            self.assertEqual(render.get_serializer(), name)
+            body = render.dumps(DOCUMENT)
+            self.assertIsInstance(body, bytes)
+            self.assertEqual(json.loads(body), DOCUMENT)
+            self.assertEqual(body, render.SERIALIZERS["json"](DOCUMENT))
+
+    def test_auto(self):
+        expected = "orjson" if render.orjson is not None else "json"
+        self.assertEqual(render.set_serializer("auto"), expected)
+        with self.assertRaises(ValueError):
+            render.set_serializer("no-such-serializer")
+
+    def test_stream_json(self):
+        head = {key: value for key, value in DOCUMENT.items() if key != "comments"}
+        comments = DOCUMENT["comments"]
+        for name in render.SERIALIZERS:
+            render.set_serializer(name)
+            fragments = list(render.stream_json(head, "comments",
+                                                [comments[:2], [], comments[2:]],
+                                                {"next_cursor": None}))
+            self.assertEqual(json.loads(b"".join(fragments)),
+                             dict(DOCUMENT, next_cursor=None))
+            self.assertEqual(json.loads(b"".join(render.stream_json({}, "owners", []))),
+                             {"owners": []})
+
+
+if __name__ == '__main__':
+    unittest.main()
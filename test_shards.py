@@ -0,0 +1,151 @@
+"""
+Tests for the shards.py owner based sharding, and the app.py routes on 3 shards
+"""
+
+import os
+import random
+import sqlite3
+import tempfile
+import unittest
+import api
+import app
+import auth
+import datagen
+import db
+import shards
+
+ACCESS_TOKEN_1 = "31cd894de101a0e31ec4aa46503e59c8"
+HEADERS_1 = {"Authorization": "Bearer " + ACCESS_TOKEN_1}
+USER_ID_1 = auth.TOKEN_MAPPING[ACCESS_TOKEN_1]["user_info"]["user_id"]
+
+
+def shard_rows(path, sql):
+    """shard_rows - rows of a query on one shard file, outside the pools"""
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.database = os.path.join(self.directory.name, "shards.db")
+        db.init_pool(database=self.database, shard_count=3)
+        shards.initialize_db()
+        shards.forget_project()
+        api.invalidate_project()
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        db.close_pool()
+        shards.forget_project()
+        api.invalidate_project()
+        db.invalidate_owner()
+        self.directory.cleanup()
+
+    def assert_placed(self, databases):
+        """every project is in its owner's shard, every owner in every shard"""
+        owners = None
+        for shard, path in enumerate(databases):
+            for owner_id, in shard_rows(path, "SELECT owner_id FROM projects;"):
+                self.assertEqual(shards.shard_for_owner(owner_id, len(databases)), shard)
+            shard_owners = shard_rows(path, "SELECT owner_id FROM owners ORDER BY owner_id;")
+            self.assertEqual(shard_owners, owners or shard_owners)
+            owners = shard_owners
+
+    def test_shard_for_owner(self):
+        self.assertEqual(db.shard_databases(self.database, 3),
+                         [self.database] + [os.path.join(self.directory.name, f"shards-shard{i}.db")
+                                            for i in (1, 2)])
+        self.assertEqual(shards.shard_for_owner(USER_ID_1),
+                         shards.shard_for_owner(USER_ID_1, 3))
+        self.assertEqual(shards.shard_for_owner(USER_ID_1, 1), 0)
+        owners = datagen.generate_owners(300, random.Random(0))
+        used = {shards.shard_for_owner(owner_id) for owner_id, _ in owners}
+        self.assertEqual(used, {0, 1, 2})
+
+    def test_routes(self):
+        r = self.client.post("/app/populate_test_data", headers=HEADERS_1)
+        self.assertEqual(r.status_code, 200)
+        self.assert_placed(db.get_shard_databases())
+
+        # the count is summed over every shard
+        r = self.client.get("/projects/count", headers=HEADERS_1)
+        self.assertIn("there are 4 projects", r.get_json()["message"])
+
+        r = self.client.post("/projects", headers=HEADERS_1, json={"project_name": "sharded"})
+        self.assertEqual(r.status_code, 200)
+        project_id = r.get_json()["project_id"]
+        path = db.get_shard_databases()[shards.shard_for_owner(USER_ID_1)]
+        self.assertEqual(shard_rows(path, "SELECT COUNT(*) FROM projects WHERE project_name='sharded';"),
+                         [(1,)])
+
+        # comments follow the project, whoever the commenter is
+        for commenter_id in (USER_ID_1, list(auth.TOKEN_MAPPING.values())[1]["user_info"]["user_id"]):
+            r = self.client.post(f"/projects/{project_id}/comments", headers=HEADERS_1,
+                                 json={"commenter_id": commenter_id, "message": "hi"})
+            self.assertEqual(r.status_code, 200)
+        r = self.client.get(f"/projects/{project_id}", headers=HEADERS_1)
+        self.assertEqual(len(r.get_json()["comments"]), 2)
+
+        r = self.client.post("/projects/no-such-project/comments", headers=HEADERS_1,
+                             json={"commenter_id": USER_ID_1, "message": "hi"})
+        self.assertEqual(r.status_code, 404)
+
+        r = self.client.delete(f"/projects/{project_id}", headers=HEADERS_1)
+        self.assertEqual(r.status_code, 200)
+        r = self.client.post(f"/projects/{project_id}/comments", headers=HEADERS_1,
+                             json={"commenter_id": USER_ID_1, "message": "hi"})
+        self.assertEqual(r.status_code, 404)
+
+    def test_owner_writes(self):
+        # whichever shard the write starts on, every shard gets it
+        with db.connect_db(shard=1) as conn:
+            db.add_owner(conn, USER_ID_1, "owner")
+            self.assertEqual(db.get_owner_username(conn, USER_ID_1), "owner")
+        with db.connect_db(shard=2) as conn:
+            api.update_owner(conn, USER_ID_1, "renamed")
+        for path in db.get_shard_databases():
+            self.assertEqual(shard_rows(path, "SELECT owner_id, owner_username FROM owners;"),
+                             [(USER_ID_1, "renamed")])
+        # the cached username read before the rename is gone
+        with db.connect_db(shard=1, readonly=True) as conn:
+            self.assertEqual(db.get_owner_username(conn, USER_ID_1), "renamed")
+
+    def test_rebalance(self):
+        db.init_pool(database=self.database, shard_count=1)
+        with db.connect_db() as conn:
+            counts = datagen.bulk_load(conn, 60, 3, 600)
+            expected = {owner_id: db.get_num_owner_projects(conn, owner_id)["project_count"]
+                        for owner_id, in conn.execute("SELECT owner_id FROM owners;").fetchall()}
+        db.close_pool()
+
+        for count in (3, 2):
+            shards.rebalance(self.database, count)
+            databases = db.shard_databases(self.database, count)
+            self.assert_placed(databases)
+
+            db.init_pool(database=self.database, shard_count=count)
+            self.assertEqual(shards.get_num_projects(), {"project_count": counts["projects"]})
+            comments = sum(shard_rows(path, "SELECT COUNT(*) FROM comments;")[0][0]
+                           for path in databases)
+            self.assertEqual(comments, counts["comments"])
+            # the trigger-maintained counters moved with the projects
+            for owner_id, project_count in expected.items():
+                with shards.connect_owner(owner_id, readonly=True) as conn:
+                    self.assertEqual(db.get_num_owner_projects(conn, owner_id)["project_count"],
+                                     project_count)
+            db.close_pool()
+
+        # shard 2 is left empty, and running again moves nothing
+        self.assertEqual(shard_rows(db.shard_databases(self.database, 3)[2],
+                                    "SELECT COUNT(*) FROM projects;"), [(0,)])
+        moved = shards.rebalance(self.database, 2)
+        self.assertEqual((moved["projects"], moved["comments"]), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
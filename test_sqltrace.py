@@ -0,0 +1,114 @@
+"""
+Tests for the sqltrace.py statement tracer and the query plans of the db.py hot paths
+"""
+
+import os
+import tempfile
+import unittest
+import uuid
+import auth
+import datagen
+import db
+import sqltrace
+
+USER_ID_1 = list(auth.TOKEN_MAPPING.values())[0]["user_info"]["user_id"]
+
+
+class TestSQLTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        db.init_pool(database=os.path.join(self.directory.name, "sqltrace.db"))
+        with db.connect_db() as conn:
+            db.initialize_db(conn)
+        self.tracer = sqltrace.Tracer(slow_threshold=None)
+        self.previous = db.set_tracer(self.tracer)
+
+    def tearDown(self):
+        db.set_tracer(self.previous)
+        db.close_pool()
+        self.directory.cleanup()
+
+    def test_statements(self):
+        with db.connect_db() as conn:
+            db.add_owner(conn, USER_ID_1, "owner")
+            conn.execute("CREATE TABLE unindexed (a TEXT);")
+            for _ in range(3):
+                db.get_owner(conn, USER_ID_1)
+            conn.execute("SELECT a FROM unindexed WHERE a=?;", ("x",)).fetchall()
+            self.tracer.flush()
+
+        statements = self.tracer.statements()
+        get_owner = [stats for sql, stats in statements.items() if "FROM owners" in sql][0]
+        self.assertEqual(get_owner["calls"], 3)
+        self.assertGreater(get_owner["seconds"], 0)
+        self.assertTrue(get_owner["plan"][0].startswith("SEARCH owners"))
+
+        self.assertEqual(list(self.tracer.scans().values()), [["SCAN unindexed"]])
+        self.assertFalse(sqltrace.is_scan("SCAN comments_fts VIRTUAL TABLE INDEX 0:M1"))
+        self.assertTrue(sqltrace.is_scan("SCAN comments_fts VIRTUAL TABLE INDEX 0:"))
+        self.assertFalse(sqltrace.is_scan("SCAN hits", {"hits"}))
+        self.assertEqual(len(self.tracer.slowest(2)), 2)
+
+    def test_slow_query_log(self):
+        self.tracer.slow_threshold = 0
+        with db.connect_db() as conn:
+            with self.assertLogs("sqltrace", "WARNING") as logs:
+                db.get_owner(conn, USER_ID_1)
+                self.tracer.flush()
+        self.assertIn(f"WHERE owner_id='{USER_ID_1}'", logs.output[0])
+        self.assertIn("SEARCH owners", logs.output[0])
+
+    def test_trigger_statements(self):
+        # the FTS5 and counter triggers run statements of their own inside the insert
+        self.tracer.slow_threshold = 0
+        with db.connect_db() as conn:
+            db.add_owner(conn, USER_ID_1, "owner")
+            project_id = str(uuid.uuid4())
+            with self.assertLogs("sqltrace", "WARNING") as logs:
+                db.add_project(conn, project_id, USER_ID_1, "traced project")
+                self.tracer.flush()
+        inserts = [line for line in logs.output if "INSERT INTO projects" in line]
+        self.assertEqual(len(inserts), 1)
+        self.assertIn("'traced project'", inserts[0])
+        self.assertFalse([line for line in logs.output if "-- " in line])
+
+    def test_hot_paths_use_indexes(self):
+        """test_hot_paths_use_indexes - every statement the request paths run on a
+        generated dataset looks rows up (SEARCH) instead of reading a table (SCAN)"""
+        with db.connect_db() as conn:
+            datagen.bulk_load(conn, owners=200, projects_per_owner=5, comments=20000)
+            self.tracer.reset()
+
+            projects, _ = db.get_projects_page(conn, USER_ID_1, 10)
+            project_id = projects[0]["project_id"]
+            list(db.iter_projects(conn, USER_ID_1))
+            db.get_owners_page(conn, 10)
+            list(db.iter_owners(conn))
+            db.get_project(conn, USER_ID_1, project_id)
+            db.get_project_page(conn, USER_ID_1, project_id, 10, 5)
+            db.get_project_version(conn, USER_ID_1, project_id)
+            list(db.iter_comments(conn, project_id))
+            db.get_comments(conn, project_id)
+            db.get_owner_comments(conn, USER_ID_1)
+            _, after = db.get_owner_comments_page(conn, USER_ID_1, 10)
+            db.get_owner_comments_page(conn, USER_ID_1, 10, after)
+            _, after = db.search(conn, USER_ID_1, '"comment"', 1)
+            db.search(conn, USER_ID_1, '"comment"', 1, after)
+            db.get_num_projects(conn)
+            db.get_num_owner_projects(conn, USER_ID_1)
+            db.invalidate_owner()
+            db.get_owner_usernames(conn, [USER_ID_1])
+            comment = db.add_comment(conn, USER_ID_1, project_id, "traced")
+            db.get_comment(conn, comment["comment_id"])
+            new_project_id = str(uuid.uuid4())
+            db.add_project(conn, new_project_id, USER_ID_1, "traced")
+            db.delete_project(conn, USER_ID_1, new_project_id)
+            self.tracer.flush()
+
+        self.assertGreaterEqual(len(self.tracer.statements()), 15)
+        self.assertEqual(self.tracer.scans(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()